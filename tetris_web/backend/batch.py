@@ -0,0 +1,413 @@
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+from game import (ActionType, BOARD_HEIGHT, BOARD_WIDTH, BOMB_LINES_REQUIRED, LINE_CLEAR_STEP,
+                  RANDOMIZERS, ROTATIONS, TETROMINOS, UniformRandomizer, WALL_KICKS, new_seed)
+
+# 1ステップで進める既定の時間（ミリ秒、約60FPS）
+DEFAULT_STEP_MS = 16
+
+# バッチ用のアクション番号（0は操作なし）
+BATCH_ACTIONS: List[Optional[ActionType]] = [
+    None,
+    ActionType.LEFT,
+    ActionType.RIGHT,
+    ActionType.DOWN,
+    ActionType.ROTATE,
+    ActionType.HARD_DROP,
+    ActionType.PLACE_BOMB,
+    ActionType.SPAWN_BOMB,
+    ActionType.PAUSE,
+    ActionType.SPEED_UP,
+    ActionType.SPEED_DOWN,
+]
+ACTION_CODES = {action: code for code, action in enumerate(BATCH_ACTIONS) if action is not None}
+
+# TetrisGameの初期値・定数（game.py と同じ値）
+SPAWN_X = BOARD_WIDTH // 2 - 1
+INITIAL_FALL_SPEED = 300
+INITIAL_LOCK_DELAY = 200
+FAST_LOCK_DELAY = 50
+LINE_CLEAR_DELAY = 250
+BOMB_RADIUS = 3
+
+
+def _build_cell_table():
+    """形状番号+1・回転ごとの占有セル(dx, dy)の表（4セルに満たない爆弾は先頭セルで埋める）"""
+    cells = np.zeros((len(TETROMINOS) + 1, 4, 4, 2), dtype=np.int16)
+    for shape_idx in range(-1, len(TETROMINOS)):
+        for rotation_idx, rotation in enumerate(ROTATIONS[shape_idx]):
+            shape_cells = list(rotation.cells)
+            shape_cells += [shape_cells[0]] * (4 - len(shape_cells))
+            cells[shape_idx + 1, rotation_idx] = shape_cells
+    return cells
+
+
+# [形状番号+1, 回転, セル, (dx, dy)]
+PIECE_CELLS = _build_cell_table()
+ROWS = np.arange(BOARD_HEIGHT)
+COLS = np.arange(BOARD_WIDTH)
+
+
+class BatchEngine:
+    """K個のゲームを配列でまとめて進めるロックステップのエンジン（ボット学習・大量シミュレーション用）
+
+    盤面は uint8[K, 20, 10]（0は空、1〜7は形状番号+1）で持ち、ピースやスコアなどの状態も
+    ゲームごとの配列で持つ。step() は各ゲームに1つずつアクションを適用してから時計を進めて
+    update() と同じ処理を行い、各ゲームで perform_action() → update() を呼んだ場合と同じ結果になる。
+    ピース列は各ゲームのシードからTetrisGameと同じ生成器で作るため、同じシードなら同じ順になる。
+    """
+
+    def __init__(self, count: int, seeds: Optional[Sequence[int]] = None,
+                 randomizer: str = UniformRandomizer.name, speed_multiplier: float = 1.0,
+                 step_ms: int = DEFAULT_STEP_MS):
+        if randomizer not in RANDOMIZERS:
+            raise ValueError(f"不明なピース列の種類です: {randomizer}")
+        self.count = count
+        self.randomizer_name = randomizer
+        self.step_ms = step_ms
+        self.time = 0
+
+        self.board = np.zeros((count, BOARD_HEIGHT, BOARD_WIDTH), dtype=np.uint8)
+        # 行ごとにブロックがあるか（盤面を書き換えたゲームだけ更新し、積み上がり判定で使う）
+        self.row_occupied = np.zeros((count, BOARD_HEIGHT), dtype=bool)
+        self.piece_shape = np.zeros(count, dtype=np.int8)
+        self.piece_rotation = np.zeros(count, dtype=np.int8)
+        self.piece_x = np.zeros(count, dtype=np.int16)
+        self.piece_y = np.zeros(count, dtype=np.int16)
+        self.next_shape = np.zeros(count, dtype=np.int8)
+
+        self.game_over = np.zeros(count, dtype=bool)
+        self.paused = np.zeros(count, dtype=bool)
+        self.score = np.zeros(count, dtype=np.int64)
+        self.level = np.zeros(count, dtype=np.int32)
+        self.lines_cleared = np.zeros(count, dtype=np.int32)
+        self.bombs_available = np.zeros(count, dtype=np.int32)
+        self.lines_cleared_this_frame = np.zeros(count, dtype=np.int32)
+
+        self.fall_time = np.zeros(count, dtype=np.int64)
+        self.fall_speed = np.zeros(count, dtype=np.int64)
+        self.base_fall_speed = np.zeros(count, dtype=np.int64)
+        self.speed_multiplier = np.zeros(count, dtype=np.float64)
+
+        self.lock_delay = np.zeros(count, dtype=np.int64)
+        self.lock_time = np.zeros(count, dtype=np.int64)
+        self.is_locked = np.zeros(count, dtype=bool)
+
+        self.pending_line_clear = np.zeros(count, dtype=bool)
+        self.pending_lines = np.zeros(count, dtype=np.int32)
+        self.line_clear_started = np.zeros(count, dtype=np.int64)
+        self.line_clear_timing = np.zeros(count, dtype=bool)  # line_clear_started が設定済みか
+
+        # 未爆発の爆弾の位置（次のupdateで爆発する）
+        self.bomb_centers = np.zeros((count, BOARD_HEIGHT, BOARD_WIDTH), dtype=bool)
+
+        self.seeds = np.zeros(count, dtype=np.int64)
+        self._randomizers: List = [None] * count
+        self.reset(np.arange(count), seeds, speed_multiplier)
+
+    def reset(self, indices: Sequence[int], seeds: Optional[Sequence[int]] = None,
+              speed_multiplier: float = 1.0):
+        """指定したゲームを新しいゲームに戻す（TetrisGame() の初期状態と同じ）"""
+        indices = np.asarray(indices, dtype=np.int64)
+        if seeds is None:
+            seeds = [new_seed() for _ in range(len(indices))]
+        randomizer_class = RANDOMIZERS[self.randomizer_name]
+        for i, seed in zip(indices.tolist(), seeds):
+            self.seeds[i] = seed
+            self._randomizers[i] = randomizer_class(int(seed))
+
+        self.board[indices] = 0
+        self.row_occupied[indices] = False
+        self.game_over[indices] = False
+        self.paused[indices] = False
+        self.score[indices] = 0
+        self.level[indices] = 1
+        self.lines_cleared[indices] = 0
+        self.bombs_available[indices] = 0
+        self.lines_cleared_this_frame[indices] = 0
+        self.fall_time[indices] = 0
+        self.fall_speed[indices] = INITIAL_FALL_SPEED
+        self.base_fall_speed[indices] = INITIAL_FALL_SPEED
+        self.speed_multiplier[indices] = speed_multiplier
+        self.lock_delay[indices] = INITIAL_LOCK_DELAY
+        self.lock_time[indices] = 0
+        self.is_locked[indices] = False
+        self.pending_line_clear[indices] = False
+        self.pending_lines[indices] = 0
+        self.line_clear_started[indices] = 0
+        self.line_clear_timing[indices] = False
+        self.bomb_centers[indices] = False
+
+        # 最初の次ピースを引いてから通常の生成を行う
+        self.next_shape[indices] = [self._randomizers[i].next() for i in indices.tolist()]
+        self._spawn(indices)
+
+    # ---- 判定 ----
+
+    def _fits(self, indices: np.ndarray, shape: np.ndarray, rotation: np.ndarray,
+              x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        """各ゲームのピースを(x, y)に置けるか（TetrisGame.piece_fits と同じ判定）"""
+        cells = PIECE_CELLS[shape.astype(np.int64) + 1, rotation.astype(np.int64) % 4]
+        cell_x = x[:, None] + cells[..., 0]
+        cell_y = y[:, None] + cells[..., 1]
+        inside = ((cell_x >= 0) & (cell_x < BOARD_WIDTH) & (cell_y < BOARD_HEIGHT)).all(axis=1)
+        occupied = self.board[indices[:, None], np.clip(cell_y, 0, BOARD_HEIGHT - 1),
+                              np.clip(cell_x, 0, BOARD_WIDTH - 1)] != 0
+        return inside & ~(occupied & (cell_y >= 0)).any(axis=1)
+
+    def _piece_fits(self, indices: np.ndarray, dx: int = 0, dy: int = 0) -> np.ndarray:
+        return self._fits(indices, self.piece_shape[indices], self.piece_rotation[indices],
+                          self.piece_x[indices] + dx, self.piece_y[indices] + dy)
+
+    def _move(self, indices: np.ndarray, dx: int, dy: int) -> np.ndarray:
+        """move_piece と同じ移動（ライン消去待ちのゲームは動かない）。移動できたかを返す"""
+        movable = ~self.pending_line_clear[indices]
+        movable[movable] = self._piece_fits(indices[movable], dx, dy)
+        moved = indices[movable]
+        self.piece_x[moved] += dx
+        self.piece_y[moved] += dy
+        return movable
+
+    # ---- 配置・消去・生成 ----
+
+    def _spawn(self, indices: np.ndarray):
+        """次のピースを現在のピースにして新しい次のピースを引く（置けなければゲームオーバー）"""
+        if len(indices) == 0:
+            return
+        self.piece_shape[indices] = self.next_shape[indices]
+        self.piece_rotation[indices] = 0
+        self.piece_x[indices] = SPAWN_X
+        self.piece_y[indices] = 0
+        self.next_shape[indices] = [self._randomizers[i].next() for i in indices.tolist()]
+        self.game_over[indices] |= ~self._piece_fits(indices)
+
+    def _explode(self, indices: np.ndarray, centers: np.ndarray):
+        """爆弾の周囲（半径3の正方形）のブロックを消去。centersは[n, 20, 10]の爆心"""
+        # 爆弾は稀なので爆心ごとに範囲を塗る（複数の爆弾の範囲は和になる）
+        area = np.zeros_like(centers)
+        for n, y, x in zip(*np.nonzero(centers)):
+            area[n, max(0, y - BOMB_RADIUS):y + BOMB_RADIUS + 1,
+                 max(0, x - BOMB_RADIUS):x + BOMB_RADIUS + 1] = True
+        boards = self.board[indices]
+        boards[area] = 0
+        self.board[indices] = boards
+        self.row_occupied[indices] = boards.any(axis=2)
+
+    def _place(self, indices: np.ndarray):
+        """place_piece と同じ配置（爆弾ピースは配置と同時に爆発）"""
+        if len(indices) == 0:
+            return
+        shape = self.piece_shape[indices]
+        bomb = shape < 0
+
+        # 爆弾ピース（1セル）：ボード内なら爆発
+        bomb_indices = indices[bomb]
+        if len(bomb_indices):
+            x = self.piece_x[bomb_indices].astype(np.int64)
+            y = self.piece_y[bomb_indices].astype(np.int64)
+            centers = np.zeros((len(bomb_indices), BOARD_HEIGHT, BOARD_WIDTH), dtype=bool)
+            inside = y >= 0
+            centers[np.nonzero(inside)[0], y[inside], x[inside]] = True
+            self._explode(bomb_indices, centers)
+
+        # 通常のピース：セルを書き込む（画面上端より上のセルは捨てる）
+        piece_indices = indices[~bomb]
+        if len(piece_indices):
+            cells = PIECE_CELLS[self.piece_shape[piece_indices].astype(np.int64) + 1,
+                                self.piece_rotation[piece_indices].astype(np.int64) % 4]
+            cell_x = self.piece_x[piece_indices, None] + cells[..., 0]
+            cell_y = self.piece_y[piece_indices, None] + cells[..., 1]
+            colors = np.broadcast_to((self.piece_shape[piece_indices] + 1)[:, None], cell_x.shape)
+            game_index = np.broadcast_to(piece_indices[:, None], cell_x.shape)
+            visible = cell_y >= 0
+            self.board[game_index[visible], cell_y[visible], cell_x[visible]] = colors[visible]
+
+        cleared = self._clear_lines(indices)
+        self.row_occupied[indices] = self.board[indices].any(axis=2)
+        has_lines = cleared > 0
+        line_indices = indices[has_lines]
+        self.pending_line_clear[line_indices] = True
+        self.pending_lines[line_indices] = cleared[has_lines]
+        self.line_clear_timing[line_indices] = False
+        self.lines_cleared_this_frame[line_indices] = cleared[has_lines]
+        self._spawn(indices[~has_lines])
+
+    def _clear_lines(self, indices: np.ndarray) -> np.ndarray:
+        """clear_lines と同じライン消去と得点・レベル・爆弾獲得。消去したライン数を返す"""
+        boards = self.board[indices]
+        full = (boards != 0).all(axis=2)
+        cleared = full.sum(axis=1).astype(np.int32)
+        has_lines = cleared > 0
+        if not has_lines.any():
+            return cleared
+
+        line_indices = indices[has_lines]
+        boards = boards[has_lines]
+        full = full[has_lines]
+        count = cleared[has_lines]
+
+        # 揃った行を先頭に集め（安定ソートで残す行の順序を保つ）、その分を空行にする
+        order = np.argsort(~full, axis=1, kind="stable")
+        boards = np.take_along_axis(boards, order[:, :, None], axis=1)
+        boards[ROWS[None, :] < count[:, None]] = 0
+        self.board[line_indices] = boards
+
+        old_lines = self.lines_cleared[line_indices]
+        new_lines = old_lines + count
+        self.lines_cleared[line_indices] = new_lines
+        self.bombs_available[line_indices] += (new_lines // BOMB_LINES_REQUIRED -
+                                               old_lines // BOMB_LINES_REQUIRED)
+        self.score[line_indices] += count * 100 * self.level[line_indices]
+        level = new_lines // 10 + 1
+        self.level[line_indices] = level
+        self.base_fall_speed[line_indices] = np.maximum(50, 375 - (level - 1) * 37)
+        return cleared
+
+    def _check_stack_height(self, indices: np.ndarray):
+        """check_stack_height と同じ落下速度の再計算"""
+        if len(indices) == 0:
+            return
+        occupied_rows = self.row_occupied[indices]
+        top_empty_rows = np.where(occupied_rows.any(axis=1), occupied_rows.argmax(axis=1), BOARD_HEIGHT)
+        stack_ratio = 1.0 - (top_empty_rows / BOARD_HEIGHT)
+        base = self.base_fall_speed[indices]
+        speed = self.speed_multiplier[indices]
+        stack_speed_multiplier = 1.0 + (stack_ratio - 0.5) * 1.0
+        fall_speed = np.where(stack_ratio > 0.5,
+                              np.trunc(base * stack_speed_multiplier / speed),
+                              np.trunc(base / speed)).astype(np.int64)
+        self.fall_speed[indices] = np.maximum(50, fall_speed)
+
+    # ---- アクション ----
+
+    def apply_actions(self, actions: np.ndarray, bomb_x: Optional[np.ndarray] = None,
+                      bomb_y: Optional[np.ndarray] = None):
+        """各ゲームにアクション番号（BATCH_ACTIONS）を1つずつ適用（perform_action と同じ）
+
+        place_bomb の座標は bomb_x・bomb_y で指定する（省略時は(0, 0)）。
+        """
+        actions = np.asarray(actions)
+        live = ~self.game_over
+
+        def select(action: ActionType) -> np.ndarray:
+            return np.nonzero(live & (actions == ACTION_CODES[action]))[0]
+
+        self._move(select(ActionType.LEFT), -1, 0)
+        self._move(select(ActionType.RIGHT), 1, 0)
+
+        # ↓：最大3マス落下し、接地中ならロック遅延を短縮
+        indices = select(ActionType.DOWN)
+        for _ in range(3):
+            if len(indices) == 0:
+                break
+            moved = self._move(indices, 0, 1)
+            stopped = indices[~moved]
+            self.lock_delay[stopped[self.is_locked[stopped]]] = FAST_LOCK_DELAY
+            indices = indices[moved]
+
+        self._rotate(select(ActionType.ROTATE))
+
+        # ハードドロップ：落ちきるまで移動してから配置
+        indices = select(ActionType.HARD_DROP)
+        falling = indices
+        while len(falling):
+            falling = falling[self._move(falling, 0, 1)]
+        self._place(indices)
+
+        indices = select(ActionType.PLACE_BOMB)
+        if len(indices):
+            x = np.zeros(len(indices), dtype=np.int64) if bomb_x is None else np.asarray(bomb_x)[indices]
+            y = np.zeros(len(indices), dtype=np.int64) if bomb_y is None else np.asarray(bomb_y)[indices]
+            placed = ((self.bombs_available[indices] > 0) & (x >= 0) & (x < BOARD_WIDTH) &
+                      (y >= 0) & (y < BOARD_HEIGHT))
+            self.bomb_centers[indices[placed], y[placed], x[placed]] = True
+            self.bombs_available[indices[placed]] -= 1
+
+        indices = select(ActionType.SPAWN_BOMB)
+        indices = indices[self.bombs_available[indices] > 0]
+        self.next_shape[indices] = -1
+        self.bombs_available[indices] -= 1
+
+        indices = select(ActionType.PAUSE)
+        self.paused[indices] = ~self.paused[indices]
+
+        indices = select(ActionType.SPEED_UP)
+        self.speed_multiplier[indices] = np.minimum(3.0, self.speed_multiplier[indices] + 0.25)
+        self._check_stack_height(indices)
+        indices = select(ActionType.SPEED_DOWN)
+        self.speed_multiplier[indices] = np.maximum(0.25, self.speed_multiplier[indices] - 0.25)
+        self._check_stack_height(indices)
+
+    def _rotate(self, indices: np.ndarray):
+        """rotate_piece と同じ回転と壁キック（左右1・2マス、上1マスの順に試す）"""
+        indices = indices[~self.pending_line_clear[indices]]
+        if len(indices) == 0:
+            return
+        original = self.piece_rotation[indices].copy()
+        self.piece_rotation[indices] = (original + 1) % 4
+        remaining = indices[~self._piece_fits(indices)]
+        for dx, dy in WALL_KICKS:
+            if len(remaining) == 0:
+                return
+            fits = self._piece_fits(remaining, dx, dy)
+            kicked = remaining[fits]
+            self.piece_x[kicked] += dx
+            self.piece_y[kicked] += dy
+            remaining = remaining[~fits]
+        # どこにも置けなければ回転を戻す
+        self.piece_rotation[remaining] = (self.piece_rotation[remaining] - 1) % 4
+
+    # ---- 時間経過 ----
+
+    def update(self, current_time: int):
+        """全ゲームで TetrisGame.update(current_time) と同じ処理を行う"""
+        active = ~self.game_over & ~self.paused
+
+        # ライン消去の遅延処理（完了したゲームは新しいピースを出してこの回の処理を終える）
+        pending = np.nonzero(active & self.pending_line_clear)[0]
+        if len(pending):
+            starting = pending[~self.line_clear_timing[pending]]
+            self.line_clear_started[starting] = current_time - LINE_CLEAR_STEP
+            self.line_clear_timing[starting] = True
+            done = pending[current_time - self.line_clear_started[pending] >= LINE_CLEAR_DELAY]
+            self.pending_line_clear[done] = False
+            self.lines_cleared_this_frame[done] = self.pending_lines[done]
+            self._spawn(done)
+            active[done] = False
+
+        # 自動落下（接地したらロックし、ロック時間が過ぎたら配置）
+        falling = np.nonzero(active & (current_time - self.fall_time > self.fall_speed))[0]
+        if len(falling):
+            was_locked = self.is_locked[falling].copy()
+            moved = self._move(falling, 0, 1)
+            self.is_locked[falling[moved]] = False
+            grounded = ~moved
+            newly_locked = falling[grounded & ~was_locked]
+            self.is_locked[newly_locked] = True
+            self.lock_time[newly_locked] = current_time
+            locked = falling[grounded & was_locked]
+            placing = locked[current_time - self.lock_time[locked] >= self.lock_delay[locked]]
+            self._place(placing)
+            self.is_locked[placing] = False
+            self.fall_time[falling] = current_time
+
+        indices = np.nonzero(active)[0]
+        self._check_stack_height(indices)
+
+        # 爆弾の爆発
+        bombed = indices[self.bomb_centers[indices].any(axis=(1, 2))]
+        if len(bombed):
+            self._explode(bombed, self.bomb_centers[bombed])
+            self.bomb_centers[bombed] = False
+
+        self.lines_cleared_this_frame[indices[~self.pending_line_clear[indices]]] = 0
+
+    def step(self, actions: Optional[np.ndarray] = None, bomb_x: Optional[np.ndarray] = None,
+             bomb_y: Optional[np.ndarray] = None):
+        """アクションを適用してから時計をstep_ms進めて全ゲームを更新"""
+        if actions is not None:
+            self.apply_actions(actions, bomb_x, bomb_y)
+        self.time += self.step_ms
+        self.update(self.time)
@@ -0,0 +1,378 @@
+import operator
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from game import (ActionType, BOARD_HEIGHT, BOARD_WIDTH, FULL_ROW_MASK, ROTATIONS, SOFT_DROP_CELLS,
+                  TetrisGame, WALL_KICKS)
+
+# 評価済みの盤面を保持する数（置換表の上限）
+DEFAULT_CACHE_SIZE = 100000
+# 次のピースまで先読みする候補数（1手目の評価が高い順）
+DEFAULT_BEAM_WIDTH = 2
+# 爆弾の爆発範囲（game.Bomb と同じ半径）
+BOMB_RADIUS = 3
+
+Masks = Tuple[int, ...]
+# ピースの状態（回転, x, y）
+PieceState = Tuple[int, int, int]
+
+
+@dataclass(frozen=True)
+class BoardFeatures:
+    """盤面の評価に使う特徴量"""
+    heights: Tuple[int, ...]  # 列ごとの高さ
+    aggregate_height: int
+    max_height: int
+    holes: int  # 上にブロックがある空きセル数
+    bumpiness: int  # 隣り合う列の高さの差の合計
+    lines: int  # この配置までに消したライン数
+
+
+Heuristic = Callable[[BoardFeatures], float]
+
+
+def default_heuristic(features: BoardFeatures) -> float:
+    """標準の評価関数（高さ・穴・凹凸を減らし、ライン消去を増やす）"""
+    return (-0.51 * features.aggregate_height
+            + 0.76 * features.lines
+            - 0.36 * features.holes
+            - 0.18 * features.bumpiness)
+
+
+# 行ビットマスク → ビットの立っている列
+_ROW_COLUMNS: Tuple[Tuple[int, ...], ...] = tuple(
+    tuple(c for c in range(BOARD_WIDTH) if mask >> c & 1) for mask in range(FULL_ROW_MASK + 1))
+
+
+def board_features(masks: Masks, lines: int) -> BoardFeatures:
+    """行ビットマスクの盤面から特徴量を計算"""
+    heights = [0] * BOARD_WIDTH
+    covered = 0
+    for r, mask in enumerate(masks):
+        new = mask & ~covered
+        if new:
+            height = BOARD_HEIGHT - r
+            for c in _ROW_COLUMNS[new]:
+                heights[c] = height
+            covered |= new
+            if covered == FULL_ROW_MASK:
+                break
+    aggregate_height = sum(heights)
+    # 列の高さまでのセルのうちブロックのないものが穴
+    holes = aggregate_height - sum(map(int.bit_count, masks))
+    bumpiness = sum(map(abs, map(operator.sub, heights[:-1], heights[1:])))
+    return BoardFeatures(tuple(heights), aggregate_height, max(heights), holes, bumpiness, lines)
+
+
+def _column_bottoms(shape_idx: int, rotation: int) -> Tuple[int, ...]:
+    """回転後の形状の列ごとの最下段セルのdy"""
+    data = ROTATIONS[shape_idx][rotation]
+    bottoms = [-1] * data.width
+    for dx, dy in data.cells:
+        bottoms[dx] = max(bottoms[dx], dy)
+    return tuple(bottoms)
+
+
+# (形状番号, 回転) → 列ごとの最下段セルのdy
+COLUMN_BOTTOMS: Dict[Tuple[int, int], Tuple[int, ...]] = {
+    (shape_idx, rotation): _column_bottoms(shape_idx, rotation)
+    for shape_idx in ROTATIONS for rotation in range(4)
+}
+
+
+def fits(masks: Masks, shape_idx: int, rotation: int, x: int, y: int) -> bool:
+    """TetrisGame.fits_masks と同じ判定を任意の盤面で行う"""
+    data = ROTATIONS[shape_idx][rotation % 4]
+    if x < 0 or x + data.width > BOARD_WIDTH or y + data.height > BOARD_HEIGHT:
+        return False
+    for r, mask in enumerate(data.row_masks):
+        board_y = y + r
+        if board_y >= 0 and masks[board_y] & (mask << x):
+            return False
+    return True
+
+
+def rotate(masks: Masks, shape_idx: int, rotation: int, x: int,
+           y: int) -> Optional[Tuple[int, int, int]]:
+    """TetrisGame.rotate_piece と同じ回転（壁キックを含む）。回転できなければNone"""
+    rotation = (rotation + 1) % 4
+    if fits(masks, shape_idx, rotation, x, y):
+        return rotation, x, y
+    for dx, dy in WALL_KICKS:
+        if fits(masks, shape_idx, rotation, x + dx, y + dy):
+            return rotation, x + dx, y + dy
+    return None
+
+
+def column_tops(masks: Masks) -> List[int]:
+    """列ごとの最上段ブロックの行（空の列はBOARD_HEIGHT）"""
+    tops = [BOARD_HEIGHT] * BOARD_WIDTH
+    remaining = FULL_ROW_MASK
+    for r, mask in enumerate(masks):
+        new = mask & remaining
+        while new:
+            low = new & -new
+            tops[low.bit_length() - 1] = r
+            new ^= low
+        remaining &= ~mask
+        if not remaining:
+            break
+    return tops
+
+
+def drop(masks: Masks, tops: Sequence[int], shape_idx: int, rotation: int, x: int, y: int) -> int:
+    """(x, y)からハードドロップしたときの着地位置のy"""
+    # ピースが各列の最上段より上にあれば、着地位置は列の高さだけで決まる
+    land_y = BOARD_HEIGHT
+    for c, bottom in enumerate(COLUMN_BOTTOMS[shape_idx, rotation]):
+        top = tops[x + c]
+        if y + bottom >= top:
+            break
+        land_y = min(land_y, top - bottom - 1)
+    else:
+        return land_y
+    while fits(masks, shape_idx, rotation, x, y + 1):
+        y += 1
+    return y
+
+
+def place(masks: Masks, shape_idx: int, rotation: int, x: int, y: int) -> Tuple[Masks, int]:
+    """place_piece と同じ配置・ライン消去を行い、(新しい盤面, 消したライン数)を返す"""
+    board = list(masks)
+    if shape_idx == -1:
+        # 爆弾ピースは周囲を消去する
+        if y >= 0:
+            area = 0
+            for c in range(max(0, x - BOMB_RADIUS), min(BOARD_WIDTH, x + BOMB_RADIUS + 1)):
+                area |= 1 << c
+            for r in range(max(0, y - BOMB_RADIUS), min(BOARD_HEIGHT, y + BOMB_RADIUS + 1)):
+                board[r] &= ~area
+    else:
+        for r, mask in enumerate(ROTATIONS[shape_idx][rotation].row_masks):
+            if y + r >= 0:
+                board[y + r] |= mask << x
+    kept = [mask for mask in board if mask != FULL_ROW_MASK]
+    lines = BOARD_HEIGHT - len(kept)
+    return tuple([0] * lines + kept), lines
+
+
+@dataclass(frozen=True)
+class Placement:
+    """ピースの最終的な置き場所と、そこへ動かすための操作"""
+    rotation: int
+    x: int
+    y: int
+    actions: Tuple[ActionType, ...]
+    masks: Masks  # 配置・ライン消去後の盤面
+    lines: int
+
+
+def _landings(masks: Masks, shape_idx: int, rotation: int, x: int,
+              y: int) -> Iterator[Tuple[int, int, int, int, int]]:
+    """回転→左右移動→ハードドロップで到達できる着地位置を列挙
+
+    (回転回数, 回転後のx, 回転, x, 着地y) を返す。同じセルを占める着地位置は1つにまとめる。
+    """
+    seen = set()
+    tops = column_tops(masks)
+    state: Optional[Tuple[int, int, int]] = (rotation % 4, x, y)
+    for turns in range(4):
+        if state is None:
+            break
+        rot, start_x, start_y = state
+        row_masks = ROTATIONS[shape_idx][rot].row_masks
+        for direction in (0, -1, 1):
+            shift_x = start_x
+            while True:
+                if direction:
+                    if not fits(masks, shape_idx, rot, shift_x + direction, start_y):
+                        break
+                    shift_x += direction
+                land_y = drop(masks, tops, shape_idx, rot, shift_x, start_y)
+                # 回転ごとの形状は左上に揃えてあるので、形状・x・yで占めるセルが決まる
+                key = (row_masks, shift_x, land_y)
+                if key not in seen:
+                    seen.add(key)
+                    yield turns, start_x, rot, shift_x, land_y
+                if not direction:
+                    break
+        state = rotate(masks, shape_idx, rot, start_x, start_y)
+
+
+def _moves(masks: Masks, shape_idx: int, state: PieceState) -> Iterator[Tuple[ActionType, PieceState]]:
+    """1回の操作（左右移動・↓・回転）で移れる状態（TetrisGame.perform_action と同じ規則）"""
+    rot, x, y = state
+    for action, dx in ((ActionType.LEFT, -1), (ActionType.RIGHT, 1)):
+        if fits(masks, shape_idx, rot, x + dx, y):
+            yield action, (rot, x + dx, y)
+    # ↓は置ける限り最大SOFT_DROP_CELLSマス落ちる
+    down_y = y
+    while down_y - y < SOFT_DROP_CELLS and fits(masks, shape_idx, rot, x, down_y + 1):
+        down_y += 1
+    if down_y != y:
+        yield ActionType.DOWN, (rot, x, down_y)
+    rotated = rotate(masks, shape_idx, rot, x, y)
+    if rotated is not None:
+        yield ActionType.ROTATE, rotated
+
+
+def enumerate_placements(masks: Masks, shape_idx: int, rotation: int, x: int,
+                         y: int) -> List[Placement]:
+    """現在位置から到達できる最終配置を列挙（同じ盤面になるものは1つ）
+
+    左右移動・↓・回転（壁キックを含む）で移れる状態を幅優先で調べ、各状態からのハードドロップを
+    最終配置とする。↓で潜り込んでから横へ滑らせる配置や、張り出しの下での回転による配置も含み、
+    操作列はそれぞれの配置への最短のもの。重力とロック遅延は考慮しない。
+    上への壁キックを繰り返すと盤面の上へいくらでも上がれるので、開始位置（出現位置）より上の状態は調べない。
+    """
+    start: PieceState = (rotation % 4, x, y)
+    min_y = min(y, 0)
+    parents: Dict[PieceState, Optional[Tuple[PieceState, ActionType]]] = {start: None}
+    queue = deque([start])
+    tops = column_tops(masks)
+    landed = set()
+    placements: Dict[Masks, Placement] = {}
+    while queue:
+        state = queue.popleft()
+        rot, state_x, state_y = state
+        land_y = drop(masks, tops, shape_idx, rot, state_x, state_y)
+        # 回転ごとの形状は左上に揃えてあるので、形状・x・yで占めるセルが決まる
+        landing = (ROTATIONS[shape_idx][rot].row_masks, state_x, land_y)
+        if landing not in landed:
+            landed.add(landing)
+            result, lines = place(masks, shape_idx, rot, state_x, land_y)
+            if result not in placements:
+                # 幅優先なので最初に見つかった操作列が最短
+                actions = [ActionType.HARD_DROP]
+                node = state
+                while parents[node] is not None:
+                    node, action = parents[node]
+                    actions.append(action)
+                actions.reverse()
+                placements[result] = Placement(rot, state_x, land_y, tuple(actions), result, lines)
+        for action, moved in _moves(masks, shape_idx, state):
+            if moved[2] >= min_y and moved not in parents:
+                parents[moved] = (state, action)
+                queue.append(moved)
+    return list(placements.values())
+
+
+class TranspositionTable:
+    """評価済みの盤面の値を保持する上限付きのキャッシュ（古いものから削除）"""
+
+    def __init__(self, max_size: int = DEFAULT_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries: "OrderedDict[tuple, float]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: tuple) -> Optional[float]:
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: tuple, value: float):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+class PlacementBot:
+    """現在と次のピースの到達可能な配置をすべて調べ、評価関数で最良の配置を選ぶボット
+
+    1手目の評価が高い候補だけ次のピースまで先読みする。盤面の評価値は置換表に保持し、
+    同じ盤面（先読みで何度も現れる盤面を含む）を再評価しない。
+    """
+
+    def __init__(self, heuristic: Heuristic = default_heuristic,
+                 beam_width: int = DEFAULT_BEAM_WIDTH,
+                 cache: Optional[TranspositionTable] = None):
+        self.heuristic = heuristic
+        self.beam_width = beam_width
+        self.cache = cache if cache is not None else TranspositionTable()
+
+    def evaluate(self, masks: Masks, lines: int) -> float:
+        """盤面の評価値（置換表を使う）"""
+        key = (masks, lines)
+        value = self.cache.get(key)
+        if value is None:
+            value = self.heuristic(board_features(masks, lines))
+            self.cache.put(key, value)
+        return value
+
+    def _best_next(self, masks: Masks, shape_idx: int, lines: int) -> float:
+        """次のピースを出現位置から置いたときの最良の評価値（置けなければ-inf）"""
+        key = (masks, shape_idx, lines, "next")
+        value = self.cache.get(key)
+        if value is not None:
+            return value
+        spawn_x = BOARD_WIDTH // 2 - 1
+        best = float("-inf")
+        if fits(masks, shape_idx, 0, spawn_x, 0):
+            # 先読みは回転→左右移動→ハードドロップの着地位置だけで近似し、着地位置から直接盤面を作って評価する
+            for _, _, rot, x, y in _landings(masks, shape_idx, 0, spawn_x, 0):
+                result, cleared = place(masks, shape_idx, rot, x, y)
+                best = max(best, self.evaluate(result, lines + cleared))
+        self.cache.put(key, best)
+        return best
+
+    def choose(self, game: TetrisGame) -> Optional[Placement]:
+        """ゲームの現在のピースの最良の配置（置き場所がなければNone）"""
+        piece = game.current_piece
+        if piece is None or game.game_over:
+            return None
+        masks = tuple(game.row_masks)
+        placements = enumerate_placements(masks, piece.shape_idx, piece.rotation, piece.x, piece.y)
+        if not placements:
+            return None
+
+        scored = sorted(((self.evaluate(p.masks, p.lines), i) for i, p in enumerate(placements)),
+                        reverse=True)
+        if game.next_piece is None or self.beam_width <= 0:
+            return placements[scored[0][1]]
+
+        # 上位の候補だけ次のピースまで先読みする
+        best_value, best_index = float("-inf"), scored[0][1]
+        for _, i in scored[:self.beam_width]:
+            placement = placements[i]
+            value = self._best_next(placement.masks, game.next_piece.shape_idx, placement.lines)
+            if value > best_value:
+                best_value, best_index = value, i
+        return placements[best_index]
+
+
+class BotPlayer:
+    """ボットの選んだ配置へ向けて、呼ばれるたびに操作を返すプレイヤー
+
+    Simulation.run_until_game_over() のポリシーとしてそのまま使える。
+    actions_per_call で1回に返す操作数を決める（1なら人間に近い速さで操作する）。
+    """
+
+    def __init__(self, bot: Optional[PlacementBot] = None, actions_per_call: int = 1):
+        self.bot = bot if bot is not None else PlacementBot()
+        self.actions_per_call = actions_per_call
+        self._piece: Optional[object] = None
+        self._plan: List[ActionType] = []
+
+    def __call__(self, game: TetrisGame) -> Optional[List[ActionType]]:
+        if game.game_over or game.paused or game.pending_line_clear:
+            return None
+        # 新しいピースが出たら配置を選び直す
+        if game.current_piece is not self._piece:
+            self._piece = game.current_piece
+            placement = self.bot.choose(game)
+            self._plan = list(placement.actions) if placement is not None else []
+        if not self._plan:
+            return None
+        actions = self._plan[:self.actions_per_call]
+        del self._plan[:self.actions_per_call]
+        return actions
@@ -1,6 +1,8 @@
 import random
 import math
-from typing import List, Tuple, Optional, Dict, Any
+import itertools
+from collections import deque
+from typing import Callable, Deque, List, Tuple, Optional, Dict, Any, Sequence
 from dataclasses import dataclass
 from enum import Enum
 
@@ -8,6 +10,8 @@ from enum import Enum
 BOARD_WIDTH = 10
 BOARD_HEIGHT = 20
 BOMB_LINES_REQUIRED = 10  # 10ライン削除で爆弾獲得
+PIECE_BLOCK_SIZE = 70  # ピース列を事前生成する単位（7の倍数）
+LINE_CLEAR_STEP = 16  # ライン消去遅延中の更新間隔（約60FPS、最初の更新はこの時間だけ経過したとみなす）
 
 # 色の定義（RGB値）
 BLACK = (0, 0, 0)
@@ -35,6 +39,27 @@ TETROMINOS = [
 
 TETROMINO_COLORS = [CYAN, YELLOW, PURPLE, ORANGE, BLUE, GREEN, RED]
 
+# 行の占有ビットマスク（ビットxが列xに対応）
+FULL_ROW_MASK = (1 << BOARD_WIDTH) - 1
+
+# 回転した位置に置けないときに試す位置のずれ(dx, dy)（左右1マス、左右2マス、上1マスの順）
+WALL_KICKS = ((-1, 0), (1, 0), (-2, 0), (2, 0), (0, -1))
+
+# ↓ボタン1回で落とす最大のマス数
+SOFT_DROP_CELLS = 3
+
+# 速度倍率の範囲と、速度変更1回の変化量
+MIN_SPEED_MULTIPLIER = 0.25
+MAX_SPEED_MULTIPLIER = 3.0
+SPEED_MULTIPLIER_STEP = 0.25
+
+# 対戦で一度に消したライン数 → 相手に送るおじゃまライン数
+GARBAGE_FOR_LINES = (0, 0, 1, 2, 4)
+GARBAGE_COLOR = GRAY
+
+# ゲーム状態の版番号（プロセス内で一意。状態を変更するたびに新しい番号を振る）
+_state_versions = itertools.count(1)
+
 class ActionType(Enum):
     LEFT = "left"
     RIGHT = "right"
@@ -46,6 +71,7 @@ class ActionType(Enum):
     PAUSE = "pause"
     SPEED_UP = "speed_up"
     SPEED_DOWN = "speed_down"
+    GARBAGE = "garbage"  # 対戦相手からのおじゃまライン（サーバーのみが適用する）
 
 @dataclass
 class Bomb:
@@ -54,8 +80,9 @@ class Bomb:
     radius: int = 3
     active: bool = True
 
-    def explode(self, board: List[List[int]]) -> List[Tuple[int, int]]:
-        """爆弾が爆発して周辺のブロックを消去"""
+    def explode(self, board: List[List[int]],
+                row_masks: Optional[List[int]] = None) -> List[Tuple[int, int]]:
+        """爆弾が爆発して周辺のブロックを消去（row_masksを渡すと占有ビットも更新）"""
         destroyed_blocks = []
         
         # 爆発範囲（3x3の範囲）
@@ -69,6 +96,8 @@ class Bomb:
                     0 <= new_y < BOARD_HEIGHT and
                     board[new_y][new_x] != 0):
                     board[new_y][new_x] = 0
+                    if row_masks is not None:
+                        row_masks[new_y] &= ~(1 << new_x)
                     destroyed_blocks.append((new_x, new_y))
         
         self.active = False
@@ -97,7 +126,8 @@ class Tetromino:
     def is_bomb(self) -> bool:
         return self.shape_idx == -1
 
-    def rotate(self, shape: List[List[int]]) -> List[List[int]]:
+    @staticmethod
+    def rotate(shape: List[List[int]]) -> List[List[int]]:
         """90度回転"""
         rows = len(shape)
         cols = len(shape[0])
@@ -109,15 +139,138 @@ class Tetromino:
         
         return rotated
 
-    def get_rotated_shape(self) -> List[List[int]]:
-        shape = self.shape
-        for _ in range(self.rotation):
-            shape = self.rotate(shape)
-        return shape
+    def get_rotation(self) -> "PieceRotation":
+        """現在の回転の事前計算済みデータを返す"""
+        return ROTATIONS[self.shape_idx][self.rotation % 4]
+
+    def get_rotated_shape(self) -> Tuple[Tuple[int, ...], ...]:
+        """回転後の形状（事前計算済みの変更不可なタプル）"""
+        return ROTATIONS[self.shape_idx][self.rotation % 4].shape
+
+    def get_row_masks(self) -> Tuple[Tuple[int, ...], int]:
+        """回転後の形状の行ごとの占有ビットマスクと幅を返す（事前計算済み）"""
+        rotation = ROTATIONS[self.shape_idx][self.rotation % 4]
+        return rotation.row_masks, rotation.width
+
+
+@dataclass(frozen=True)
+class PieceRotation:
+    """1つの形状の1つの回転状態（import時に計算して共有）"""
+    shape: Tuple[Tuple[int, ...], ...]
+    cells: Tuple[Tuple[int, int], ...]  # 占有セルの(dx, dy)
+    width: int
+    height: int
+    row_masks: Tuple[int, ...]  # 行ごとの占有ビットマスク（ビットcが列cに対応）
+    column_bottoms: Tuple[int, ...]  # 列ごとの最も下の占有セルの行（dy）
+
+
+def build_rotations(shape: List[List[int]]) -> Tuple[PieceRotation, ...]:
+    """形状の4回転分のデータを計算"""
+    rotations = []
+    for _ in range(4):
+        rotations.append(PieceRotation(
+            shape=tuple(tuple(row) for row in shape),
+            cells=tuple((c, r) for r, row in enumerate(shape) for c, cell in enumerate(row) if cell),
+            width=len(shape[0]),
+            height=len(shape),
+            row_masks=tuple(sum(1 << c for c, cell in enumerate(row) if cell) for row in shape),
+            column_bottoms=tuple(max(r for r, row in enumerate(shape) if row[c])
+                                 for c in range(len(shape[0]))),
+        ))
+        shape = Tetromino.rotate(shape)
+    return tuple(rotations)
+
+
+# 形状番号（爆弾ピースは-1）→ 4回転分のデータ
+ROTATIONS: Dict[int, Tuple[PieceRotation, ...]] = {
+    shape_idx: build_rotations(Tetromino(0, 0, shape_idx).shape)
+    for shape_idx in range(-1, len(TETROMINOS))
+}
+
+# シード未指定のゲームに割り当てるシードの生成元（グローバルなrandomの状態に依存しない）
+_seed_source = random.SystemRandom()
+
+
+def parse_speed_multiplier(value: Any) -> float:
+    """クライアントから指定された初期速度倍率（数値でなければ1.0、範囲外は範囲内に丸める）"""
+    try:
+        multiplier = float(value)
+    except (TypeError, ValueError):
+        return 1.0
+    if not math.isfinite(multiplier):
+        return 1.0
+    return min(MAX_SPEED_MULTIPLIER, max(MIN_SPEED_MULTIPLIER, multiplier))
+
+
+def new_seed() -> int:
+    """ゲーム用の新しいシード（32ビット）"""
+    return _seed_source.getrandbits(32)
+
+
+class UniformRandomizer:
+    """各ピースを独立に等確率で選ぶピース列（従来の挙動）"""
+
+    name = "uniform"
+
+    def __init__(self, seed: int):
+        self._rng = random.Random(seed)
+        self._queue: Deque[int] = deque()
+        self.drawn = 0  # 取り出したピース数（スナップショットからの復元に使う）
+
+    def _refill(self):
+        """ピース列を1ブロック分まとめて生成"""
+        self._queue.extend(self._rng.choices(range(len(TETROMINOS)), k=PIECE_BLOCK_SIZE))
+
+    def next(self) -> int:
+        """次のピースの形状番号を取り出す"""
+        if not self._queue:
+            self._refill()
+        self.drawn += 1
+        return self._queue.popleft()
+
+    def skip(self, count: int):
+        """count個分ピース列を進める（同じシードから途中の状態を復元する）"""
+        for _ in range(count):
+            self.next()
+
+    def peek(self, count: int) -> List[int]:
+        """取り出さずに先のcount個の形状番号を返す"""
+        while len(self._queue) < count:
+            self._refill()
+        return [self._queue[i] for i in range(count)]
+
+
+class SevenBagRandomizer(UniformRandomizer):
+    """7種類を1つずつ入れた袋をシャッフルして順に出すピース列"""
+
+    name = "bag"
+
+    def _refill(self):
+        bag = list(range(len(TETROMINOS)))
+        for _ in range(PIECE_BLOCK_SIZE // len(TETROMINOS)):
+            self._rng.shuffle(bag)
+            self._queue.extend(bag)
+
+
+RANDOMIZERS = {
+    UniformRandomizer.name: UniformRandomizer,
+    SevenBagRandomizer.name: SevenBagRandomizer,
+}
+
 
 class TetrisGame:
-    def __init__(self):
+    def __init__(self, seed: Optional[int] = None, randomizer: str = UniformRandomizer.name):
+        if randomizer not in RANDOMIZERS:
+            raise ValueError(f"不明なピース列の種類です: {randomizer}")
+        # ゲームごとのピース列（同じシードと操作なら同じゲームを再現できる）
+        self.seed = seed if seed is not None else new_seed()
+        self.randomizer_name = randomizer
+        self.randomizer = RANDOMIZERS[randomizer](self.seed)
         self.board = [[0 for _ in range(BOARD_WIDTH)] for _ in range(BOARD_HEIGHT)]
+        self.row_masks = [0] * BOARD_HEIGHT  # 行ごとの占有ビットマスク（boardと常に同期）
+        # 列ごとの高さと最も上の占有行（空ならBOARD_HEIGHT）。ボードを変更するたびに更新する
+        self.column_heights = [0] * BOARD_WIDTH
+        self.stack_top = BOARD_HEIGHT
         self.bombs: List[Bomb] = []
         self.current_piece: Optional[Tetromino] = None
         self.next_piece: Optional[Tetromino] = None
@@ -142,16 +295,41 @@ class TetrisGame:
         # ライン消去エフェクトの遅延
         self.line_clear_delay = 250  # 0.25秒
         self.line_clear_time = 0
+        self.line_clear_started: Optional[int] = None  # ライン消去遅延の起点時刻
         self.pending_line_clear = False
         self.pending_lines = 0
         
+        # 対戦用のおじゃまライン（受け取った(ライン数, 穴の列)と、ライン消去で送る分の累計）
+        self.pending_garbage: List[Tuple[int, int]] = []
+        self.outgoing_garbage = 0
+        
+        # 状態の版番号と、版ごとに作った値（状態の辞書・エンコード済みフレームなど）のキャッシュ
+        self.state_version = next(_state_versions)
+        self.state_cache: Dict[str, Tuple[int, Any]] = {}
+        
         self.spawn_new_piece()
 
+    def touch(self):
+        """送信する状態が変わった（新しい版番号を振り、前の版のキャッシュを無効にする）"""
+        self.state_version = next(_state_versions)
+
+    def cached(self, key: str, build: Callable[[], Any]) -> Any:
+        """現在の版の状態から作る値をkeyごとに1つ保持して再利用（版が変わると作り直す）"""
+        entry = self.state_cache.get(key)
+        if entry is not None and entry[0] == self.state_version:
+            return entry[1]
+        value = build()
+        self.state_cache[key] = (self.state_version, value)
+        return value
+
     def spawn_new_piece(self):
         """新しいテトリミノを生成"""
+        # 受け取ったおじゃまラインは次のピースが出る前に下からせり上げる
+        if self.pending_garbage:
+            self.insert_garbage()
         # 次のピースがなければ生成
         if self.next_piece is None:
-            shape_idx = random.randint(0, len(TETROMINOS) - 1)
+            shape_idx = self.randomizer.next()
             self.next_piece = Tetromino(BOARD_WIDTH // 2 - 1, 0, shape_idx)
         
         # 現在のピースを次のピースに設定
@@ -160,25 +338,112 @@ class TetrisGame:
         self.current_piece.y = 0
         
         # 新しい次のピースを生成
-        shape_idx = random.randint(0, len(TETROMINOS) - 1)
+        shape_idx = self.randomizer.next()
         self.next_piece = Tetromino(BOARD_WIDTH // 2 - 1, 0, shape_idx)
         
-        # ゲームオーバーチェック
-        if not self.is_valid_move(self.current_piece.x, self.current_piece.y, self.current_piece.get_rotated_shape()):
+        # ゲームオーバーチェック（積み上がりがピースの高さに届いていなければ必ず置ける）
+        piece = self.current_piece
+        if self.stack_top < piece.get_rotation().height and not self.piece_fits(piece, piece.x, piece.y):
             self.game_over = True
+        self.touch()
 
-    def is_valid_move(self, x: int, y: int, shape: List[List[int]]) -> bool:
+    @property
+    def status(self) -> str:
+        """ゲームの状態（playing / paused / game_over）"""
+        if self.game_over:
+            return "game_over"
+        return "paused" if self.paused else "playing"
+
+    def insert_garbage(self):
+        """受け取ったおじゃまラインを盤面の下に追加（上にはみ出したブロックがあればゲームオーバー）"""
+        for lines, hole in self.pending_garbage:
+            lines = min(lines, BOARD_HEIGHT)
+            if any(self.row_masks[:lines]):
+                self.game_over = True
+            garbage_mask = FULL_ROW_MASK & ~(1 << hole)
+            self.board[:] = self.board[lines:] + [
+                [0 if x == hole else GARBAGE_COLOR for x in range(BOARD_WIDTH)] for _ in range(lines)]
+            self.row_masks[:] = self.row_masks[lines:] + [garbage_mask] * lines
+            # 配置済みの爆弾も一緒にせり上がる
+            for bomb in self.bombs:
+                bomb.y -= lines
+            self.bombs = [bomb for bomb in self.bombs if bomb.y >= 0]
+        self.pending_garbage = []
+        self.rebuild_stack()
+
+    def rebuild_stack(self):
+        """占有ビットから列ごとの高さと最も上の占有行を求め直す（ライン消去・爆発・復元の後に呼ぶ）"""
+        heights = [0] * BOARD_WIDTH
+        top = BOARD_HEIGHT
+        seen = 0
+        for r, mask in enumerate(self.row_masks):
+            new = mask & ~seen
+            if not new:
+                continue
+            if top == BOARD_HEIGHT:
+                top = r
+            seen |= new
+            while new:
+                low = new & -new
+                heights[low.bit_length() - 1] = BOARD_HEIGHT - r
+                new ^= low
+            if seen == FULL_ROW_MASK:
+                break
+        self.column_heights = heights
+        self.stack_top = top
+
+    def drop_distance(self) -> int:
+        """現在のピースを真下に落とせる行数"""
+        piece = self.current_piece
+        rotation = piece.get_rotation()
+        heights = self.column_heights
+        distance = BOARD_HEIGHT
+        for c, bottom in enumerate(rotation.column_bottoms):
+            # 列の最も上のブロックより上にあれば、そのすぐ上まで落とせる
+            free = BOARD_HEIGHT - heights[piece.x + c] - 1 - (piece.y + bottom)
+            if free < 0:
+                # 張り出しの下に潜り込んでいる場合は占有ビットで1行ずつ調べる
+                distance = 0
+                while self.fits_masks(piece.x, piece.y + distance + 1, rotation.row_masks, rotation.width):
+                    distance += 1
+                return distance
+            distance = min(distance, free)
+        return distance
+
+    def peek_pieces(self, count: int) -> List[int]:
+        """次のピースより後に出るcount個の形状番号（ピース列は消費しない）"""
+        return self.randomizer.peek(count)
+
+    def fits_masks(self, x: int, y: int, masks: Tuple[int, ...], width: int) -> bool:
+        """行ビットマスクで表した形状が(x, y)に置けるかチェック"""
+        # 形状は外接矩形いっぱいなので、矩形がボードからはみ出せば無効（上方向のみ許容）
+        if x < 0 or x + width > BOARD_WIDTH or y + len(masks) > BOARD_HEIGHT:
+            return False
+        row_masks = self.row_masks
+        for r, mask in enumerate(masks):
+            board_y = y + r
+            if board_y >= 0 and row_masks[board_y] & (mask << x):
+                return False
+        return True
+
+    def piece_fits(self, piece: Tetromino, x: int, y: int) -> bool:
+        """ピースを現在の回転のまま(x, y)に置けるかチェック"""
+        masks, width = piece.get_row_masks()
+        return self.fits_masks(x, y, masks, width)
+
+    def is_valid_move(self, x: int, y: int, shape: Sequence[Sequence[int]]) -> bool:
         """移動が有効かチェック"""
         for r, row in enumerate(shape):
-            for c, cell in enumerate(row):
-                if cell:
-                    new_x = x + c
-                    new_y = y + r
-                    
-                    if (new_x < 0 or new_x >= BOARD_WIDTH or 
-                        new_y >= BOARD_HEIGHT or 
-                        (new_y >= 0 and self.board[new_y][new_x])):
-                        return False
+            mask = sum(1 << c for c, cell in enumerate(row) if cell)
+            if not mask:
+                continue
+            board_y = y + r
+            left = x + (mask & -mask).bit_length() - 1
+            right = x + mask.bit_length()
+            if left < 0 or right > BOARD_WIDTH or board_y >= BOARD_HEIGHT:
+                return False
+            if board_y >= 0 and self.row_masks[board_y] & (mask << x if x >= 0 else mask >> -x):
+                return False
         return True
 
     def place_piece(self):
@@ -186,28 +451,35 @@ class TetrisGame:
         if not self.current_piece:
             return
         
+        piece = self.current_piece
+        rotation = piece.get_rotation()
+        
         # 爆弾ピースの場合、配置と同時に爆発
-        if self.current_piece.is_bomb:
-            shape = self.current_piece.get_rotated_shape()
-            for r, row in enumerate(shape):
-                for c, cell in enumerate(row):
-                    if cell:
-                        board_y = self.current_piece.y + r
-                        board_x = self.current_piece.x + c
-                        if board_y >= 0:
-                            # 爆弾を配置して即座に爆発
-                            bomb = Bomb(board_x, board_y)
-                            bomb.explode(self.board)
+        if piece.is_bomb:
+            for c, r in rotation.cells:
+                board_y = piece.y + r
+                board_x = piece.x + c
+                if board_y >= 0:
+                    # 爆弾を配置して即座に爆発
+                    bomb = Bomb(board_x, board_y)
+                    if bomb.explode(self.board, self.row_masks):
+                        self.rebuild_stack()
         else:
-            # 通常のピース
-            shape = self.current_piece.get_rotated_shape()
-            for r, row in enumerate(shape):
-                for c, cell in enumerate(row):
-                    if cell:
-                        board_y = self.current_piece.y + r
-                        board_x = self.current_piece.x + c
-                        if board_y >= 0:
-                            self.board[board_y][board_x] = self.current_piece.color
+            # 通常のピース（色プレーンと占有ビットの両方に書き込み、列の高さと最上段を更新）
+            color = piece.color
+            heights = self.column_heights
+            for c, r in rotation.cells:
+                board_y = piece.y + r
+                if board_y >= 0:
+                    self.board[board_y][piece.x + c] = color
+                    if BOARD_HEIGHT - board_y > heights[piece.x + c]:
+                        heights[piece.x + c] = BOARD_HEIGHT - board_y
+                    if board_y < self.stack_top:
+                        self.stack_top = board_y
+            for r, mask in enumerate(rotation.row_masks):
+                board_y = piece.y + r
+                if board_y >= 0:
+                    self.row_masks[board_y] |= mask << piece.x
         
         # ライン消去を遅延実行
         lines_cleared = self.clear_lines()
@@ -215,12 +487,14 @@ class TetrisGame:
             self.pending_line_clear = True
             self.pending_lines = lines_cleared
             self.line_clear_time = 0
+            self.line_clear_started = None
         else:
             self.spawn_new_piece()
         
         # ライン消去エフェクト用のフラグ
         if lines_cleared > 0:
             self.lines_cleared_this_frame = lines_cleared
+        self.touch()
 
     def place_bomb(self, x: int, y: int) -> bool:
         """指定位置に爆弾を配置"""
@@ -228,6 +502,7 @@ class TetrisGame:
             bomb = Bomb(x, y)
             self.bombs.append(bomb)
             self.bombs_available -= 1
+            self.touch()
             return True
         return False
     
@@ -237,33 +512,42 @@ class TetrisGame:
             # 次のピースを爆弾ピースに変更
             self.next_piece = Tetromino(BOARD_WIDTH // 2 - 1, 0, -1)  # -1は爆弾ピースを示す
             self.bombs_available -= 1
+            self.touch()
             return True
         return False
 
     def explode_bombs(self):
         """爆弾を爆発させる"""
         exploded_bombs = []
+        detonated = False
         for bomb in self.bombs:
             if bomb.active:
-                destroyed_blocks = bomb.explode(self.board)
+                detonated = True
+                destroyed_blocks = bomb.explode(self.board, self.row_masks)
                 if destroyed_blocks:
                     exploded_bombs.append(bomb)
         
-        # 爆発した爆弾をリストから削除
-        self.bombs = [bomb for bomb in self.bombs if bomb not in exploded_bombs]
+        # 爆発した爆弾をリストから削除（消えたブロックに合わせて列の高さを求め直す）
+        if exploded_bombs:
+            self.bombs = [bomb for bomb in self.bombs if bomb not in exploded_bombs]
+            self.rebuild_stack()
+        # 何も消さなかった爆弾も非アクティブになるので、送る状態が変わる
+        if detonated:
+            self.touch()
 
     def clear_lines(self):
         """ライン消去処理"""
-        lines_to_clear = []
-        for r in range(BOARD_HEIGHT):
-            if all(self.board[r]):
-                lines_to_clear.append(r)
-        
-        for line in lines_to_clear:
-            del self.board[line]
-            self.board.insert(0, [0 for _ in range(BOARD_WIDTH)])
+        lines_to_clear = [r for r, mask in enumerate(self.row_masks) if mask == FULL_ROW_MASK]
         
         if lines_to_clear:
+            # 揃った行を除いて詰め、上に空行を足す（色プレーン・占有ビットとも同じ並び）
+            cleared = len(lines_to_clear)
+            kept = [r for r, mask in enumerate(self.row_masks) if mask != FULL_ROW_MASK]
+            self.board[:] = ([[0 for _ in range(BOARD_WIDTH)] for _ in range(cleared)] +
+                             [self.board[r] for r in kept])
+            self.row_masks[:] = [0] * cleared + [self.row_masks[r] for r in kept]
+            self.rebuild_stack()
+            
             # ライン消去前の爆弾獲得判定
             old_lines = self.lines_cleared
             self.lines_cleared += len(lines_to_clear)
@@ -275,6 +559,7 @@ class TetrisGame:
                 self.bombs_available += (new_bomb_threshold - old_bomb_threshold)
             
             self.score += len(lines_to_clear) * 100 * self.level
+            self.outgoing_garbage += GARBAGE_FOR_LINES[min(cleared, len(GARBAGE_FOR_LINES) - 1)]
             self.level = self.lines_cleared // 10 + 1
             self.base_fall_speed = max(50, 375 - (self.level - 1) * 37)
             
@@ -290,9 +575,10 @@ class TetrisGame:
         new_x = self.current_piece.x + dx
         new_y = self.current_piece.y + dy
         
-        if self.is_valid_move(new_x, new_y, self.current_piece.get_rotated_shape()):
+        if self.piece_fits(self.current_piece, new_x, new_y):
             self.current_piece.x = new_x
             self.current_piece.y = new_y
+            self.touch()
             return True
         return False
 
@@ -308,21 +594,20 @@ class TetrisGame:
         self.current_piece.rotation = (self.current_piece.rotation + 1) % 4
         
         # 壁キック（回転後の位置調整）
-        if not self.is_valid_move(self.current_piece.x, self.current_piece.y, self.current_piece.get_rotated_shape()):
-            # 左右に移動して回転を試行
-            for dx in [-1, 1, -2, 2]:
-                if self.is_valid_move(self.current_piece.x + dx, self.current_piece.y, self.current_piece.get_rotated_shape()):
-                    self.current_piece.x += dx
+        piece = self.current_piece
+        if not self.piece_fits(piece, piece.x, piece.y):
+            # 左右、上の順に移動して回転を試行
+            for dx, dy in WALL_KICKS:
+                if self.piece_fits(piece, piece.x + dx, piece.y + dy):
+                    piece.x += dx
+                    piece.y += dy
+                    self.touch()
                     return True
             
-            # 上に移動して回転を試行
-            if self.is_valid_move(self.current_piece.x, self.current_piece.y - 1, self.current_piece.get_rotated_shape()):
-                self.current_piece.y -= 1
-                return True
-            
             # 回転を元に戻す
             self.current_piece.rotation = original_rotation
             return False
+        self.touch()
         return True
 
     def hard_drop(self):
@@ -330,18 +615,15 @@ class TetrisGame:
         if not self.current_piece:
             return
             
-        while self.move_piece(0, 1):
-            pass
+        # ライン消去の遅延中は移動できない（move_pieceと同じ）
+        if not self.pending_line_clear:
+            self.current_piece.y += self.drop_distance()
         self.place_piece()
 
     def check_stack_height(self):
         """積み上がり具合をチェックして速度を調整"""
-        # 最上段から何行目までブロックがあるかをチェック
-        top_empty_rows = 0
-        for r in range(BOARD_HEIGHT):
-            if any(self.board[r]):
-                break
-            top_empty_rows += 1
+        # 最上段から何行目までブロックがないか（ボードの変更時に更新している最上段の行）
+        top_empty_rows = self.stack_top
         
         # 積み上がり具合（空行が少ないほど積み上がっている）
         stack_ratio = 1.0 - (top_empty_rows / BOARD_HEIGHT)
@@ -360,9 +642,10 @@ class TetrisGame:
     def change_speed(self, direction: str):
         """速度を変更"""
         if direction == "up":
-            self.speed_multiplier = min(3.0, self.speed_multiplier + 0.25)
+            self.speed_multiplier = min(MAX_SPEED_MULTIPLIER, self.speed_multiplier + SPEED_MULTIPLIER_STEP)
         elif direction == "down":
-            self.speed_multiplier = max(0.25, self.speed_multiplier - 0.25)
+            self.speed_multiplier = max(MIN_SPEED_MULTIPLIER, self.speed_multiplier - SPEED_MULTIPLIER_STEP)
+        self.touch()
         
         # 現在の積み上がり状況に応じて速度を再計算
         self.check_stack_height()
@@ -372,9 +655,11 @@ class TetrisGame:
         if self.game_over or self.paused:
             return
 
-        # ライン消去の遅延処理
+        # ライン消去の遅延処理（渡された時刻で経過時間を測るので仮想時計でも同じ結果になる）
         if self.pending_line_clear:
-            self.line_clear_time += 16  # 約60FPS
+            if self.line_clear_started is None:
+                self.line_clear_started = current_time - LINE_CLEAR_STEP
+            self.line_clear_time = current_time - self.line_clear_started
             if self.line_clear_time >= self.line_clear_delay:
                 self.pending_line_clear = False
                 self.lines_cleared_this_frame = self.pending_lines
@@ -409,8 +694,25 @@ class TetrisGame:
         self.explode_bombs()
         
         # ライン消去エフェクトフラグをリセット（遅延処理中はリセットしない）
-        if not self.pending_line_clear:
+        if not self.pending_line_clear and self.lines_cleared_this_frame:
             self.lines_cleared_this_frame = 0
+            self.touch()
+
+    def next_update_time(self, current_time: int) -> Optional[int]:
+        """次にupdate()が必要になる時刻（ミリ秒）を返す（一時停止・ゲームオーバー中はNone）"""
+        if self.game_over or self.paused:
+            return None
+
+        # ライン消去の遅延中は一定間隔で進める
+        if self.pending_line_clear:
+            return current_time + LINE_CLEAR_STEP
+
+        # 未爆発の爆弾は次の更新で処理する
+        if any(bomb.active for bomb in self.bombs):
+            return current_time
+
+        # 自動落下（接地中のロック判定も落下タイミングで行われる）
+        return self.fall_time + self.fall_speed + 1
 
     def perform_action(self, action: ActionType, **kwargs) -> bool:
         """アクションを実行"""
@@ -424,7 +726,7 @@ class TetrisGame:
         elif action == ActionType.DOWN:
             # ↓ボタンで高速落下（複数マス落下）
             moved = False
-            for _ in range(3):  # 最大3マス落下
+            for _ in range(SOFT_DROP_CELLS):
                 if self.move_piece(0, 1):
                     moved = True
                 else:
@@ -446,6 +748,7 @@ class TetrisGame:
             return self.spawn_bomb_piece()
         elif action == ActionType.PAUSE:
             self.paused = not self.paused
+            self.touch()
             return True
         elif action == ActionType.SPEED_UP:
             self.change_speed("up")
@@ -453,12 +756,24 @@ class TetrisGame:
         elif action == ActionType.SPEED_DOWN:
             self.change_speed("down")
             return True
+        elif action == ActionType.GARBAGE:
+            lines = kwargs.get('lines', 0)
+            hole = kwargs.get('hole', 0)
+            if lines > 0 and 0 <= hole < BOARD_WIDTH:
+                self.pending_garbage.append((lines, hole))
+                self.touch()
+                return True
+            return False
         
         return False
 
     def reset_game(self):
-        """ゲームをリセット"""
+        """ゲームをリセット（同じシードのピース列を最初からやり直す）"""
+        self.randomizer = RANDOMIZERS[self.randomizer_name](self.seed)
         self.board = [[0 for _ in range(BOARD_WIDTH)] for _ in range(BOARD_HEIGHT)]
+        self.row_masks = [0] * BOARD_HEIGHT
+        self.column_heights = [0] * BOARD_WIDTH
+        self.stack_top = BOARD_HEIGHT
         self.bombs = []
         self.current_piece = None
         self.next_piece = None
@@ -480,13 +795,19 @@ class TetrisGame:
         self.is_locked = False
         self.line_clear_delay = 250
         self.line_clear_time = 0
+        self.line_clear_started = None
         self.pending_line_clear = False
         self.pending_lines = 0
+        self.pending_garbage = []
+        self.outgoing_garbage = 0
         
         self.spawn_new_piece()
 
     def get_game_state(self) -> Dict[str, Any]:
-        """ゲーム状態を取得"""
+        """ゲーム状態を取得（同じ版の間は同じ辞書を返すので、呼び出し側で変更しないこと）"""
+        return self.cached("state", self._build_game_state)
+
+    def _build_game_state(self) -> Dict[str, Any]:
         return {
             "board": self.board,
             "current_piece": {
@@ -494,7 +815,10 @@ class TetrisGame:
                 "y": self.current_piece.y,
                 "shape": self.current_piece.get_rotated_shape(),
                 "color": self.current_piece.color,
-                "is_bomb": self.current_piece.is_bomb
+                "is_bomb": self.current_piece.is_bomb,
+                # クライアント側の予測で回転表を引くための形状番号と回転
+                "shape_idx": self.current_piece.shape_idx,
+                "rotation": self.current_piece.rotation % 4
             } if self.current_piece else None,
             "next_piece": {
                 "shape": self.next_piece.shape,
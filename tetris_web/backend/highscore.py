@@ -0,0 +1,155 @@
+import asyncio
+import threading
+import time
+from typing import Any, Optional, Tuple
+
+from google.cloud import firestore
+
+from metrics import observe_firestore
+
+# ハイスコアのキャッシュ有効期間（秒）
+DEFAULT_TTL_SEC = 30.0
+# 連続した送信をまとめて1回の書き込みにする待ち時間（秒）
+DEFAULT_COALESCE_SEC = 0.05
+
+
+class FirestoreHighScoreBackend:
+    """Firestoreの1ドキュメントにハイスコアを保存するバックエンド（同期I/O）"""
+
+    def __init__(self, db: Any, collection: str, document: str):
+        self.db = db
+        self.collection = collection
+        self.document = document
+
+    def _doc_ref(self):
+        return self.db.collection(self.collection).document(self.document)
+
+    @observe_firestore("high_score_read")
+    def read(self) -> int:
+        """Firestoreからハイスコアを読み込み"""
+        doc = self._doc_ref().get()
+        if doc.exists:
+            high_score = doc.to_dict().get('score', 0)
+            print(f"Firestoreからハイスコアを読み込み: {high_score}")
+            return high_score
+        print("ハイスコアドキュメントが存在しません。0を返します。")
+        return 0
+
+    @observe_firestore("high_score_write")
+    def write_if_higher(self, score: int) -> Tuple[int, int]:
+        """既存より高い場合のみトランザクションで保存し、(保存後のハイスコア, 保存前のハイスコア)を返す"""
+        doc_ref = self._doc_ref()
+
+        @firestore.transactional
+        def update(transaction):
+            snapshot = doc_ref.get(transaction=transaction)
+            current = snapshot.to_dict().get('score', 0) if snapshot.exists else 0
+            if score > current:
+                transaction.set(doc_ref, {
+                    'score': score,
+                    'updated_at': firestore.SERVER_TIMESTAMP
+                })
+                return score, current
+            return current, current
+
+        high_score, previous = update(self.db.transaction())
+        if high_score > previous:
+            print(f"新しいハイスコアをFirestoreに保存: {high_score}")
+        else:
+            print(f"現在のスコア {score} は既存のハイスコア {previous} を上回りませんでした")
+        return high_score, previous
+
+
+class InMemoryHighScoreBackend:
+    """プロセス内にハイスコアを保持するバックエンド（テスト・Firestoreなしのローカル実行用）"""
+
+    def __init__(self, score: int = 0):
+        self._score = score
+        self._lock = threading.Lock()
+
+    def read(self) -> int:
+        with self._lock:
+            return self._score
+
+    def write_if_higher(self, score: int) -> Tuple[int, int]:
+        with self._lock:
+            previous = self._score
+            if score > previous:
+                self._score = score
+            return self._score, previous
+
+
+class HighScoreService:
+    """バックエンドの前段でハイスコアをキャッシュし、I/Oをイベントループ外で行うサービス
+
+    読み込みはTTL付きでキャッシュし、同時の読み込みは1回にまとめる。
+    キャッシュ値以下のスコアはI/Oなしで判定し、それを超えるスコアは
+    短い待ち時間の間に届いたものをまとめて最大値だけを条件付きで書き込む。
+    """
+
+    def __init__(self, backend: Any, ttl_sec: float = DEFAULT_TTL_SEC,
+                 coalesce_sec: float = DEFAULT_COALESCE_SEC):
+        self.backend = backend
+        self.ttl_sec = ttl_sec
+        self.coalesce_sec = coalesce_sec
+
+        self._value: Optional[int] = None
+        self._fetched_at = 0.0
+        self._refresh: Optional[asyncio.Future] = None
+        self._pending_score: Optional[int] = None
+        self._flush: Optional[asyncio.Future] = None
+
+    def _store(self, value: int):
+        self._value = value
+        self._fetched_at = time.monotonic()
+
+    def _is_fresh(self) -> bool:
+        return self._value is not None and time.monotonic() - self._fetched_at < self.ttl_sec
+
+    async def get(self) -> int:
+        """現在のハイスコア（キャッシュが有効ならI/Oなし）"""
+        if self._is_fresh():
+            return self._value
+        if self._refresh is None:
+            self._refresh = asyncio.ensure_future(self._load())
+        return await asyncio.shield(self._refresh)
+
+    async def _load(self) -> int:
+        try:
+            value = await asyncio.to_thread(self.backend.read)
+            self._store(value)
+            return value
+        except Exception as e:
+            print(f"ハイスコア読み込みエラー: {e}")
+            return self._value or 0
+        finally:
+            self._refresh = None
+
+    async def submit(self, score: int) -> Tuple[bool, int]:
+        """スコアを送信し、(新しいハイスコアか, 現在のハイスコア)を返す"""
+        current = await self.get()
+        if score <= current:
+            return False, current
+
+        # 待ち時間内の送信をまとめ、最大のスコアだけを書き込む
+        if self._pending_score is None or score > self._pending_score:
+            self._pending_score = score
+        if self._flush is None:
+            self._flush = asyncio.ensure_future(self._flush_pending())
+        high_score, previous = await asyncio.shield(self._flush)
+        return score > previous and score == high_score, high_score
+
+    async def _flush_pending(self) -> Tuple[int, int]:
+        await asyncio.sleep(self.coalesce_sec)
+        score = self._pending_score
+        # 書き込み中に届いた送信は次のまとまりにする
+        self._pending_score = None
+        self._flush = None
+        try:
+            high_score, previous = await asyncio.to_thread(self.backend.write_if_higher, score)
+            self._store(high_score)
+            return high_score, previous
+        except Exception as e:
+            print(f"ハイスコア保存エラー: {e}")
+            current = self._value or 0
+            return current, current
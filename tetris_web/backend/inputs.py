@@ -0,0 +1,54 @@
+from typing import Any, Dict, List, Optional
+
+# 1回のステップまでにためておける入力の最大数（超えた入力は捨ててエラーを返す）
+MAX_PENDING_INPUTS = 64
+
+
+class InputQueue:
+    """クライアントの入力をため、次のステップの時刻にまとめて適用するキュー（接続ごとに1つ）
+
+    入力は到着順にためておき、到着後の最初のステップの時刻（due）で一度に取り出す。
+    クライアントが入力に付けた通番（seq）のうち処理済みの最大値を last_seq に保持し、
+    まとめて適用した後の1つのフレームで処理済みの通番として返す。
+    """
+
+    def __init__(self, max_pending: int = MAX_PENDING_INPUTS):
+        self.max_pending = max_pending
+        self.pending: List[Dict[str, Any]] = []
+        self.due: Optional[int] = None  # ためている入力を適用する時刻（なければNone）
+        self.last_seq: Optional[int] = None  # 処理済みの入力の通番
+
+        # 統計
+        self.inputs = 0
+        self.batches = 0
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def push(self, message: Dict[str, Any], due: int):
+        """入力をためる（最初の入力の時刻で適用時刻が決まる、あふれた場合はValueError）"""
+        if len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            raise ValueError("入力が多すぎます")
+        self.pending.append(message)
+        if self.due is None:
+            self.due = due
+
+    def take(self) -> List[Dict[str, Any]]:
+        """ためた入力をすべて取り出し、通番を処理済みにする"""
+        batch = self.pending
+        self.pending = []
+        self.due = None
+        for message in batch:
+            self.acknowledge(message)
+        if batch:
+            self.inputs += len(batch)
+            self.batches += 1
+        return batch
+
+    def acknowledge(self, message: Dict[str, Any]):
+        """キューを通さずに処理した入力（start など）の通番を処理済みにする"""
+        seq = message.get("seq")
+        if isinstance(seq, int) and (self.last_seq is None or seq > self.last_seq):
+            self.last_seq = seq
@@ -0,0 +1,395 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+from metrics import observe_firestore
+
+# 順位表の種類（all: 全期間、day: 日別、week: 週別、level: レベル別）
+BOARD_KINDS = ("all", "day", "week", "level")
+
+# 上位リストのキャッシュ有効期間（秒）
+DEFAULT_CACHE_TTL_SEC = 5.0
+# 共有ストア（複数インスタンスから書き込まれる）の場合にインデックスを読み直す間隔（秒）
+DEFAULT_RELOAD_INTERVAL_SEC = 300.0
+# 1ページの最大件数
+MAX_PAGE_SIZE = 100
+
+# 順位表のキー（種類, 期間またはレベル）
+BoardKey = Tuple[str, Optional[Any]]
+
+
+def period_keys(timestamp: float) -> Tuple[str, str]:
+    """時刻から日別・週別の期間キーを求める（UTC、週はISO週）"""
+    dt = datetime.fromtimestamp(timestamp, timezone.utc)
+    year, week, _ = dt.isocalendar()
+    return dt.strftime("%Y-%m-%d"), f"{year}-W{week:02d}"
+
+
+class OrderedScoreIndex:
+    """スコアの順序統計インデックス（追加・順位取得ともO(log n)）
+
+    昇順に並べたスコアを最大 2*LOAD 件のブロックに分けて保持し、
+    ブロック末尾の値の二分探索と、ブロックごとの件数を持つFenwick木で
+    「あるスコアより高いスコアの件数」を求める。
+    """
+
+    LOAD = 512
+
+    def __init__(self, scores: Iterable[int] = ()):
+        values = sorted(scores)
+        self._blocks: List[List[int]] = [values[i:i + self.LOAD]
+                                         for i in range(0, len(values), self.LOAD)]
+        self._maxes: List[int] = [block[-1] for block in self._blocks]
+        self._len = len(values)
+        self._build_tree()
+
+    def __len__(self) -> int:
+        return self._len
+
+    def _build_tree(self):
+        """ブロックごとの件数のFenwick木を作り直す（O(ブロック数)）"""
+        tree = [0] * (len(self._blocks) + 1)
+        for i, block in enumerate(self._blocks, 1):
+            tree[i] += len(block)
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _tree_add(self, block_index: int, delta: int):
+        i = block_index + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def _tree_prefix(self, block_index: int) -> int:
+        """先頭からblock_index個のブロックの件数合計"""
+        total = 0
+        i = block_index
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def add(self, score: int):
+        """スコアを追加"""
+        if not self._blocks:
+            self._blocks.append([score])
+            self._maxes.append(score)
+            self._len = 1
+            self._build_tree()
+            return
+
+        i = bisect_left(self._maxes, score)
+        if i == len(self._maxes):
+            i -= 1
+        block = self._blocks[i]
+        insort(block, score)
+        self._maxes[i] = block[-1]
+        self._len += 1
+
+        if len(block) > 2 * self.LOAD:
+            # ブロックを分割（LOAD件の追加ごとに高々1回なので償却O(1)）
+            self._blocks[i:i + 1] = [block[:self.LOAD], block[self.LOAD:]]
+            self._maxes[i:i + 1] = [block[self.LOAD - 1], block[-1]]
+            self._build_tree()
+        else:
+            self._tree_add(i, 1)
+
+    def count_greater(self, score: int) -> int:
+        """scoreより高いスコアの件数"""
+        i = bisect_right(self._maxes, score)
+        if i == len(self._blocks):
+            return 0
+        not_greater = self._tree_prefix(i) + bisect_right(self._blocks[i], score)
+        return self._len - not_greater
+
+    def rank(self, score: int) -> int:
+        """scoreの順位（同点は同順位）"""
+        return self.count_greater(score) + 1
+
+
+class SQLiteLeaderboardStore:
+    """組み込みSQLiteにスコアを保存するストア（既定、同期I/O）"""
+
+    shared = False
+
+    _WHERE = {"all": "", "day": "WHERE day = ?", "week": "WHERE week = ?", "level": "WHERE level = ?"}
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS scores (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    player_name TEXT,
+                    score INTEGER NOT NULL,
+                    level INTEGER NOT NULL,
+                    lines_cleared INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    day TEXT NOT NULL,
+                    week TEXT NOT NULL
+                )""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_scores_score ON scores(score DESC, id)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_scores_day ON scores(day, score DESC, id)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_scores_week ON scores(week, score DESC, id)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_scores_level ON scores(level, score DESC, id)")
+
+    def _filter(self, board: BoardKey) -> Tuple[str, Tuple[Any, ...]]:
+        kind, value = board
+        return self._WHERE[kind], (() if kind == "all" else (value,))
+
+    def insert(self, entry: Dict[str, Any]) -> Any:
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO scores (player_name, score, level, lines_cleared, created_at, day, week) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (entry["player_name"], entry["score"], entry["level"], entry["lines_cleared"],
+                 entry["created_at"], entry["day"], entry["week"]),
+            )
+            return cursor.lastrowid
+
+    def scores(self, board: BoardKey) -> List[int]:
+        where, params = self._filter(board)
+        with self._lock:
+            return [row[0] for row in self._conn.execute(f"SELECT score FROM scores {where}", params)]
+
+    def levels(self) -> List[int]:
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT DISTINCT level FROM scores")]
+
+    def top(self, board: BoardKey, limit: int, offset: int) -> List[Dict[str, Any]]:
+        where, params = self._filter(board)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT id, player_name, score, level, lines_cleared, created_at FROM scores {where} "
+                "ORDER BY score DESC, id LIMIT ? OFFSET ?",
+                params + (limit, offset),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def count(self, board: BoardKey) -> int:
+        where, params = self._filter(board)
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM scores {where}", params).fetchone()[0]
+
+    def count_greater(self, board: BoardKey, score: int) -> int:
+        where, params = self._filter(board)
+        condition = f"{where} AND score > ?" if where else "WHERE score > ?"
+        with self._lock:
+            return self._conn.execute(
+                f"SELECT COUNT(*) FROM scores {condition}", params + (score,)).fetchone()[0]
+
+
+class FirestoreLeaderboardStore:
+    """Firestoreのコレクションにスコアを保存するストア（任意、同期I/O）
+
+    day・week・levelとscore降順の複合インデックスをFirestore側に作成しておく必要がある。
+    """
+
+    shared = True
+
+    def __init__(self, db: Any, collection: str):
+        self.db = db
+        self.collection = collection
+
+    def _query(self, board: BoardKey):
+        kind, value = board
+        query = self.db.collection(self.collection)
+        if kind != "all":
+            query = query.where(filter=FieldFilter(kind, "==", value))
+        return query
+
+    @observe_firestore("leaderboard_insert")
+    def insert(self, entry: Dict[str, Any]) -> Any:
+        _, doc_ref = self.db.collection(self.collection).add(dict(entry))
+        return doc_ref.id
+
+    @observe_firestore("leaderboard_scores")
+    def scores(self, board: BoardKey) -> List[int]:
+        return [doc.get("score") for doc in self._query(board).select(["score"]).stream()]
+
+    @observe_firestore("leaderboard_levels")
+    def levels(self) -> List[int]:
+        return sorted({doc.get("level") for doc in
+                       self.db.collection(self.collection).select(["level"]).stream()})
+
+    @observe_firestore("leaderboard_top")
+    def top(self, board: BoardKey, limit: int, offset: int) -> List[Dict[str, Any]]:
+        query = (self._query(board)
+                 .order_by("score", direction=firestore.Query.DESCENDING)
+                 .offset(offset).limit(limit))
+        entries = []
+        for doc in query.stream():
+            data = doc.to_dict()
+            entries.append({
+                "id": doc.id,
+                "player_name": data.get("player_name"),
+                "score": data.get("score", 0),
+                "level": data.get("level", 1),
+                "lines_cleared": data.get("lines_cleared", 0),
+                "created_at": data.get("created_at"),
+            })
+        return entries
+
+    @observe_firestore("leaderboard_count")
+    def count(self, board: BoardKey) -> int:
+        return int(self._query(board).count().get()[0][0].value)
+
+    @observe_firestore("leaderboard_count_greater")
+    def count_greater(self, board: BoardKey, score: int) -> int:
+        query = self._query(board).where(filter=FieldFilter("score", ">", score))
+        return int(query.count().get()[0][0].value)
+
+
+class Leaderboard:
+    """スコアの順位表サービス
+
+    全期間・当日・当週・レベル別の順位はメモリ上のOrderedScoreIndexでO(log n)で求め、
+    それ以外の期間はストアに問い合わせる。上位リストはページごとにTTL付きでキャッシュする。
+    ストアのI/Oはすべてイベントループ外のスレッドで行う。
+    """
+
+    def __init__(self, store: Any, cache_ttl_sec: float = DEFAULT_CACHE_TTL_SEC,
+                 reload_interval_sec: float = DEFAULT_RELOAD_INTERVAL_SEC):
+        self.store = store
+        self.cache_ttl_sec = cache_ttl_sec
+        self.reload_interval_sec = reload_interval_sec
+        self._indexes: Dict[BoardKey, OrderedScoreIndex] = {}
+        self._cache: Dict[Tuple[BoardKey, int, int], Tuple[float, Dict[str, Any]]] = {}
+        self._loaded_at = 0.0
+
+    def board_key(self, kind: str, period: Optional[str] = None,
+                  level: Optional[int] = None) -> BoardKey:
+        """種類と期間・レベルから順位表のキーを作る（期間省略時は現在の期間）"""
+        if kind not in BOARD_KINDS:
+            raise ValueError(f"不明な順位表です: {kind}")
+        if kind == "all":
+            return ("all", None)
+        if kind == "level":
+            if level is None:
+                raise ValueError("レベル別の順位表にはlevelの指定が必要です")
+            return ("level", level)
+        if period is None:
+            day, week = period_keys(time.time())
+            period = day if kind == "day" else week
+        return (kind, period)
+
+    def _current_boards(self, entry: Dict[str, Any]) -> List[BoardKey]:
+        return [("all", None), ("day", entry["day"]), ("week", entry["week"]),
+                ("level", entry["level"])]
+
+    def _build_indexes(self) -> Dict[BoardKey, OrderedScoreIndex]:
+        day, week = period_keys(time.time())
+        boards: List[BoardKey] = [("all", None), ("day", day), ("week", week)]
+        boards += [("level", level) for level in self.store.levels()]
+        return {board: OrderedScoreIndex(self.store.scores(board)) for board in boards}
+
+    async def load(self):
+        """ストアからインデックスを構築（起動時・定期的に呼ぶ）"""
+        indexes = await asyncio.to_thread(self._build_indexes)
+        self._indexes = indexes
+        self._cache.clear()
+        self._loaded_at = time.monotonic()
+        print(f"順位表のインデックスを読み込みました: {len(indexes.get(('all', None), []))}件")
+
+    async def _maybe_reload(self):
+        if (self.store.shared and
+                time.monotonic() - self._loaded_at >= self.reload_interval_sec):
+            await self.load()
+
+    def _index_for(self, board: BoardKey) -> Optional[OrderedScoreIndex]:
+        index = self._indexes.get(board)
+        if index is None and board[0] in ("day", "week", "level"):
+            # 現在の期間・新しいレベルは空のインデックスから始める
+            day, week = period_keys(time.time())
+            if board in (("day", day), ("week", week)) or board[0] == "level":
+                index = self._indexes[board] = OrderedScoreIndex()
+        return index
+
+    async def submit(self, score: int, level: int, lines_cleared: int,
+                     player_name: Optional[str] = None) -> Dict[str, Any]:
+        """スコアを記録し、各順位表での順位を返す"""
+        now = time.time()
+        day, week = period_keys(now)
+        entry = {
+            "player_name": player_name,
+            "score": score,
+            "level": level,
+            "lines_cleared": lines_cleared,
+            "created_at": now,
+            "day": day,
+            "week": week,
+        }
+        # 再読み込みは挿入の前に行う（挿入後に読み込むと新しい行がインデックスに2回入る）
+        await self._maybe_reload()
+        indexes = self._indexes
+        entry_id = await asyncio.to_thread(self.store.insert, entry)
+        # 挿入中に他の提出で再読み込みされた場合、新しいインデックスには既にこの行が入っていることがある
+        reloaded = self._indexes is not indexes
+
+        ranks = {}
+        for board in self._current_boards(entry):
+            index = self._index_for(board)
+            if index is None:
+                # 日付をまたいで過去の期間になった順位表はインデックスを持たないのでストアで数える
+                ranks[board[0]] = await asyncio.to_thread(self.store.count_greater, board, score) + 1
+            else:
+                if not reloaded:
+                    index.add(score)
+                ranks[board[0]] = index.rank(score)
+            self._invalidate(board)
+        return {"id": entry_id, "ranks": ranks}
+
+    def _invalidate(self, board: BoardKey):
+        for key in [key for key in self._cache if key[0] == board]:
+            del self._cache[key]
+
+    async def rank(self, board: BoardKey, score: int) -> int:
+        """指定スコアの順位表での順位"""
+        index = self._indexes.get(board)
+        if index is not None:
+            return index.rank(score)
+        return await asyncio.to_thread(self.store.count_greater, board, score) + 1
+
+    async def top(self, board: BoardKey, limit: int = 10, offset: int = 0) -> Dict[str, Any]:
+        """上位リストの1ページ（キャッシュが有効ならI/Oなし）"""
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        offset = max(0, offset)
+        key = (board, limit, offset)
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+
+        entries = await asyncio.to_thread(self.store.top, board, limit, offset)
+        index = self._indexes.get(board)
+        if index is not None:
+            total = len(index)
+            for entry in entries:
+                entry["rank"] = index.rank(entry["score"])
+        else:
+            total = await asyncio.to_thread(self.store.count, board)
+            for i, entry in enumerate(entries):
+                if i == 0:
+                    # 前のページと同点の場合があるため先頭だけ件数から求める
+                    entry["rank"] = await asyncio.to_thread(
+                        self.store.count_greater, board, entry["score"]) + 1
+                elif entries[i - 1]["score"] == entry["score"]:
+                    entry["rank"] = entries[i - 1]["rank"]
+                else:
+                    entry["rank"] = offset + i + 1
+        result = {"board": board[0], "key": board[1], "total": total,
+                  "offset": offset, "entries": entries}
+        self._cache[key] = (time.monotonic() + self.cache_ttl_sec, result)
+        return result
@@ -1,21 +1,42 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi import Depends, FastAPI, Header, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, Response
 from pydantic import BaseModel
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 from contextlib import asynccontextmanager
 import json
 import time
 import asyncio
+import itertools
 import os
+import secrets
 from google.cloud import firestore
-from game import TetrisGame, ActionType
+from game import TetrisGame, UniformRandomizer
+from simulation import GameRecording, Simulation
+from scheduler import BroadcastPacer, SessionScheduler, earliest, monotonic_ms, parse_broadcast_rate
+from protocol import ACTION_OPCODES, PIECE_RULES_MESSAGE, create_encoder, decode_binary_action
+from outbox import ClientOutbox, EVICT_CLOSE_CODE
+from inputs import InputQueue
+from sharding import ShardPool
+from highscore import FirestoreHighScoreBackend, HighScoreService, InMemoryHighScoreBackend
+from leaderboard import FirestoreLeaderboardStore, Leaderboard, SQLiteLeaderboardStore
+from verification import DEFAULT_VERIFY_WORKERS, ScoreVerifier, new_game_id
+from snapshot import SnapshotStore, decode_snapshot, encode_snapshot, new_resume_token
+from metrics import CONTENT_TYPE, REGISTRY, UPDATE_ITERATION_SECONDS, monitor_event_loop
+from profiling import (DEFAULT_PROFILE_SECONDS, DEFAULT_SAMPLE_INTERVAL_MS, Profiler,
+                       format_report)
+from spectator import (MAX_SPECTATORS_PER_GAME, SPECTATE_NOT_FOUND_CLOSE_CODE, SpectatorChannel,
+                       SpectatorEncoders, SpectatorFrame, new_watch_id, spectator_format)
+from rooms import (ROOM_FULL_CLOSE_CODE, ROOM_INVALID_CLOSE_CODE, Room, parse_room_id,
+                   parse_room_size)
 
 # ハイスコア管理のためのモデル
 class ScoreSubmission(BaseModel):
     score: int
     level: int
     lines_cleared: int
+    player_name: Optional[str] = None
+    game_id: Optional[str] = None  # WebSocketで通知されたゲームID（記録の再生による検証に使う）
 
 # Firestoreクライアントの初期化
 try:
@@ -29,93 +50,260 @@ except Exception as e:
 COLLECTION_NAME = "tetris_game"
 HIGH_SCORE_DOC = "high_score"
 
-def load_high_score():
-    """Firestoreからハイスコアを読み込み"""
-    try:
-        if db is None:
-            print("Firestoreクライアントが利用できません")
-            return 0
-            
-        doc_ref = db.collection(COLLECTION_NAME).document(HIGH_SCORE_DOC)
-        doc = doc_ref.get()
-        
-        if doc.exists:
-            data = doc.to_dict()
-            high_score = data.get('score', 0)
-            print(f"Firestoreからハイスコアを読み込み: {high_score}")
-            return high_score
-        else:
-            print("ハイスコアドキュメントが存在しません。0を返します。")
-            return 0
-    except Exception as e:
-        print(f"Firestoreハイスコア読み込みエラー: {e}")
-        return 0
-
-def save_high_score(score: int):
-    """Firestoreにハイスコアを保存"""
-    try:
-        if db is None:
-            print("Firestoreクライアントが利用できません")
-            return False
-            
-        current_high_score = load_high_score()
-        if score > current_high_score:
-            doc_ref = db.collection(COLLECTION_NAME).document(HIGH_SCORE_DOC)
-            doc_ref.set({
-                'score': score,
-                'updated_at': firestore.SERVER_TIMESTAMP
-            })
-            print(f"新しいハイスコアをFirestoreに保存: {score}")
-            return True
-        else:
-            print(f"現在のスコア {score} は既存のハイスコア {current_high_score} を上回りませんでした")
-            return False
-    except Exception as e:
-        print(f"Firestoreハイスコア保存エラー: {e}")
-        return False
+# ハイスコアサービス（Firestoreが利用できない場合はプロセス内のバックエンドで代替）
+if db is not None:
+    high_score_backend = FirestoreHighScoreBackend(db, COLLECTION_NAME, HIGH_SCORE_DOC)
+else:
+    print("Firestoreクライアントが利用できないため、ハイスコアはメモリ内で管理します")
+    high_score_backend = InMemoryHighScoreBackend()
+high_score_service = HighScoreService(high_score_backend)
+
+# セッション数などの集計値のメトリクス（/metrics の出力時に集計する）
+def collect_session_states() -> Dict[tuple, float]:
+    """状態（playing/paused/game_over）ごとのセッション数"""
+    counts = {("playing",): 0, ("paused",): 0, ("game_over",): 0}
+    if shard_pool is not None:
+        for shard in shard_pool.stats():
+            for state, count in shard.get("states", {}).items():
+                counts[(state,)] = counts.get((state,), 0) + count
+    else:
+        for simulation in client_simulations.values():
+            counts[(simulation.game.status,)] += 1
+    return counts
+
+def collect_shard_stat(key: str):
+    """シャードワーカーごとの負荷情報の1項目"""
+    def collect() -> Dict[tuple, float]:
+        if shard_pool is None:
+            return {}
+        return {(str(shard["shard"]),): shard[key] for shard in shard_pool.stats() if key in shard}
+    return collect
+
+REGISTRY.gauge("tetris_sessions", "状態ごとのセッション数", ("state",), collect_session_states)
+REGISTRY.gauge("tetris_connections", "WebSocketの接続数",
+               collect=lambda: {(): len(client_outboxes)})
+REGISTRY.gauge("tetris_spectators", "観戦者の接続数",
+               collect=lambda: {(): sum(len(channel) for channel in spectator_channels.values())})
+REGISTRY.gauge("tetris_rooms", "対戦ルーム数", collect=lambda: {(): len(room_members)})
+REGISTRY.gauge("tetris_shard_busy_ratio", "シャードワーカーの稼働率", ("shard",),
+               collect_shard_stat("busy_ratio"))
+REGISTRY.gauge("tetris_shard_updates_per_second", "シャードワーカーの更新回数/秒", ("shard",),
+               collect_shard_stat("updates_per_sec"))
+
+# 順位表（LEADERBOARD_BACKEND=firestore でFirestore、既定は組み込みSQLite）
+LEADERBOARD_COLLECTION = "tetris_scores"
+if os.environ.get("LEADERBOARD_BACKEND") == "firestore" and db is not None:
+    leaderboard_store = FirestoreLeaderboardStore(db, LEADERBOARD_COLLECTION)
+else:
+    leaderboard_store = SQLiteLeaderboardStore(os.environ.get("LEADERBOARD_DB", "leaderboard.db"))
+leaderboard = Leaderboard(leaderboard_store)
+
+# スコア検証（ゲームの記録を再生して提出されたスコアと照合する）
+score_verifier = ScoreVerifier(int(os.environ.get("VERIFY_WORKERS", DEFAULT_VERIFY_WORKERS)))
+
+# 切断されたゲームのスナップショット（再接続時に再開トークンで再開する）
+snapshot_store = SnapshotStore()
+
+# 管理用エンドポイント（/admin/...）の認証トークン（未設定の場合は管理用エンドポイントを無効にする）
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """X-Admin-Tokenヘッダが管理用トークンと一致するか確認"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="管理用エンドポイントは無効です（ADMIN_TOKENが未設定）")
+    if x_admin_token is None or not secrets.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="管理用トークンが正しくありません")
+
+def game_label(game: TetrisGame) -> Optional[str]:
+    """ゲームに対応するゲームID（メモリ割り当ての集計用）"""
+    for websocket, simulation in client_simulations.items():
+        if simulation.game is game:
+            return client_game_ids.get(websocket)
+    return None
+
+# 区間計測・サンプリング・メモリ割り当て追跡（シャード利用時は各ワーカーでも行う）
+profiler = Profiler(game_label)
 
 # ゲーム状態の自動更新タスク
 async def game_update_task():
-    """各クライアントのゲーム状態を定期的に更新"""
+    """更新期限・送信枠が到来したクライアントのゲームだけを更新し、送信枠ごとに状態を送る"""
     while True:
         try:
-            current_time = int(time.time() * 1000)  # ミリ秒
+            await session_scheduler.wait_until_due()
+            started = time.perf_counter()
+            current_time = monotonic_ms()
             
-            # 各クライアントのゲームを更新
+            # 期限が来たクライアントのゲームを更新
             disconnected_clients = []
-            for websocket, game in client_games.items():
+            for websocket in session_scheduler.pop_due(current_time):
+                # 対戦ルームはルームIDで登録され、全メンバーのゲームをまとめて進める
+                if isinstance(websocket, str):
+                    try:
+                        update_room(websocket, current_time)
+                    except Exception as e:
+                        print(f"ルーム {websocket} の更新エラー: {e}")
+                    continue
+                simulation = client_simulations.get(websocket)
+                pacer = client_pacers.get(websocket)
+                if simulation is None or pacer is None:
+                    continue
                 try:
-                    game.update(current_time)
-                    # 更新された状態をそのクライアントに送信（非同期で送信）
-                    asyncio.create_task(websocket.send_text(json.dumps(game.get_game_state())))
+                    # 固定ステップの時刻で順に更新する（遅れて処理されても記録の再生と同じ結果になる）
+                    version = simulation.game.state_version
+                    # ためていた入力はステップの時刻でまとめて適用する
+                    inputs = client_inputs.get(websocket)
+                    replied = inputs is not None and inputs.due is not None and inputs.due <= current_time
+                    if replied:
+                        simulation.advance_to(inputs.due)
+                        simulation.apply(inputs.take())
+                    simulation.advance_to(current_time)
+                    spectator = client_spectators.get(websocket)
+                    # 送る状態が変わったときだけ送信枠を使う（接地中・ライン消去待ちの更新では送らない）
+                    if simulation.game.state_version != version:
+                        pacer.mark_dirty()
+                        if spectator is not None:
+                            spectator.pacer.mark_dirty()
+                    # 送信が長時間滞っているクライアントは切断
+                    outbox = client_outboxes.get(websocket)
+                    if outbox is None or outbox.closed or outbox.is_stalled(current_time):
+                        disconnected_clients.append(websocket)
+                        continue
+                    # 入力への応答は送信枠を待たずに1フレームで返し、それ以外は送信枠が来ていれば
+                    # それまでの更新をまとめた最新の状態を送る
+                    if replied or pacer.ready(current_time):
+                        send_game_state(websocket, simulation.game)
+                    # 観戦者へは観戦用の送信枠ごとに1回だけエンコードして配る
+                    if spectator is not None and spectator.pacer.ready(current_time):
+                        publish_spectator_frames(websocket, spectator.encode(simulation.game, current_time))
+                    # 次の更新期限・送信枠を登録
+                    schedule_client(websocket)
                 except Exception as e:
                     print(f"クライアント {websocket} のゲーム更新エラー: {e}")
                     disconnected_clients.append(websocket)
             
             # 切断されたクライアントを削除
             for websocket in disconnected_clients:
-                if websocket in client_games:
-                    del client_games[websocket]
+                evict_client(websocket)
+            UPDATE_ITERATION_SECONDS.observe(time.perf_counter() - started)
                 
         except Exception as e:
             print(f"ゲーム更新タスクエラー: {e}")
-        
-        await asyncio.sleep(0.008)  # 約120FPS（8ms間隔）で更新
+            await asyncio.sleep(0.008)
+
+# シャードワーカーからのフレーム・エラーの受け取り
+def on_shard_frame(session_id: int, payload):
+    """ワーカーでエンコード済みのフレームをクライアントの送信箱へ入れる"""
+    websocket = session_sockets.get(session_id)
+    outbox = client_outboxes.get(websocket) if websocket is not None else None
+    if outbox is None:
+        return
+    # 送信が長時間滞っているクライアントは切断
+    if outbox.closed or outbox.is_stalled():
+        evict_client(websocket)
+        return
+    outbox.push_payload(payload)
+
+def on_shard_error(session_id: int, error: str):
+    """ワーカーで発生したアクションのエラーをクライアントへ通知"""
+    websocket = session_sockets.get(session_id)
+    if websocket is not None:
+        send_client_message(websocket, {"error": error})
+
+def on_shard_spectate(session_id: int, frames: List[SpectatorFrame]):
+    """ワーカーでエンコード済みの観戦フレームを観戦者へ配る"""
+    websocket = session_sockets.get(session_id)
+    if websocket is not None:
+        publish_spectator_frames(websocket, frames)
+
+def on_shard_room_frame(room_id: str, payload: str):
+    """ワーカーでエンコード済みのルームフレームを全メンバーへ配る"""
+    publish_room_frame(room_id, payload)
+
+def on_shard_room_error(room_id: str, slot: int, error: str):
+    """ワーカーで発生したルームのアクションのエラーをメンバーへ通知"""
+    websocket = room_members.get(room_id, {}).get(slot)
+    if websocket is not None:
+        send_client_message(websocket, {"error": error})
+
+def on_shard_recording(game_id: str, recording: GameRecording):
+    """ワーカーで終了したゲームの記録をスコア検証用に登録"""
+    score_verifier.register(game_id, recording)
+
+def on_shard_snapshot(token: str, game_id: str, snapshot: bytes, recording: GameRecording):
+    """ワーカーで閉じたセッションのゲームを再開用に保存（記録は再開後も続けるため登録しておく）"""
+    score_verifier.register(game_id, recording)
+    snapshot_store.put(token, game_id, snapshot)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """アプリケーションのライフサイクル管理"""
-    # 起動時の処理
-    asyncio.create_task(game_update_task())
+    global shard_pool
+    # 起動時の処理（SHARD_WORKERSが1以上ならワーカープロセスでゲームを進める）
+    await leaderboard.load()
+    score_verifier.start()
+    asyncio.create_task(monitor_event_loop())
+    if SHARD_WORKERS > 0:
+        shard_pool = ShardPool(SHARD_WORKERS, on_shard_frame, on_shard_error, on_shard_recording,
+                               on_shard_snapshot, on_shard_spectate, on_shard_room_frame,
+                               on_shard_room_error)
+        shard_pool.start()
+    else:
+        asyncio.create_task(game_update_task())
     yield
-    # 終了時の処理（必要に応じて）
+    # 終了時の処理
+    if shard_pool is not None:
+        shard_pool.stop()
+    score_verifier.stop()
 
 app = FastAPI(title="テトリスWebゲーム", version="1.0.0", lifespan=lifespan)
 
 # 静的ファイルの配信（APIエンドポイントの後にマウント）
 
-# クライアントごとのゲームインスタンス管理
-client_games: Dict[WebSocket, TetrisGame] = {}
+# クライアントごとのゲームインスタンス管理（期限どおりの時刻で進め、操作を記録する）
+client_simulations: Dict[WebSocket, Simulation] = {}
+
+# クライアントごとの状態送信の間隔（接続時に ?rate=20/30/60 で指定）
+client_pacers: Dict[WebSocket, BroadcastPacer] = {}
+
+# クライアントごとの入力キュー（次のステップの時刻にまとめて適用する）
+client_inputs: Dict[WebSocket, InputQueue] = {}
+
+# クライアントごとの現在のゲームIDと再開トークン
+client_game_ids: Dict[WebSocket, str] = {}
+client_resume_tokens: Dict[WebSocket, str] = {}
+
+# クライアントごとの観戦用ID（ゲームIDとは別に公開する）と、観戦用IDからプレイヤーの接続への対応
+client_watch_ids: Dict[WebSocket, str] = {}
+watch_players: Dict[str, WebSocket] = {}
+
+# 観戦用IDごとの観戦者への配信（観戦者がいる間だけ存在する）
+spectator_channels: Dict[str, SpectatorChannel] = {}
+
+# 観戦されているクライアントの観戦フレームのエンコーダ（シャード利用時はワーカーが持つ）
+client_spectators: Dict[WebSocket, SpectatorEncoders] = {}
+
+# 対戦ルーム（シャード利用時はワーカーが持つ）と、ルームごとのメンバーの接続（席番号 → 接続）・人数
+rooms: Dict[str, Room] = {}
+room_members: Dict[str, Dict[int, WebSocket]] = {}
+room_sizes: Dict[str, int] = {}
+
+# クライアントごとの参加中のルームIDと席番号
+client_rooms: Dict[WebSocket, Tuple[str, int]] = {}
+
+# クライアント（対戦ルームはルームID）ごとの次回更新期限の管理
+session_scheduler = SessionScheduler()
+
+# クライアントごとの送信箱（フレームエンコーダと書き込みタスクを保持）
+client_outboxes: Dict[WebSocket, ClientOutbox] = {}
+
+# シミュレーションワーカー数（0の場合はこのプロセスのイベントループでゲームを進める）
+SHARD_WORKERS = int(os.environ.get("SHARD_WORKERS", "0"))
+shard_pool: Optional[ShardPool] = None
+
+# シャード利用時のクライアントとセッションIDの対応
+client_sessions: Dict[WebSocket, int] = {}
+session_sockets: Dict[int, WebSocket] = {}
+session_ids = itertools.count(1)
 
 # Pydanticモデル
 class ActionRequest(BaseModel):
@@ -137,23 +325,211 @@ class GameStateResponse(BaseModel):
     speed_multiplier: float
     lines_cleared_this_frame: int
 
+def send_game_id(websocket: WebSocket, game_id: str, resumed: bool = False):
+    """ゲームIDと再開トークンをクライアントへ通知"""
+    message = {"type": "game", "game_id": game_id, "resume_token": client_resume_tokens.get(websocket),
+               "watch_id": client_watch_ids.get(websocket)}
+    if resumed:
+        message["resumed"] = True
+    send_client_message(websocket, message)
+
+def start_recorded_game(websocket: WebSocket, randomizer: str = UniformRandomizer.name,
+                        speed_multiplier: float = 1.0) -> Simulation:
+    """操作を記録するゲームを作成し、ゲームIDをクライアントへ通知"""
+    simulation = Simulation.recorded(monotonic_ms(), randomizer, speed_multiplier)
+    client_simulations[websocket] = simulation
+    # 前のゲームの記録はここから期限を数える
+    previous_id = client_game_ids.get(websocket)
+    if previous_id is not None:
+        score_verifier.finish(previous_id)
+    game_id = new_game_id()
+    client_game_ids[websocket] = game_id
+    score_verifier.track(game_id, simulation.recording)
+    send_game_id(websocket, game_id)
+    return simulation
+
+def resume_game(websocket: WebSocket, token: str) -> bool:
+    """再開トークンに対応するスナップショットからゲームを再開（再開できなければFalse）"""
+    entry = snapshot_store.take(token)
+    if entry is None:
+        return False
+    game_id, snapshot = entry
+    # 記録が残っていれば続けて記録する（記録がなければスコアは検証できない）
+    simulation = decode_snapshot(snapshot, monotonic_ms(), score_verifier.recording(game_id))
+    if simulation.recording is not None:
+        score_verifier.track(game_id, simulation.recording)
+    client_simulations[websocket] = simulation
+    client_game_ids[websocket] = game_id
+    send_game_id(websocket, game_id, resumed=True)
+    print(f"切断されたゲームを再開しました: {id(simulation.game)}")
+    return True
+
 def get_or_create_game(websocket: WebSocket) -> TetrisGame:
     """WebSocket接続に対応するゲームインスタンスを取得または作成"""
-    if websocket not in client_games:
-        client_games[websocket] = TetrisGame()
-        print(f"新しいゲームインスタンスを作成しました: {id(client_games[websocket])}")
-    return client_games[websocket]
+    if websocket not in client_simulations:
+        start_recorded_game(websocket)
+        print(f"新しいゲームインスタンスを作成しました: {id(client_simulations[websocket].game)}")
+    return client_simulations[websocket].game
 
-def force_new_game(websocket: WebSocket) -> TetrisGame:
+def force_new_game(websocket: WebSocket, randomizer: str = UniformRandomizer.name,
+                   speed_multiplier: float = 1.0) -> TetrisGame:
     """WebSocket接続に対して強制的に新しいゲームインスタンスを作成"""
-    client_games[websocket] = TetrisGame()
-    print(f"強制的に新しいゲームインスタンスを作成しました: {id(client_games[websocket])}")
-    return client_games[websocket]
+    game = start_recorded_game(websocket, randomizer, speed_multiplier).game
+    print(f"強制的に新しいゲームインスタンスを作成しました: {id(game)}")
+    return game
 
 def remove_client_game(websocket: WebSocket):
-    """WebSocket接続に対応するゲームインスタンスを削除"""
-    if websocket in client_games:
-        del client_games[websocket]
+    """WebSocket接続に対応するゲームインスタンスを削除（続行中のゲームは再開用に保存）"""
+    leave_room(websocket)
+    simulation = client_simulations.pop(websocket, None)
+    game_id = client_game_ids.pop(websocket, None)
+    token = client_resume_tokens.pop(websocket, None)
+    if simulation is not None and game_id is not None and token is not None and not simulation.game.game_over:
+        simulation.advance_to(monotonic_ms())
+        # 保存に失敗しても切断時の後片付けは続ける（再開はできなくなる）
+        try:
+            snapshot_store.put(token, game_id, encode_snapshot(simulation))
+        except Exception as e:
+            print(f"スナップショットの保存エラー: {e}")
+    # 記録はここから期限を数える（再開できる間・ゲームオーバー後の提出に使う）
+    if game_id is not None:
+        score_verifier.finish(game_id)
+    session_scheduler.cancel(websocket)
+    client_pacers.pop(websocket, None)
+    client_inputs.pop(websocket, None)
+    client_spectators.pop(websocket, None)
+    # 観戦者への配信を終了
+    watch_id = client_watch_ids.pop(websocket, None)
+    if watch_id is not None:
+        watch_players.pop(watch_id, None)
+        channel = spectator_channels.pop(watch_id, None)
+        if channel is not None:
+            channel.close()
+    outbox = client_outboxes.pop(websocket, None)
+    if outbox is not None:
+        outbox.close()
+    session_id = client_sessions.pop(websocket, None)
+    if session_id is not None:
+        session_sockets.pop(session_id, None)
+        if shard_pool is not None:
+            # 続行中のゲームはワーカーがスナップショットを返す
+            shard_pool.close_session(session_id, token)
+
+def evict_client(websocket: WebSocket):
+    """送信が追いつかない・失敗したクライアントを切断して削除"""
+    outbox = client_outboxes.get(websocket)
+    if outbox is not None:
+        print(f"クライアント {websocket} を切断します（未送信: {outbox.depth}, 間引き: {outbox.coalesced_frames}）")
+        outbox.close(code=EVICT_CLOSE_CODE)
+    remove_client_game(websocket)
+
+def send_game_state(websocket: WebSocket, game: TetrisGame):
+    """ゲーム状態をこのクライアントの送信箱へ入れる（送信は書き込みタスクが行う）"""
+    outbox = client_outboxes.get(websocket)
+    if outbox is not None:
+        # 処理済みの入力の通番をフレームに付ける
+        inputs = client_inputs.get(websocket)
+        if inputs is not None:
+            outbox.encoder.ack = inputs.last_seq
+        outbox.push_state(game)
+        # 次の送信枠はここから数える
+        pacer = client_pacers.get(websocket)
+        if pacer is not None:
+            pacer.mark_sent(monotonic_ms())
+
+def send_client_message(websocket: WebSocket, message: Dict[str, Any]):
+    """状態以外のメッセージ（エラーなど）をこのクライアントの送信箱へ入れる"""
+    outbox = client_outboxes.get(websocket)
+    if outbox is not None:
+        outbox.push_message(json.dumps(message))
+
+def schedule_client(websocket: WebSocket):
+    """ゲームの次の更新期限・入力の適用時刻と送信枠（観戦用の送信枠を含む）のうち最も早い時刻でスケジューラに登録"""
+    simulation = client_simulations.get(websocket)
+    pacer = client_pacers.get(websocket)
+    if simulation is not None and pacer is not None:
+        spectator = client_spectators.get(websocket)
+        inputs = client_inputs.get(websocket)
+        session_scheduler.schedule(websocket, earliest(
+            simulation.next_due, pacer.deadline(),
+            spectator.pacer.deadline() if spectator is not None else None,
+            inputs.due if inputs is not None else None))
+
+def publish_spectator_frames(websocket: WebSocket, frames: List[SpectatorFrame]):
+    """プレイヤーのゲームの観戦フレームを全観戦者へ配り、送信が滞っている観戦者を切断"""
+    watch_id = client_watch_ids.get(websocket)
+    channel = spectator_channels.get(watch_id) if watch_id is not None else None
+    if channel is None:
+        return
+    for outbox in channel.publish(frames):
+        outbox.close(code=EVICT_CLOSE_CODE)
+
+def update_spectator_formats(watch_id: str):
+    """観戦者がいる形式だけをエンコードするようにゲームを進める側へ伝える"""
+    websocket = watch_players.get(watch_id)
+    if websocket is None:
+        return
+    channel = spectator_channels.get(watch_id)
+    formats = channel.formats if channel is not None else ()
+    if shard_pool is not None:
+        session_id = client_sessions.get(websocket)
+        if session_id is not None:
+            shard_pool.watch(session_id, formats)
+    elif formats:
+        client_spectators.setdefault(websocket, SpectatorEncoders()).set_formats(formats)
+        schedule_client(websocket)
+    else:
+        client_spectators.pop(websocket, None)
+
+def schedule_room(room_id: str):
+    """ルームのいずれかのゲームの次の更新期限と送信枠のうち最も早い時刻でスケジューラに登録"""
+    room = rooms.get(room_id)
+    if room is not None:
+        session_scheduler.schedule(room_id, earliest(room.next_due, room.pacer.deadline()))
+
+def update_room(room_id: str, current_time: int):
+    """ルームの全ゲームを現在時刻まで進め、送信枠が来ていればルームフレームを1回だけエンコードして配る"""
+    room = rooms.get(room_id)
+    if room is None:
+        return
+    room.advance_to(current_time)
+    if room.pacer.ready(current_time):
+        publish_room_frame(room_id, room.encode(current_time))
+    schedule_room(room_id)
+
+def publish_room_frame(room_id: str, payload: Optional[str]):
+    """ルームフレームを全メンバーの送信箱へ入れ、送信が滞っているメンバーを切断"""
+    if payload is None:
+        return
+    stalled = []
+    for websocket in room_members.get(room_id, {}).values():
+        outbox = client_outboxes.get(websocket)
+        if outbox is None or outbox.closed or outbox.is_stalled():
+            stalled.append(websocket)
+            continue
+        outbox.push_payload(payload)
+    for websocket in stalled:
+        evict_client(websocket)
+
+def leave_room(websocket: WebSocket):
+    """参加中のルームから抜ける（ラウンド中なら棄権、最後のメンバーならルームを削除）"""
+    entry = client_rooms.pop(websocket, None)
+    if entry is None:
+        return
+    room_id, slot = entry
+    members = room_members.get(room_id, {})
+    members.pop(slot, None)
+    if shard_pool is not None:
+        shard_pool.leave_room(room_id, slot)
+    elif room_id in rooms:
+        rooms[room_id].remove_player(slot, monotonic_ms())
+    if not members:
+        room_members.pop(room_id, None)
+        room_sizes.pop(room_id, None)
+        rooms.pop(room_id, None)
+        session_scheduler.cancel(room_id)
+    else:
+        schedule_room(room_id)
 
 # メインページは静的ファイルで配信されるため、このエンドポイントは不要
 # @app.get("/", response_class=HTMLResponse)
@@ -170,20 +546,149 @@ async def start_game():
 @app.get("/high-score")
 async def get_high_score():
     """ハイスコアを取得"""
-    high_score = load_high_score()
+    high_score = await high_score_service.get()
     return {"high_score": high_score}
 
 @app.post("/submit-score")
 async def submit_score(score_data: ScoreSubmission):
-    """スコアを送信してハイスコア更新をチェック"""
-    is_new_high_score = save_high_score(score_data.score)
-    current_high_score = load_high_score()
+    """スコアを送信してハイスコア更新をチェック（ゲームの記録を再生して一致した場合のみ受け付ける）"""
+    verification = await score_verifier.verify(
+        score_data.game_id, score_data.score, score_data.level, score_data.lines_cleared)
+    if not verification.verified:
+        print(f"スコアを拒否しました: {score_data.score}（{verification.reason}）")
+        raise HTTPException(status_code=400, detail=verification.reason)
+    is_new_high_score, current_high_score = await high_score_service.submit(score_data.score)
+    recorded = await leaderboard.submit(
+        score_data.score, score_data.level, score_data.lines_cleared, score_data.player_name)
     return {
         "submitted_score": score_data.score,
         "current_high_score": current_high_score,
-        "is_new_high_score": is_new_high_score
+        "is_new_high_score": is_new_high_score,
+        "ranks": recorded["ranks"]
+    }
+
+@app.get("/leaderboard")
+async def get_leaderboard(board: str = "all", period: Optional[str] = None,
+                          level: Optional[int] = None, limit: int = 10, offset: int = 0):
+    """順位表の上位リストを取得（board: all/day/week/level、periodは日別YYYY-MM-DD・週別YYYY-Www）"""
+    try:
+        key = leaderboard.board_key(board, period, level)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return await leaderboard.top(key, limit, offset)
+
+@app.get("/leaderboard/rank")
+async def get_leaderboard_rank(score: int, board: str = "all", period: Optional[str] = None,
+                               level: Optional[int] = None):
+    """指定スコアの順位を取得"""
+    try:
+        key = leaderboard.board_key(board, period, level)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"board": board, "score": score, "rank": await leaderboard.rank(key, score)}
+
+@app.get("/verification")
+async def get_verification_stats():
+    """スコア検証の統計を取得"""
+    return score_verifier.stats()
+
+@app.get("/snapshots")
+async def get_snapshot_stats():
+    """再開用スナップショットの統計を取得"""
+    return snapshot_store.stats()
+
+@app.get("/spectate")
+async def get_spectated_games(limit: int = 20):
+    """観戦できるゲームを観戦者数の多い順に取得（観戦は WS /spectate/{watch_id}）"""
+    games = sorted(
+        ({"watch_id": watch_id,
+          "viewers": len(spectator_channels[watch_id]) if watch_id in spectator_channels else 0}
+         for watch_id in watch_players),
+        key=lambda game: game["viewers"], reverse=True)
+    return {
+        "games": games[:max(0, limit)],
+        "spectators": sum(len(channel) for channel in spectator_channels.values()),
+        "frames_published": sum(channel.frames_published for channel in spectator_channels.values()),
+        "frames_delivered": sum(channel.frames_delivered for channel in spectator_channels.values()),
     }
 
+@app.get("/rooms")
+async def get_rooms():
+    """対戦ルームの一覧（このプロセスで進めているルームは状態と統計を含む）"""
+    return {"rooms": [
+        rooms[room_id].stats() if room_id in rooms else
+        {"room": room_id, "size": room_sizes.get(room_id), "players": len(members)}
+        for room_id, members in room_members.items()
+    ]}
+
+@app.get("/metrics")
+async def get_metrics():
+    """メトリクスをテキスト形式（Prometheus）で取得"""
+    return Response(content=REGISTRY.render(), media_type=CONTENT_TYPE)
+
+async def profile_all(kind: str, **params) -> Dict[str, Dict[str, Any]]:
+    """このプロセスと全シャードワーカーで計測を行い、プロセスごとの結果を返す"""
+    reports: Dict[str, Dict[str, Any]] = {}
+    pending = None
+    if shard_pool is not None:
+        timeout = params.get("seconds", 0) + 5
+        pending = asyncio.ensure_future(shard_pool.profile(kind, timeout, **params))
+    try:
+        if kind == "phases":
+            reports["frontend"] = profiler.set_phases(params.get("enabled"))
+        else:
+            profiler.start_job(kind, **params)
+            # リクエストが取り消されても計測を止めないと次の計測が始められなくなる
+            try:
+                await asyncio.sleep(params["seconds"])
+            finally:
+                reports["frontend"] = profiler.finish_job()
+    except ValueError as e:
+        reports["frontend"] = {"error": str(e)}
+    if pending is not None:
+        for shard_id, report in sorted((await pending).items()):
+            reports[f"shard-{shard_id}"] = report
+    return reports
+
+def report_response(reports: Dict[str, Dict[str, Any]], filename: str, folded: bool = False) -> Response:
+    """計測結果をダウンロード用のテキストとして返す"""
+    errors = [report["error"] for report in reports.values() if "error" in report]
+    if errors and len(errors) == len(reports):
+        raise HTTPException(status_code=409, detail=errors[0])
+    return Response(content=format_report(reports, folded), media_type="text/plain; charset=utf-8",
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@app.get("/admin/profile/phases", dependencies=[Depends(require_admin)])
+async def get_phase_timers():
+    """ゲーム更新・状態送信の区間ごとの処理時間を取得"""
+    return await profile_all("phases", enabled=None)
+
+@app.post("/admin/profile/phases", dependencies=[Depends(require_admin)])
+async def set_phase_timers(enabled: bool = True):
+    """区間ごとの処理時間の計測を開始・停止（開始時にそれまでの計測値は消える）"""
+    return await profile_all("phases", enabled=enabled)
+
+@app.post("/admin/profile/sample", dependencies=[Depends(require_admin)])
+async def sample_profile(seconds: float = DEFAULT_PROFILE_SECONDS,
+                         interval_ms: float = DEFAULT_SAMPLE_INTERVAL_MS, format: str = "text"):
+    """一定期間スタックを採取し、関数ごとの集計（format=foldedで折りたたみ形式）をダウンロード"""
+    reports = await profile_all("sample", seconds=seconds, interval_ms=interval_ms)
+    folded = format == "folded"
+    return report_response(reports, "profile.folded" if folded else "profile.txt", folded)
+
+@app.post("/admin/profile/allocations", dependencies=[Depends(require_admin)])
+async def allocation_profile(seconds: float = DEFAULT_PROFILE_SECONDS):
+    """一定期間メモリ割り当てを追跡し、行ごと・セッションごとの確保量の増減をダウンロード"""
+    reports = await profile_all("allocations", seconds=seconds)
+    return report_response(reports, "allocations.txt")
+
+@app.get("/shards")
+async def get_shard_stats():
+    """シャードワーカーごとの負荷情報を取得"""
+    if shard_pool is None:
+        return {"workers": 0, "shards": []}
+    return {"workers": shard_pool.workers, "shards": shard_pool.stats()}
+
 @app.post("/move")
 async def perform_move(action_request: ActionRequest):
     """アクションを実行（WebSocket経由で実行されるため、このエンドポイントは非推奨）"""
@@ -199,57 +704,248 @@ async def websocket_endpoint(websocket: WebSocket):
     """WebSocketエンドポイント"""
     await websocket.accept()
     
+    # フレーム形式を接続時に決定（?encoding=binary でバイナリ、?frames=delta で差分フレーム、指定なしは従来形式）
+    # ?predict=1 は予測モード（ピースの規則を最初に送り、フレームに状態ハッシュを付ける）
+    predict = websocket.query_params.get("predict") == "1"
+    encoder = create_encoder(
+        websocket.query_params.get("frames"),
+        websocket.query_params.get("encoding"),
+        predict,
+    )
+    outbox = ClientOutbox(websocket, encoder)
+    client_outboxes[websocket] = outbox
+    outbox.start()
+    if predict:
+        outbox.push_message(PIECE_RULES_MESSAGE)
+    # 状態の送信レートを接続時に決定（?rate=20/30/60、指定なしは既定値）
+    broadcast_rate = parse_broadcast_rate(websocket.query_params.get("rate"))
+    client_pacers[websocket] = BroadcastPacer(broadcast_rate)
+    
+    # ?resume=<再開トークン> が有効なら切断前のゲームを再開する（トークンは接続ごとに新しく発行）
+    resume_token = websocket.query_params.get("resume")
+    client_resume_tokens[websocket] = new_resume_token()
+    # 観戦用のIDは接続ごとに発行し、接続中は新しいゲームを始めても同じIDで観戦できる
+    watch_id = new_watch_id()
+    client_watch_ids[websocket] = watch_id
+    watch_players[watch_id] = websocket
+    
     try:
-        # このクライアント用のゲームインスタンスを作成
-        game = get_or_create_game(websocket)
-        
-        # 初期状態を送信
-        await websocket.send_text(json.dumps(game.get_game_state()))
+        if shard_pool is not None:
+            # ワーカーにセッションを割り当て（初期状態はワーカーから届く）
+            session_id = next(session_ids)
+            client_sessions[websocket] = session_id
+            session_sockets[session_id] = websocket
+            entry = snapshot_store.take(resume_token) if resume_token else None
+            if entry is not None:
+                game_id, snapshot = entry
+                resumed = (snapshot, score_verifier.recording(game_id))
+            else:
+                game_id, resumed = new_game_id(), None
+            shard_pool.open_session(
+                session_id,
+                websocket.query_params.get("frames"),
+                websocket.query_params.get("encoding"),
+                game_id,
+                resumed,
+                broadcast_rate,
+                predict,
+            )
+            send_game_id(websocket, game_id, resumed=entry is not None)
+        else:
+            client_inputs[websocket] = InputQueue()
+            # 再開できなければこのクライアント用のゲームインスタンスを作成
+            if not (resume_token and resume_game(websocket, resume_token)):
+                get_or_create_game(websocket)
+            game = client_simulations[websocket].game
+            
+            # 初期状態を送信
+            send_game_state(websocket, game)
+            schedule_client(websocket)
         
         # クライアントからのメッセージを処理
         while True:
-            data = await websocket.receive_text()
+            received = await websocket.receive()
+            received_at = time.perf_counter()
+            if received["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(received.get("code", 1000))
             try:
-                message = json.loads(data)
+                # テキストはJSON、バイナリは1バイトのオペコード形式
+                if received.get("bytes") is not None:
+                    message = decode_binary_action(received["bytes"])
+                else:
+                    message = json.loads(received["text"])
                 action = message.get("action")
+                # 既知のアクションは応答フレームまでの時間を記録する
+                if action in ACTION_OPCODES:
+                    outbox.expect_reply(action, received_at)
+                
+                # シャード利用時は担当ワーカーへ中継（新しいゲームにはここでIDを割り当てる）
+                if shard_pool is not None:
+                    if action == "start":
+                        game_id = new_game_id()
+                        shard_pool.start_game(client_sessions[websocket], message, game_id)
+                        send_game_id(websocket, game_id)
+                    else:
+                        shard_pool.send_action(client_sessions[websocket], message)
+                    continue
                 
                 # このクライアントのゲームインスタンスを取得
                 game = get_or_create_game(websocket)
+                inputs = client_inputs[websocket]
                 
                 if action == "start":
                     initial_speed_multiplier = message.get("initial_speed_multiplier", 1.0)
-                    # 完全に新しいゲームインスタンスを作成
-                    game = force_new_game(websocket)
-                    game.speed_multiplier = initial_speed_multiplier
+                    # 完全に新しいゲームインスタンスを作成（前のゲームへの未処理の入力は捨てる）
+                    game = force_new_game(websocket, message.get("randomizer", UniformRandomizer.name),
+                                          initial_speed_multiplier)
+                    inputs.take()
+                    inputs.acknowledge(message)
                     print(f"新しいゲーム開始 - 速度倍率: {initial_speed_multiplier}")
-                elif action in ["left", "right", "down", "rotate", "hard_drop"]:
-                    action_type = ActionType(action)
-                    game.perform_action(action_type)
-                elif action == "place_bomb":
-                    x = message.get("x", 0)
-                    y = message.get("y", 0)
-                    game.perform_action(ActionType.PLACE_BOMB, x=x, y=y)
-                elif action == "spawn_bomb":
-                    game.perform_action(ActionType.SPAWN_BOMB)
-                elif action == "pause":
-                    game.perform_action(ActionType.PAUSE)
-                elif action == "speed_up":
-                    game.perform_action(ActionType.SPEED_UP)
-                elif action == "speed_down":
-                    game.perform_action(ActionType.SPEED_DOWN)
+                elif action == "resync":
+                    # 差分フレームの欠落を検知したクライアントへキーフレームを再送
+                    outbox.encoder.request_keyframe()
+                else:
+                    # 到着後の最初のステップの時刻でまとめて適用し、時刻とともに記録する
+                    # （応答はその時刻の1フレームで、処理済みの通番とともに返す）
+                    simulation = client_simulations[websocket]
+                    inputs.push(message, simulation.next_step(monotonic_ms()))
+                    schedule_client(websocket)
+                    continue
                 
-                # 更新された状態をこのクライアントにのみ送信
-                await websocket.send_text(json.dumps(game.get_game_state()))
+                # 新しいゲーム・再同期への応答は送信枠を待たずにこのクライアントにのみ送信
+                send_game_state(websocket, game)
+                
+                # 落下速度・爆弾・一時停止などの変化を次のステップの更新に反映
+                schedule_client(websocket)
                 
             except json.JSONDecodeError:
-                await websocket.send_text(json.dumps({"error": "無効なJSONです"}))
+                send_client_message(websocket, {"error": "無効なJSONです"})
             except Exception as e:
-                await websocket.send_text(json.dumps({"error": str(e)}))
+                send_client_message(websocket, {"error": str(e)})
                 
     except WebSocketDisconnect:
         # クライアント切断時にゲームインスタンスを削除
         remove_client_game(websocket)
 
+@app.websocket("/spectate/{watch_id}")
+async def spectate_endpoint(websocket: WebSocket, watch_id: str):
+    """観戦用WebSocketエンドポイント（読み取り専用、フレーム形式は /ws と同じ指定方法）"""
+    await websocket.accept()
+    if watch_id not in watch_players:
+        await websocket.close(code=SPECTATE_NOT_FOUND_CLOSE_CODE)
+        return
+    channel = spectator_channels.get(watch_id)
+    if channel is None:
+        channel = spectator_channels[watch_id] = SpectatorChannel(watch_id)
+    if len(channel) >= MAX_SPECTATORS_PER_GAME:
+        await websocket.close(code=EVICT_CLOSE_CODE)
+        return
+    
+    # フレームはゲームを進める側でエンコード済みなので、観戦者の送信箱はそのまま送るだけ
+    kind = spectator_format(websocket.query_params.get("frames"), websocket.query_params.get("encoding"))
+    outbox = ClientOutbox(websocket, None)
+    outbox.start()
+    if channel.add(outbox, kind):
+        update_spectator_formats(watch_id)
+    
+    try:
+        while not outbox.closed:
+            received = await websocket.receive()
+            if received["type"] == "websocket.disconnect":
+                break
+            try:
+                if received.get("bytes") is not None:
+                    message = decode_binary_action(received["bytes"])
+                else:
+                    message = json.loads(received["text"])
+                # 差分フレームの欠落を検知した観戦者へ最新のキーフレームから送り直す（操作は受け付けない）
+                if message.get("action") == "resync":
+                    channel.catch_up(outbox, kind)
+                else:
+                    outbox.push_message(json.dumps({"error": "観戦中は操作できません"}))
+            except json.JSONDecodeError:
+                outbox.push_message(json.dumps({"error": "無効なJSONです"}))
+            except Exception as e:
+                # 短すぎるバイナリ・オブジェクト以外のJSONなどで接続を落とさない
+                outbox.push_message(json.dumps({"error": str(e)}))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        outbox.close()
+        if channel.remove(outbox, kind):
+            if not len(channel) and spectator_channels.get(watch_id) is channel:
+                del spectator_channels[watch_id]
+            update_spectator_formats(watch_id)
+
+@app.websocket("/versus/{room_id}")
+async def versus_endpoint(websocket: WebSocket, room_id: str):
+    """対戦ルームのWebSocketエンドポイント（?size=2〜8で人数、?name=で表示名、フレームは全員分をまとめたJSON）"""
+    await websocket.accept()
+    try:
+        parse_room_id(room_id)
+    except ValueError:
+        await websocket.close(code=ROOM_INVALID_CLOSE_CODE)
+        return
+    # 人数は最初のメンバーの指定で決まり、空いている最小の席に入る
+    size = room_sizes.get(room_id) or parse_room_size(websocket.query_params.get("size"))
+    members = room_members.setdefault(room_id, {})
+    slot = next((slot for slot in range(size) if slot not in members), None)
+    if slot is None:
+        await websocket.close(code=ROOM_FULL_CLOSE_CODE)
+        return
+    name = (websocket.query_params.get("name") or f"player{slot + 1}")[:16]
+    
+    # ルームフレームはエンコード済みなので、メンバーの送信箱はそのまま送るだけ
+    outbox = ClientOutbox(websocket, None)
+    client_outboxes[websocket] = outbox
+    outbox.start()
+    members[slot] = websocket
+    room_sizes[room_id] = size
+    client_rooms[websocket] = (room_id, slot)
+    send_client_message(websocket, {"type": "room_join", "room": room_id, "slot": slot, "size": size})
+    
+    try:
+        if shard_pool is not None:
+            # ルームは1つのワーカーがまとめて進める（ルームの初期状態はワーカーから届く）
+            shard_pool.join_room(room_id, slot, name, size)
+        else:
+            room = rooms.get(room_id)
+            if room is None:
+                room = rooms[room_id] = Room(room_id, size)
+            current_time = monotonic_ms()
+            room.add_player(slot, name, current_time)
+            publish_room_frame(room_id, room.encode(current_time))
+            schedule_room(room_id)
+        
+        while True:
+            received = await websocket.receive()
+            if received["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(received.get("code", 1000))
+            try:
+                if received.get("bytes") is not None:
+                    message = decode_binary_action(received["bytes"])
+                else:
+                    message = json.loads(received["text"])
+                
+                if shard_pool is not None:
+                    shard_pool.room_action(room_id, slot, message)
+                    continue
+                
+                # 到着時刻まで全員のゲームを進めてから適用し、応答は送信枠を待たずに全メンバーへ送る
+                current_time = monotonic_ms()
+                room = rooms[room_id]
+                room.apply(slot, message, current_time)
+                publish_room_frame(room_id, room.encode(current_time))
+                schedule_room(room_id)
+                
+            except json.JSONDecodeError:
+                send_client_message(websocket, {"error": "無効なJSONです"})
+            except Exception as e:
+                send_client_message(websocket, {"error": str(e)})
+    
+    except WebSocketDisconnect:
+        remove_client_game(websocket)
+
 # 静的ファイルの配信（APIエンドポイントの後にマウント）
 import os
 from fastapi.responses import FileResponse
@@ -0,0 +1,260 @@
+import asyncio
+import bisect
+from abc import ABC, abstractmethod
+import functools
+import math
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# テキスト形式（Prometheusのexposition format）のContent-Type
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 処理時間のヒストグラムの既定のバケット（秒）
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5)
+# イベントループの遅延を測る間隔（秒）
+EVENT_LOOP_PROBE_SEC = 0.1
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str],
+                   extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class CounterValue:
+    """単調増加する値（ラベルの組ごとに1つ）"""
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+
+class GaugeValue:
+    """任意に増減する値（ラベルの組ごとに1つ）"""
+
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+
+class HistogramValue:
+    """観測値のバケットごとの件数・合計・件数（ラベルの組ごとに1つ）"""
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 各バケットに入った件数（累積ではない、最後は+Inf）
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+
+class Metric(ABC):
+    """ラベルの組ごとの値を持つメトリクス（labels()で取得した値を保持して使うと速い）"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[LabelValues, Any] = {}
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+
+    @abstractmethod
+    def _new_child(self) -> Any:
+        """ラベルの組1つ分の値を作る"""
+
+    def labels(self, *values: str) -> Any:
+        """ラベルの値の組に対応する値（初回に作成）"""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"ラベルの数が一致しません: {self.name}")
+            child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _samples(self) -> Iterable[Tuple[str, LabelValues, Optional[Tuple[str, str]], float]]:
+        """(名前の接尾辞, ラベルの値, 追加ラベル, 値)を列挙"""
+        for values, child in list(self._children.items()):
+            yield "", values, None, child.value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, values, extra, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, values, extra)} "
+                         f"{_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _new_child(self) -> CounterValue:
+        return CounterValue()
+
+    def inc(self, amount: float = 1):
+        """ラベルなしのカウンタを増やす"""
+        self._children[()].inc(amount)
+
+
+class Gauge(Metric):
+    """現在値のメトリクス（collectを渡すと出力のたびに {ラベルの値: 値} を集計する）"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                 collect: Optional[Callable[[], Dict[LabelValues, float]]] = None):
+        super().__init__(name, help_text, labelnames)
+        self.collect = collect
+
+    def _new_child(self) -> GaugeValue:
+        return GaugeValue()
+
+    def set(self, value: float):
+        """ラベルなしのゲージを設定"""
+        self._children[()].set(value)
+
+    def _samples(self):
+        if self.collect is None:
+            yield from super()._samples()
+            return
+        for values, value in self.collect().items():
+            yield "", values, None, value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help_text, labelnames)
+
+    def _new_child(self) -> HistogramValue:
+        return HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        """ラベルなしのヒストグラムに観測値を追加"""
+        self._children[()].observe(value)
+
+    def _samples(self):
+        for values, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), list(child.counts)):
+                cumulative += count
+                yield "_bucket", values, ("le", _format_value(bound)), cumulative
+            yield "_sum", values, None, child.sum
+            yield "_count", values, None, child.count
+
+
+class MetricsRegistry:
+    """メトリクスを登録し、まとめてテキスト形式で出力する"""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"メトリクス名が重複しています: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+              collect: Optional[Callable[[], Dict[LabelValues, float]]] = None) -> Gauge:
+        return self.register(Gauge(name, help_text, labelnames, collect))
+
+    def histogram(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help_text, labelnames, buckets))
+
+    def render(self) -> str:
+        """全メトリクスをテキスト形式で出力"""
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                print(f"メトリクス {metric.name} の出力エラー: {e}")
+        return "\n".join(lines) + "\n"
+
+
+# プロセス全体のメトリクス
+REGISTRY = MetricsRegistry()
+
+UPDATE_ITERATION_SECONDS = REGISTRY.histogram(
+    "tetris_update_iteration_seconds", "ゲーム更新タスクの1回の処理時間")
+EVENT_LOOP_LAG_SECONDS = REGISTRY.histogram(
+    "tetris_event_loop_lag_seconds", "イベントループの遅延（予定した再開時刻からの遅れ）")
+FRAMES_SENT = REGISTRY.counter(
+    "tetris_frames_sent_total", "WebSocketで送信したメッセージ数")
+BYTES_SENT = REGISTRY.counter(
+    "tetris_bytes_sent_total", "WebSocketで送信したバイト数")
+ACTION_LATENCY_SECONDS = REGISTRY.histogram(
+    "tetris_action_latency_seconds", "アクションの受信から応答フレームの送信までの時間", ("action",))
+FIRESTORE_CALL_SECONDS = REGISTRY.histogram(
+    "tetris_firestore_call_seconds", "Firestore呼び出しの所要時間", ("operation",))
+FIRESTORE_ERRORS = REGISTRY.counter(
+    "tetris_firestore_errors_total", "Firestore呼び出しのエラー数", ("operation",))
+
+
+def observe_firestore(operation: str):
+    """Firestore呼び出しの所要時間とエラー数を記録するデコレータ"""
+    latency = FIRESTORE_CALL_SECONDS.labels(operation)
+    errors = FIRESTORE_ERRORS.labels(operation)
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                latency.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+async def monitor_event_loop(interval_sec: float = EVENT_LOOP_PROBE_SEC):
+    """一定間隔で眠り、予定より遅れて再開した時間をイベントループの遅延として記録"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval_sec)
+        EVENT_LOOP_LAG_SECONDS.observe(max(0.0, time.perf_counter() - started - interval_sec))
@@ -0,0 +1,177 @@
+import asyncio
+import time
+from collections import deque
+from typing import Any, Deque, Optional, Tuple
+
+from metrics import ACTION_LATENCY_SECONDS, BYTES_SENT, FRAMES_SENT
+from scheduler import monotonic_ms
+
+# 未送信の状態がこの時間以上送れなければ接続を切断する（ミリ秒）
+DEFAULT_EVICT_AFTER_MS = 10000
+# エラーなど状態以外のメッセージの最大保持数
+DEFAULT_MAX_MESSAGES = 16
+# 送信が追いつかないクライアントを切断するときのクローズコード（Try Again Later）
+EVICT_CLOSE_CODE = 1013
+
+
+class ClientOutbox:
+    """接続ごとの送信箱（1つの書き込みタスクで順番に送信）
+
+    ゲーム状態は最新のものだけを保持し（latest wins）、送信時にエンコードする。
+    シャードワーカーでエンコード済みのフレームも同様に最新の1つだけを保持する。
+    送信中に届いた状態は上書きされ、上書きされた回数を coalesced_frames に数える。
+    """
+
+    def __init__(self, websocket: Any, encoder: Any,
+                 evict_after_ms: int = DEFAULT_EVICT_AFTER_MS,
+                 max_messages: int = DEFAULT_MAX_MESSAGES):
+        self.websocket = websocket
+        self.encoder = encoder
+        self.evict_after_ms = evict_after_ms
+
+        self._game: Any = None  # 未送信の最新ゲーム状態
+        self._payload: Any = None  # 未送信の最新エンコード済みフレーム
+        self._pending_since: Optional[int] = None  # 未送信データがあり送信が進んでいない起点時刻
+        self._messages: Deque[str] = deque(maxlen=max_messages)
+        # 応答フレームを待っているアクション（アクション名, 受信時刻perf_counter）
+        self._awaiting_replies: Deque[Tuple[str, float]] = deque(maxlen=max_messages)
+        self._ready = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.closed = False
+
+        # 統計
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.coalesced_frames = 0
+        self.dropped_messages = 0
+
+    def start(self):
+        """書き込みタスクを開始"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._writer())
+
+    @property
+    def depth(self) -> int:
+        """未送信のメッセージ数（状態は最大1つ）"""
+        return (len(self._messages) + (1 if self._game is not None else 0) +
+                (1 if self._payload is not None else 0))
+
+    def push_state(self, game: Any):
+        """ゲーム状態の送信を予約（未送信の状態があれば置き換える）"""
+        if self.closed:
+            return
+        if self._game is not None:
+            self.coalesced_frames += 1
+        if self._pending_since is None:
+            self._pending_since = monotonic_ms()
+        self._game = game
+        self._ready.set()
+
+    def push_payload(self, payload: Any):
+        """エンコード済みフレームの送信を予約（未送信のフレームがあれば置き換える）"""
+        if self.closed:
+            return
+        if self._payload is not None:
+            self.coalesced_frames += 1
+        if self._pending_since is None:
+            self._pending_since = monotonic_ms()
+        self._payload = payload
+        self._ready.set()
+
+    def push_message(self, text: str):
+        """状態以外のテキストメッセージ（エラーなど）の送信を予約"""
+        if self.closed:
+            return
+        if len(self._messages) == self._messages.maxlen:
+            self.dropped_messages += 1
+        self._messages.append(text)
+        if self._pending_since is None:
+            self._pending_since = monotonic_ms()
+        self._ready.set()
+
+    def expect_reply(self, action: str, received_at: float):
+        """アクションを受信した（次に送る状態フレームまでの時間を応答遅延として記録する）"""
+        self._awaiting_replies.append((action, received_at))
+
+    def _observe_replies(self, sent: bool):
+        """状態フレームを送った時点で、待っていたアクションの応答遅延を記録"""
+        if not self._awaiting_replies:
+            return
+        if sent:
+            now = time.perf_counter()
+            for action, received_at in self._awaiting_replies:
+                ACTION_LATENCY_SECONDS.labels(action).observe(now - received_at)
+        # 状態が変わらず送らなかった場合は応答なしとして記録しない
+        self._awaiting_replies.clear()
+
+    def is_stalled(self, now: Optional[int] = None) -> bool:
+        """未送信のデータが切断閾値を超えて滞留しているか"""
+        if self._pending_since is None:
+            return False
+        if now is None:
+            now = monotonic_ms()
+        return now - self._pending_since >= self.evict_after_ms
+
+    async def _send(self, payload: Any):
+        if isinstance(payload, bytes):
+            await self.websocket.send_bytes(payload)
+        else:
+            await self.websocket.send_text(payload)
+        self.frames_sent += 1
+        self.bytes_sent += len(payload)
+        FRAMES_SENT.inc()
+        BYTES_SENT.inc(len(payload))
+        self._mark_progress()
+
+    def _mark_progress(self):
+        """送信が進んだ時点で滞留の起点を更新"""
+        self._pending_since = monotonic_ms() if self.depth else None
+
+    async def _writer(self):
+        """送信箱の中身を順番に送る書き込みタスク"""
+        try:
+            while not self.closed:
+                await self._ready.wait()
+                self._ready.clear()
+
+                while self._messages:
+                    await self._send(self._messages.popleft())
+
+                payload = self._payload
+                self._payload = None
+                if payload is not None:
+                    await self._send(payload)
+                    self._observe_replies(True)
+
+                game = self._game
+                self._game = None
+                if game is not None:
+                    payload = self.encoder.encode(game)
+                    if payload is not None:
+                        await self._send(payload)
+                    else:
+                        self._mark_progress()
+                    self._observe_replies(payload is not None)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"クライアント {self.websocket} への送信エラー: {e}")
+        finally:
+            self.closed = True
+
+    def close(self, code: Optional[int] = None):
+        """書き込みタスクを停止（codeを指定した場合はWebSocketも閉じる）"""
+        self.closed = True
+        self._game = None
+        self._payload = None
+        self._messages.clear()
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+        if code is not None:
+            asyncio.create_task(self._close_websocket(code))
+
+    async def _close_websocket(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
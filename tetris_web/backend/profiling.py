@@ -0,0 +1,391 @@
+import functools
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from game import TetrisGame
+from outbox import ClientOutbox
+from protocol import BinaryStateEncoder, DeltaFrameEncoder, JsonStateEncoder
+from scheduler import monotonic_ms
+from simulation import Simulation
+
+# サンプリング・メモリ割り当て追跡の既定の期間と上限（秒）
+DEFAULT_PROFILE_SECONDS = 10
+MAX_PROFILE_SECONDS = 60
+# スタックを採取する既定の間隔と下限（ミリ秒）
+DEFAULT_SAMPLE_INTERVAL_MS = 5
+MIN_SAMPLE_INTERVAL_MS = 1
+# レポートに載せる行数
+REPORT_TOP = 30
+
+# 区間計測の対象（所有者, 属性名, 区間名）。計測中だけ計測用の関数に置き換える
+PHASE_TARGETS = (
+    (Simulation, "advance_to", "simulation.advance_to"),
+    (TetrisGame, "update", "game.update"),
+    (TetrisGame, "move_piece", "game.move_piece"),
+    (TetrisGame, "place_piece", "game.place_piece"),
+    (TetrisGame, "clear_lines", "game.clear_lines"),
+    (TetrisGame, "spawn_new_piece", "game.spawn_new_piece"),
+    (TetrisGame, "check_stack_height", "game.check_stack_height"),
+    (TetrisGame, "explode_bombs", "game.explode_bombs"),
+    (TetrisGame, "get_game_state", "game.get_game_state"),
+    (JsonStateEncoder, "encode", "encode.json"),
+    (DeltaFrameEncoder, "encode", "encode.delta"),
+    (BinaryStateEncoder, "encode", "encode.binary"),
+    (json, "dumps", "json.dumps"),
+    (ClientOutbox, "_send", "outbox.send"),
+)
+
+# メモリ割り当てをセッションごとに数える対象（所有者, 属性名, 引数からゲームを取り出す関数）
+ALLOCATION_TARGETS = (
+    (Simulation, "advance_to", lambda simulation: simulation.game),
+    (Simulation, "apply", lambda simulation: simulation.game),
+    (TetrisGame, "get_game_state", lambda game: game),
+)
+
+# 置き換え中の属性ごとの差し込み（下から順に重なる）
+_patches: Dict[Tuple[int, str], List["_Patch"]] = {}
+
+
+class _Patch:
+    """属性を包む関数への置き換え（重ねて差し込み、どの順でも外せる）"""
+
+    def __init__(self, owner: Any, name: str, make_wrapper: Callable[[Callable], Callable]):
+        self.owner = owner
+        self.name = name
+        self.original = getattr(owner, name)
+        call = lambda *args, **kwargs: self.original(*args, **kwargs)
+        wrapper = make_wrapper(call)
+        self.wrapper = functools.wraps(self.original)(wrapper)
+
+    def install(self):
+        _patches.setdefault((id(self.owner), self.name), []).append(self)
+        setattr(self.owner, self.name, self.wrapper)
+
+    def remove(self):
+        stack = _patches[(id(self.owner), self.name)]
+        index = stack.index(self)
+        if index == len(stack) - 1:
+            setattr(self.owner, self.name, self.original)
+        else:
+            # 上に重なった差し込みが、この差し込みの下の関数を呼ぶようにする
+            stack[index + 1].original = self.original
+        stack.pop(index)
+        if not stack:
+            del _patches[(id(self.owner), self.name)]
+
+
+def _timed(call: Callable, stat: List[float], is_async: bool) -> Callable:
+    """呼び出しの回数・合計時間・最大時間をstatに加算する関数"""
+    def record(started: float):
+        elapsed = time.perf_counter() - started
+        stat[0] += 1
+        stat[1] += elapsed
+        if elapsed > stat[2]:
+            stat[2] = elapsed
+
+    if is_async:
+        async def async_wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await call(*args, **kwargs)
+            finally:
+                record(started)
+        return async_wrapper
+
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return call(*args, **kwargs)
+        finally:
+            record(started)
+    return wrapper
+
+
+class PhaseTimers:
+    """ゲーム更新・状態送信の区間ごとの処理時間の計測
+
+    有効にしている間だけ対象のメソッドを計測用の関数に置き換えるので、
+    無効時は元のメソッドがそのまま呼ばれ、計測のコストはかからない。
+    時間は呼び出しの内側の区間も含む（game.update には check_stack_height などが含まれる）。
+    """
+
+    def __init__(self):
+        self._patches: List[_Patch] = []
+        # 区間名 → [呼び出し回数, 合計秒, 最大秒]
+        self._stats: Dict[str, List[float]] = {}
+        self._started_at: Optional[float] = None
+        self._elapsed = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self._patches)
+
+    def enable(self):
+        """計測を開始（それまでの計測値は消す）"""
+        if self.enabled:
+            return
+        self._stats = {}
+        self._elapsed = 0.0
+        self._started_at = time.perf_counter()
+        for owner, name, phase in PHASE_TARGETS:
+            stat = self._stats.setdefault(phase, [0, 0.0, 0.0])
+            is_async = inspect.iscoroutinefunction(getattr(owner, name))
+            patch = _Patch(owner, name,
+                           lambda call, stat=stat, is_async=is_async: _timed(call, stat, is_async))
+            patch.install()
+            self._patches.append(patch)
+
+    def disable(self):
+        """計測を停止して元のメソッドに戻す（計測値はreport()で引き続き取得できる）"""
+        for patch in reversed(self._patches):
+            patch.remove()
+        self._patches = []
+        if self._started_at is not None:
+            self._elapsed += time.perf_counter() - self._started_at
+            self._started_at = None
+
+    def report(self) -> Dict[str, Any]:
+        """区間ごとの回数・合計・平均・最大（合計時間の長い順）"""
+        elapsed = self._elapsed
+        if self._started_at is not None:
+            elapsed += time.perf_counter() - self._started_at
+        phases = [
+            {
+                "phase": phase,
+                "calls": int(calls),
+                "total_ms": total * 1000,
+                "mean_us": total / calls * 1e6 if calls else None,
+                "max_us": peak * 1e6,
+            }
+            for phase, (calls, total, peak) in self._stats.items() if calls
+        ]
+        phases.sort(key=lambda entry: entry["total_ms"], reverse=True)
+        return {"enabled": self.enabled, "elapsed_sec": elapsed, "phases": phases}
+
+
+class StackSampler:
+    """指定したスレッドのスタックを一定間隔で採取するサンプリングプロファイラ（別スレッドで動く）"""
+
+    def __init__(self, thread_id: int, interval_ms: float = DEFAULT_SAMPLE_INTERVAL_MS):
+        self.thread_id = thread_id
+        self.interval_ms = interval_ms
+        self.samples = 0
+        self.stacks: Counter = Counter()
+        self._labels: Dict[Any, str] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _label(self, code: Any) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            self._labels[code] = label
+        return label
+
+    def _run(self):
+        interval = self.interval_ms / 1000
+        while not self._stop.wait(interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                stack.reverse()
+                self.stacks[";".join(stack)] += 1
+                self.samples += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="tetris-stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> Dict[str, Any]:
+        """採取を止め、スタックごとの採取回数を返す"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return {"samples": self.samples, "interval_ms": self.interval_ms, "stacks": dict(self.stacks)}
+
+
+class AllocationTracker:
+    """tracemallocによるメモリ割り当ての追跡（開始時と終了時のスナップショットの差分）
+
+    追跡中はゲームの更新・操作・状態取得を包み、前後の確保量の差をセッション（ゲーム）ごとに数える。
+    label_ofはゲームからセッション名（ゲームIDなど）を求める関数。
+    """
+
+    def __init__(self, label_of: Optional[Callable[[TetrisGame], Optional[str]]] = None):
+        self.label_of = label_of
+        self._patches: List[_Patch] = []
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+        self._started_tracing = False
+        # ゲームのid → [セッション名, 確保量の増減の合計, 1回の呼び出し中の最大確保量, 呼び出し回数]
+        self._sessions: Dict[int, List[Any]] = {}
+
+    def _session(self, game: TetrisGame) -> List[Any]:
+        entry = self._sessions.get(id(game))
+        if entry is None:
+            label = self.label_of(game) if self.label_of is not None else None
+            entry = [label or f"game-{id(game):x}", 0, 0, 0]
+            self._sessions[id(game)] = entry
+        return entry
+
+    def _counted(self, call: Callable, game_of: Callable[[Any], TetrisGame]) -> Callable:
+        def wrapper(target, *args, **kwargs):
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            try:
+                return call(target, *args, **kwargs)
+            finally:
+                current, peak = tracemalloc.get_traced_memory()
+                entry = self._session(game_of(target))
+                entry[1] += current - before
+                entry[2] = max(entry[2], peak - before)
+                entry[3] += 1
+        return wrapper
+
+    def start(self):
+        self._started_tracing = not tracemalloc.is_tracing()
+        if self._started_tracing:
+            tracemalloc.start()
+        self._snapshot = tracemalloc.take_snapshot()
+        for owner, name, game_of in ALLOCATION_TARGETS:
+            patch = _Patch(owner, name, lambda call, game_of=game_of: self._counted(call, game_of))
+            patch.install()
+            self._patches.append(patch)
+
+    def stop(self) -> Dict[str, Any]:
+        """追跡を止め、コードの行ごと・セッションごとの確保量の差分を返す"""
+        for patch in reversed(self._patches):
+            patch.remove()
+        self._patches = []
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        if self._started_tracing:
+            tracemalloc.stop()
+        # 追跡自体の確保は除く
+        snapshot = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),
+                                           tracemalloc.Filter(False, __file__)))
+        top = [
+            {"location": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+             "size_diff": stat.size_diff, "count_diff": stat.count_diff, "size": stat.size}
+            for stat in snapshot.compare_to(self._snapshot, "lineno")[:REPORT_TOP]
+        ]
+        sessions = sorted(self._sessions.values(), key=lambda entry: entry[1], reverse=True)
+        return {
+            "traced_bytes": current,
+            "traced_peak_bytes": peak,
+            "top": top,
+            "sessions": [
+                {"session": label, "net_bytes": net, "max_call_bytes": call_peak, "calls": calls}
+                for label, net, call_peak, calls in sessions[:REPORT_TOP]
+            ],
+            "session_count": len(sessions),
+        }
+
+
+class Profiler:
+    """区間計測・サンプリング・メモリ割り当て追跡の制御（プロセスごとに1つ）
+
+    サンプリングとメモリ割り当て追跡は一定期間だけ行うジョブで、同時に1つだけ実行できる。
+    ジョブは start_job() で開始し、job_deadline を過ぎたら finish_job() で結果を受け取る。
+    """
+
+    def __init__(self, label_of: Optional[Callable[[TetrisGame], Optional[str]]] = None):
+        self.phases = PhaseTimers()
+        self.label_of = label_of
+        self.job_kind: Optional[str] = None
+        self.job_deadline: Optional[int] = None  # ジョブを終える時刻（monotonic_ms）
+        self._job: Any = None
+        self._job_started: Optional[float] = None
+
+    def set_phases(self, enabled: Optional[bool]) -> Dict[str, Any]:
+        """区間計測を有効・無効にして計測値を返す（Noneなら切り替えない）"""
+        if enabled is True:
+            self.phases.enable()
+        elif enabled is False:
+            self.phases.disable()
+        return self.phases.report()
+
+    def start_job(self, kind: str, seconds: float = DEFAULT_PROFILE_SECONDS,
+                  interval_ms: float = DEFAULT_SAMPLE_INTERVAL_MS):
+        """サンプリング（sample）またはメモリ割り当て追跡（allocations）を開始"""
+        if self._job is not None:
+            raise ValueError(f"別の計測（{self.job_kind}）を実行中です")
+        if not 0 < seconds <= MAX_PROFILE_SECONDS:
+            raise ValueError(f"計測期間は{MAX_PROFILE_SECONDS}秒以内で指定してください")
+        if kind == "sample":
+            self._job = StackSampler(threading.get_ident(), max(interval_ms, MIN_SAMPLE_INTERVAL_MS))
+        elif kind == "allocations":
+            self._job = AllocationTracker(self.label_of)
+        else:
+            raise ValueError(f"不明な計測の種類です: {kind}")
+        self._job.start()
+        self.job_kind = kind
+        self.job_deadline = monotonic_ms() + int(seconds * 1000)
+        self._job_started = time.perf_counter()
+
+    def finish_job(self) -> Dict[str, Any]:
+        """実行中のジョブを終えて結果を返す"""
+        job, kind = self._job, self.job_kind
+        report = job.stop()
+        report["kind"] = kind
+        report["seconds"] = time.perf_counter() - self._job_started
+        self._job = self.job_kind = self.job_deadline = self._job_started = None
+        return report
+
+
+def _format_bytes(size: float) -> str:
+    return f"{size / 1024:+.1f} KiB"
+
+
+def format_report(reports: Dict[str, Dict[str, Any]], folded: bool = False) -> str:
+    """プロセスごとのジョブ結果をテキストにする
+
+    foldedを指定するとサンプリング結果をflamegraph.pl・speedscopeで読める
+    折りたたみ形式（"プロセス;関数;...;関数 回数"）で出力する。
+    """
+    lines: List[str] = []
+    if folded:
+        for process, report in reports.items():
+            for stack, count in sorted(report.get("stacks", {}).items()):
+                lines.append(f"{process};{stack} {count}")
+        return "\n".join(lines) + "\n"
+
+    for process, report in reports.items():
+        lines.append(f"=== {process} ===")
+        if "error" in report:
+            lines.append(f"エラー: {report['error']}")
+        elif report["kind"] == "sample":
+            samples = report["samples"]
+            lines.append(f"サンプル数: {samples}（{report['seconds']:.1f}秒, 間隔 {report['interval_ms']}ms）")
+            inclusive: Counter = Counter()
+            exclusive: Counter = Counter()
+            for stack, count in report["stacks"].items():
+                frames = stack.split(";")
+                exclusive[frames[-1]] += count
+                for frame in set(frames):
+                    inclusive[frame] += count
+            for title, counts in (("自身の時間", exclusive), ("呼び出し先を含む時間", inclusive)):
+                lines.append(f"--- {title}（上位{REPORT_TOP}件） ---")
+                for frame, count in counts.most_common(REPORT_TOP):
+                    lines.append(f"{count / samples * 100 if samples else 0:6.1f}%  {count:7d}  {frame}")
+        else:
+            lines.append(f"追跡中の確保量: {report['traced_bytes'] / 1024:.1f} KiB"
+                         f"（最大 {report['traced_peak_bytes'] / 1024:.1f} KiB, {report['seconds']:.1f}秒）")
+            lines.append(f"--- 行ごとの確保量の増減（上位{REPORT_TOP}件） ---")
+            for entry in report["top"]:
+                lines.append(f"{_format_bytes(entry['size_diff']):>14}  {entry['count_diff']:+8d}  {entry['location']}")
+            lines.append(f"--- セッションごとの確保量の増減（{report['session_count']}セッション中 上位{REPORT_TOP}件） ---")
+            for entry in report["sessions"]:
+                lines.append(f"{_format_bytes(entry['net_bytes']):>14}  呼び出し中の最大 {entry['max_call_bytes'] / 1024:.1f} KiB"
+                             f"  {entry['calls']:7d}回  {entry['session']}")
+        lines.append("")
+    return "\n".join(lines)
@@ -0,0 +1,376 @@
+import json
+import struct
+import zlib
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from game import (BOARD_HEIGHT, BOARD_WIDTH, BOMB_RED, GARBAGE_COLOR, ROTATIONS, SOFT_DROP_CELLS,
+                  TETROMINO_COLORS, WALL_KICKS, ActionType, TetrisGame)
+
+# フレーム種別
+FRAME_KEY = "key"
+FRAME_DELTA = "delta"
+
+# 差分フレームを何回送ったらキーフレームを挟むか（復旧用）
+DEFAULT_KEYFRAME_INTERVAL = 300
+
+# バイナリ形式のフレーム種別（処理済みの入力の通番付きは末尾に4バイトの通番が続き、
+# 状態ハッシュ付きはさらにその後ろに4バイトのハッシュが続く）
+BINARY_FRAME_STATE = 1
+BINARY_FRAME_STATE_ACK = 2
+BINARY_FRAME_STATE_HASH = 3
+
+# バイナリ形式のアクションのオペコードに立てるビット（オペコードの直後に4バイトの通番が続く）
+OPCODE_SEQ_FLAG = 0x80
+
+# バイナリ形式のアクションのオペコード（1バイト）
+ACTION_OPCODES = {
+    "start": 0x01,
+    "left": 0x02,
+    "right": 0x03,
+    "down": 0x04,
+    "rotate": 0x05,
+    "hard_drop": 0x06,
+    "place_bomb": 0x07,
+    "spawn_bomb": 0x08,
+    "pause": 0x09,
+    "speed_up": 0x0A,
+    "speed_down": 0x0B,
+    "resync": 0x0C,
+}
+OPCODE_ACTIONS = {opcode: action for action, opcode in ACTION_OPCODES.items()}
+
+# ボードのセル（RGBタプル）と1バイトの色番号の対応（0は空セル）
+COLOR_INDEX: Dict[Any, int] = {0: 0, BOMB_RED: len(TETROMINO_COLORS) + 1,
+                               GARBAGE_COLOR: len(TETROMINO_COLORS) + 2}
+COLOR_INDEX.update({color: i + 1 for i, color in enumerate(TETROMINO_COLORS)})
+
+# バイナリ状態フレームのヘッダ（リトルエンディアン、29バイト）
+# 種別, seq, フラグ, スコア, レベル, ライン数, 爆弾所持数, 速度倍率, 今回消去ライン数,
+# 現在ピースx, y, 形状番号, 回転, 次ピース形状番号, 爆弾数
+STATE_HEADER = struct.Struct("<BIBIHIHfBbbbBbB")
+# ヘッダ先頭の種別とseq（接続ごとに異なる部分）
+FRAME_PREFIX = struct.Struct("<BI")
+# 入力の通番（アクションのオペコードの後・状態フレームの末尾）
+INPUT_SEQ = struct.Struct("<I")
+BOMB_RECORD = struct.Struct("<bbB")
+MAX_BINARY_BOMBS = 255
+
+# 状態ハッシュ（CRC32）の対象: 行ごとの占有ビットマスク（上の行から）と現在のピースの形状番号・回転・x・y
+HASH_ROWS = struct.Struct(f"<{BOARD_HEIGHT}H")
+HASH_PIECE = struct.Struct("<bBbb")
+
+# フラグのビット
+FLAG_GAME_OVER = 0x01
+FLAG_PAUSED = 0x02
+FLAG_HAS_CURRENT = 0x04
+FLAG_HAS_NEXT = 0x08
+
+FramePayload = Union[str, bytes]
+
+
+def state_hash(game: TetrisGame) -> int:
+    """盤面の占有と現在のピースの状態ハッシュ（版ごとに1回だけ計算する）
+
+    クライアントの予測・差分の復元結果とサーバーの状態が一致しているかを、状態を送らずに確かめるために使う。
+    """
+    return game.cached("hash", lambda: _build_state_hash(game))
+
+
+def _build_state_hash(game: TetrisGame) -> int:
+    data = HASH_ROWS.pack(*game.row_masks)
+    piece = game.current_piece
+    if piece is not None:
+        data += HASH_PIECE.pack(piece.shape_idx, piece.rotation % 4, piece.x, piece.y)
+    return zlib.crc32(data)
+
+
+def build_piece_rules() -> Dict[str, Any]:
+    """クライアントが操作を予測するためのピースの規則（出現位置・回転表・壁キックの順・↓1回の落下マス数）"""
+    return {
+        "type": "rules",
+        "board": [BOARD_WIDTH, BOARD_HEIGHT],
+        "spawn": [BOARD_WIDTH // 2 - 1, 0],
+        # 形状番号（爆弾ピースは-1）→ 4回転分の占有セルの(dx, dy)
+        "rotations": {str(shape_idx): [[list(cell) for cell in rotation.cells] for rotation in rotations]
+                      for shape_idx, rotations in ROTATIONS.items()},
+        "kicks": [list(kick) for kick in WALL_KICKS],
+        "soft_drop": SOFT_DROP_CELLS,
+    }
+
+
+# 予測モードの接続に最初に送る規則メッセージ（変わらないので1回だけエンコードする）
+PIECE_RULES_MESSAGE = json.dumps(build_piece_rules())
+
+
+class JsonStateEncoder:
+    """従来形式のエンコーダ（状態が変わるたびにゲーム状態をそのまま送る）
+
+    エンコード結果はゲームの版ごとに1つだけ作り、同じゲームを送る他の接続・観戦者と共有する。
+    ackを設定すると、処理済みの入力の通番を "ack" としてフレームの先頭に付ける。
+    hashes=True では状態ハッシュを "hash" として付ける。
+    """
+
+    def __init__(self, hashes: bool = False):
+        self.hashes = hashes
+        self.ack: Optional[int] = None  # 処理済みの入力の通番
+        self._sent_version: Optional[int] = None  # 最後に送った状態の版
+        self._sent_ack: Optional[int] = None
+
+    def encode(self, game: TetrisGame) -> Optional[FramePayload]:
+        """ゲーム状態をJSONに変換（前回から版も処理済みの通番も変わっていなければNone）"""
+        if game.state_version == self._sent_version and self.ack == self._sent_ack:
+            return None
+        self._sent_version = game.state_version
+        self._sent_ack = self.ack
+        payload = game.cached("json", lambda: json.dumps(game.get_game_state()))
+        if self.hashes:
+            payload = f'{{"hash": {state_hash(game)}, {payload[1:]}'
+        if self.ack is None:
+            return payload
+        return f'{{"ack": {self.ack}, {payload[1:]}'
+
+    def request_keyframe(self):
+        """次のフレームを変化の有無にかかわらず送る"""
+        self._sent_version = None
+
+
+class DeltaFrameEncoder:
+    """キーフレーム＋差分フレームのエンコーダ（接続ごとに1つ）
+
+    キーフレーム: {"type": "key", "seq": n, "state": {...}}
+    差分フレーム: {"type": "delta", "seq": n, "cells": [[x, y, セル値], ...], "fields": {...}}
+    変化がない場合はフレームを生成しない（seqも進めない）。ackを設定するとフレームに "ack" を付け、
+    状態が変わらなくても処理済みの通番が進んだときは空の差分フレームで返す。
+    hashes=True では適用後の状態の状態ハッシュを "hash" として付ける（復元結果の検証用）。
+    """
+
+    def __init__(self, keyframe_interval: int = DEFAULT_KEYFRAME_INTERVAL, hashes: bool = False):
+        self.keyframe_interval = keyframe_interval
+        self.seq = 0
+        self._board: Optional[List[Tuple[Any, ...]]] = None  # 最後に送ったボード
+        self._fields: Dict[str, Any] = {}  # 最後に送ったボード以外の値
+        self._frames_since_key = 0
+        self._force_key = True
+        self._sent_version: Optional[int] = None  # 最後に差分を調べた状態の版
+        self.hashes = hashes
+        self.ack: Optional[int] = None  # 処理済みの入力の通番
+        self._sent_ack: Optional[int] = None
+
+    def request_keyframe(self):
+        """次のフレームをキーフレームにする（クライアントからの再同期要求など）"""
+        self._force_key = True
+
+    def _remember(self, state: Dict[str, Any]):
+        """送信した状態を差分計算用に保存（ボードは行をコピー）"""
+        self._board = [tuple(row) for row in state["board"]]
+        self._fields = {key: value for key, value in state.items() if key != "board"}
+
+    def _keyframe(self, state: Dict[str, Any]) -> Dict[str, Any]:
+        self._remember(state)
+        self._force_key = False
+        self._frames_since_key = 0
+        self.seq += 1
+        return {"type": FRAME_KEY, "seq": self.seq, "state": state}
+
+    def _diff_board(self, board: List[List[Any]]) -> List[List[Any]]:
+        """変化したセルを[x, y, セル値]のリストで返す"""
+        cells = []
+        for y, row in enumerate(board):
+            old_row = self._board[y]
+            if old_row == tuple(row):
+                continue
+            for x, cell in enumerate(row):
+                if cell != old_row[x]:
+                    cells.append([x, y, cell])
+        return cells
+
+    def encode_frame(self, state: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """ゲーム状態からフレームを生成（変化がなければNone）"""
+        if (self._force_key or self._board is None or
+                self._frames_since_key >= self.keyframe_interval):
+            return self._keyframe(state)
+
+        cells = self._diff_board(state["board"])
+        fields = {key: value for key, value in state.items()
+                  if key != "board" and self._fields.get(key) != value}
+        if not cells and not fields:
+            return None
+
+        self._board = [tuple(row) for row in state["board"]] if cells else self._board
+        self._fields.update(fields)
+        self._frames_since_key += 1
+        self.seq += 1
+
+        frame: Dict[str, Any] = {"type": FRAME_DELTA, "seq": self.seq}
+        if cells:
+            frame["cells"] = cells
+        if fields:
+            frame["fields"] = fields
+        return frame
+
+    def encode(self, game: TetrisGame) -> Optional[FramePayload]:
+        """ゲーム状態からフレームを生成してJSONに変換（版が変わっていなければ差分を調べずにNone）"""
+        if (game.state_version == self._sent_version and self.ack == self._sent_ack and
+                not self._force_key and self._frames_since_key < self.keyframe_interval):
+            return None
+        self._sent_version = game.state_version
+        frame = self.encode_frame(game.get_game_state())
+        if frame is None and self.ack != self._sent_ack:
+            self._frames_since_key += 1
+            self.seq += 1
+            frame = {"type": FRAME_DELTA, "seq": self.seq}
+        if frame is None:
+            return None
+        if self.ack is not None:
+            frame["ack"] = self.ack
+        if self.hashes:
+            frame["hash"] = state_hash(game)
+        self._sent_ack = self.ack
+        return json.dumps(frame)
+
+
+class BinaryStateEncoder:
+    """固定レイアウトのバイナリ状態フレームのエンコーダ（接続ごとに1つ）
+
+    ヘッダ（STATE_HEADER）の後にボード（1セル1バイトの色番号、行優先）と
+    爆弾（x, y, active の3バイトずつ）が続く。ピースの形状は形状番号と回転数で表し、
+    クライアント側で回転を再現する。ゲームから直接、事前確保したバッファに書き込む。
+    接続ごとのseqを除いた部分はゲームの版ごとに1つだけ作り、同じゲームを送る接続で共有する。
+    ackを設定すると種別を BINARY_FRAME_STATE_ACK にし、末尾に処理済みの入力の通番（4バイト）を付ける。
+    hashes=True では種別を BINARY_FRAME_STATE_HASH にし、通番（なければ0）と状態ハッシュ（4バイトずつ）を付ける。
+    """
+
+    BOARD_OFFSET = STATE_HEADER.size
+    BOMBS_OFFSET = BOARD_OFFSET + BOARD_WIDTH * BOARD_HEIGHT
+
+    def __init__(self, hashes: bool = False):
+        self.hashes = hashes
+        self.seq = 0
+        self._buffer = bytearray(self.BOMBS_OFFSET + BOMB_RECORD.size * MAX_BINARY_BOMBS)
+        self._last_body = b""  # 最後に送ったフレーム（seqを除く）
+        self._sent_version: Optional[int] = None  # 最後にエンコードした状態の版
+        self.ack: Optional[int] = None  # 処理済みの入力の通番
+        self._sent_ack: Optional[int] = None
+
+    def request_keyframe(self):
+        """次のフレームを変化の有無にかかわらず送る"""
+        self._last_body = b""
+        self._sent_version = None
+
+    def encode(self, game: TetrisGame) -> Optional[FramePayload]:
+        """ゲーム状態をバイナリフレームに変換（前回から変化がなければNone）"""
+        if game.state_version == self._sent_version and self.ack == self._sent_ack:
+            return None
+        self._sent_version = game.state_version
+        # seq以外が前回と同じなら送信しない
+        body = game.cached("binary", lambda: self._encode_body(game))
+        if body == self._last_body and self.ack == self._sent_ack:
+            return None
+        self._last_body = body
+        self._sent_ack = self.ack
+        self.seq += 1
+        if self.hashes:
+            return (FRAME_PREFIX.pack(BINARY_FRAME_STATE_HASH, self.seq) + body +
+                    INPUT_SEQ.pack((self.ack or 0) & 0xFFFFFFFF) + INPUT_SEQ.pack(state_hash(game)))
+        if self.ack is None:
+            return FRAME_PREFIX.pack(BINARY_FRAME_STATE, self.seq) + body
+        return (FRAME_PREFIX.pack(BINARY_FRAME_STATE_ACK, self.seq) + body +
+                INPUT_SEQ.pack(self.ack & 0xFFFFFFFF))
+
+    def _encode_body(self, game: TetrisGame) -> bytes:
+        """フレームのseqより後の部分"""
+        buffer = self._buffer
+        current = game.current_piece
+        next_piece = game.next_piece
+
+        flags = 0
+        if game.game_over:
+            flags |= FLAG_GAME_OVER
+        if game.paused:
+            flags |= FLAG_PAUSED
+        if current:
+            flags |= FLAG_HAS_CURRENT
+        if next_piece:
+            flags |= FLAG_HAS_NEXT
+
+        # ボード
+        offset = self.BOARD_OFFSET
+        for row in game.board:
+            for cell in row:
+                buffer[offset] = COLOR_INDEX[cell]
+                offset += 1
+
+        # 爆弾
+        bombs = game.bombs[:MAX_BINARY_BOMBS]
+        for bomb in bombs:
+            BOMB_RECORD.pack_into(buffer, offset, bomb.x, bomb.y, 1 if bomb.active else 0)
+            offset += BOMB_RECORD.size
+
+        STATE_HEADER.pack_into(
+            buffer, 0,
+            BINARY_FRAME_STATE, 0, flags,
+            game.score, game.level, game.lines_cleared, game.bombs_available,
+            game.speed_multiplier, game.lines_cleared_this_frame,
+            current.x if current else 0,
+            current.y if current else 0,
+            current.shape_idx if current else 0,
+            current.rotation if current else 0,
+            next_piece.shape_idx if next_piece else 0,
+            len(bombs),
+        )
+        return bytes(buffer[FRAME_PREFIX.size:offset])
+
+
+def decode_binary_action(data: bytes) -> Dict[str, Any]:
+    """バイナリ形式のアクションをJSON形式と同じ辞書に変換"""
+    if not data:
+        raise ValueError("空のアクションです")
+
+    action = OPCODE_ACTIONS.get(data[0] & ~OPCODE_SEQ_FLAG)
+    if action is None:
+        raise ValueError(f"不明なオペコードです: {data[0]}")
+
+    message: Dict[str, Any] = {"action": action}
+    # 通番付きのアクションはオペコードの直後に通番があり、引数はその後ろに続く
+    offset = 1
+    if data[0] & OPCODE_SEQ_FLAG:
+        message["seq"] = INPUT_SEQ.unpack_from(data, 1)[0]
+        offset += INPUT_SEQ.size
+    if action == "start" and len(data) >= offset + 4:
+        message["initial_speed_multiplier"] = struct.unpack_from("<f", data, offset)[0]
+    elif action == "place_bomb":
+        message["x"], message["y"] = struct.unpack_from("<bb", data, offset)
+    return message
+
+
+def perform_message_action(game: TetrisGame, message: Dict[str, Any]):
+    """クライアントからのアクションメッセージをゲームに適用（start・resyncは呼び出し側で処理）"""
+    action = message.get("action")
+    if action in ["left", "right", "down", "rotate", "hard_drop"]:
+        action_type = ActionType(action)
+        game.perform_action(action_type)
+    elif action == "place_bomb":
+        x = message.get("x", 0)
+        y = message.get("y", 0)
+        game.perform_action(ActionType.PLACE_BOMB, x=x, y=y)
+    elif action == "spawn_bomb":
+        game.perform_action(ActionType.SPAWN_BOMB)
+    elif action == "pause":
+        game.perform_action(ActionType.PAUSE)
+    elif action == "speed_up":
+        game.perform_action(ActionType.SPEED_UP)
+    elif action == "speed_down":
+        game.perform_action(ActionType.SPEED_DOWN)
+
+
+def create_encoder(frames: Optional[str] = None, encoding: Optional[str] = None, predict: bool = False):
+    """接続時に指定されたフレーム形式のエンコーダを生成
+
+    encoding=binary がframesより優先され、指定なしは従来のJSON形式。
+    predict=True（予測モード）ではフレームに状態ハッシュを付ける。
+    """
+    if encoding == "binary":
+        return BinaryStateEncoder(hashes=predict)
+    if frames == "delta":
+        return DeltaFrameEncoder(hashes=predict)
+    return JsonStateEncoder(hashes=predict)
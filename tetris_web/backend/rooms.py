@@ -0,0 +1,276 @@
+import json
+import random
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+from game import BOARD_WIDTH, ActionType, SevenBagRandomizer, TetrisGame, new_seed
+from protocol import COLOR_INDEX
+from scheduler import DEFAULT_BROADCAST_RATE, BroadcastPacer, earliest
+from simulation import Simulation
+
+# 1ルームの人数（既定は1対1）
+ROOM_MIN_PLAYERS = 2
+ROOM_MAX_PLAYERS = 8
+DEFAULT_ROOM_SIZE = 2
+# ルームフレームを送るレート（Hz、全メンバーに同じフレームを送る）
+ROOM_BROADCAST_RATE = DEFAULT_BROADCAST_RATE
+# ルームIDに使える文字
+ROOM_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,32}$")
+# 参加できないときのクローズコード（IDが不正・満員）
+ROOM_INVALID_CLOSE_CODE = 4400
+ROOM_FULL_CLOSE_CODE = 4409
+
+# ルームの状態
+ROOM_WAITING = "waiting"
+ROOM_PLAYING = "playing"
+ROOM_FINISHED = "finished"
+
+# ルームフレームの盤面のセル（色番号を1文字で表す）
+CELL_CHARS = "0123456789"
+
+
+def parse_room_id(value: str) -> str:
+    """接続時に指定されたルームID（使えない文字・長さはValueError）"""
+    if not ROOM_ID_PATTERN.match(value):
+        raise ValueError(f"無効なルームIDです: {value}")
+    return value
+
+
+def parse_room_size(value: Optional[str]) -> int:
+    """接続時に指定されたルームの人数（未指定・範囲外は既定値）"""
+    try:
+        size = int(value) if value is not None else DEFAULT_ROOM_SIZE
+    except ValueError:
+        return DEFAULT_ROOM_SIZE
+    return size if ROOM_MIN_PLAYERS <= size <= ROOM_MAX_PLAYERS else DEFAULT_ROOM_SIZE
+
+
+@dataclass
+class RoomPlayer:
+    slot: int
+    name: str
+    simulation: Optional[Simulation] = None  # 参加中のラウンドのゲーム（ラウンドの途中で入った場合はNone）
+    garbage_sent: int = 0
+
+
+class Room:
+    """対戦ルーム（2〜8人のゲームを共通の時計でまとめて進め、おじゃまラインをやり取りする）
+
+    全メンバーのゲームは同じ開始時刻・同じシードのピース列で始まり、いずれかのゲームの
+    更新期限が来るたびに全員を同じ時刻まで進めてから、ライン消去で生じたおじゃまラインを
+    生き残っている相手へ送る。状態は全員分をまとめた1つのルームフレームとして送信枠ごとに
+    1回だけエンコードし、全メンバーへ同じものを配る。
+    """
+
+    def __init__(self, room_id: str, size: int = DEFAULT_ROOM_SIZE, seed: Optional[int] = None):
+        self.room_id = room_id
+        self.size = size
+        self.players: Dict[int, RoomPlayer] = {}
+        self.state = ROOM_WAITING
+        self.round = 0
+        self.winner: Optional[int] = None
+        self.now = 0
+        self.pacer = BroadcastPacer(ROOM_BROADCAST_RATE)
+        # おじゃまラインの送り先と穴の位置（ルームごとのシードで決める）
+        self._rng = random.Random(seed if seed is not None else new_seed())
+        self._last_body: Optional[str] = None
+        self._last_versions: Optional[tuple] = None  # 最後にエンコードしたときのルームと各ゲームの版
+
+        # 統計
+        self.seq = 0
+        self.updates = 0
+        self.garbage_lines = 0
+
+    def __len__(self) -> int:
+        return len(self.players)
+
+    def free_slot(self) -> Optional[int]:
+        """空いている最小の席番号（満員ならNone）"""
+        for slot in range(self.size):
+            if slot not in self.players:
+                return slot
+        return None
+
+    def add_player(self, slot: int, name: str, now: int):
+        """席にプレイヤーを追加（満員になったらラウンドを開始）"""
+        if slot in self.players or not 0 <= slot < self.size:
+            raise ValueError(f"この席には参加できません: {slot}")
+        self.players[slot] = RoomPlayer(slot, name)
+        self.pacer.mark_dirty()
+        if self.state == ROOM_WAITING and len(self.players) == self.size:
+            self.start(now)
+
+    def remove_player(self, slot: int, now: int):
+        """プレイヤーを削除（ラウンド中なら棄権として扱う）"""
+        if self.players.pop(slot, None) is None:
+            return
+        self.advance_to(now)
+        self.pacer.mark_dirty()
+        self._check_finished()
+
+    def start(self, now: int):
+        """全メンバーで新しいラウンドを開始（全員が同じピース列・同じ開始時刻）"""
+        if len(self.players) < ROOM_MIN_PLAYERS:
+            raise ValueError(f"対戦には{ROOM_MIN_PLAYERS}人以上が必要です")
+        seed = self._rng.getrandbits(32)
+        for player in self.players.values():
+            game = TetrisGame(seed=seed, randomizer=SevenBagRandomizer.name)
+            player.simulation = Simulation(game, now)
+            player.garbage_sent = 0
+        self.state = ROOM_PLAYING
+        self.round += 1
+        self.winner = None
+        self.now = now
+        self.pacer.mark_dirty()
+
+    def _playing(self) -> List[RoomPlayer]:
+        return [player for player in self.players.values()
+                if player.simulation is not None and not player.simulation.game.game_over]
+
+    @property
+    def next_due(self) -> Optional[int]:
+        """いずれかのゲームの次の更新期限（ラウンド中でなければNone）"""
+        if self.state != ROOM_PLAYING:
+            return None
+        return earliest(*(player.simulation.next_due for player in self._playing()))
+
+    def advance_to(self, end: int):
+        """全メンバーのゲームを時刻endまで進める（更新期限ごとに全員を揃え、おじゃまラインを交換）"""
+        if self.state != ROOM_PLAYING or end < self.now:
+            return
+        while self.state == ROOM_PLAYING:
+            due = self.next_due
+            if due is None or due > end:
+                break
+            # 期限の来たゲームだけが更新され、他のゲームは時計だけが進む
+            changed = False
+            for player in self._playing():
+                simulation = player.simulation
+                before = simulation.updates
+                version = simulation.game.state_version
+                simulation.advance_to(due)
+                self.updates += simulation.updates - before
+                changed = changed or simulation.game.state_version != version
+            self.now = due
+            self._exchange_garbage()
+            self._check_finished()
+            if changed:
+                self.pacer.mark_dirty()
+        for player in self._playing():
+            player.simulation.advance_to(end)
+        self.now = end
+
+    def _exchange_garbage(self):
+        """ライン消去で生じたおじゃまラインを生き残っている相手の1人へ送る"""
+        playing = self._playing()
+        for player in playing:
+            game = player.simulation.game
+            lines = game.outgoing_garbage
+            if not lines:
+                continue
+            game.outgoing_garbage = 0
+            targets = [target for target in playing if target is not player]
+            if not targets:
+                continue
+            target = self._rng.choice(targets)
+            hole = self._rng.randrange(BOARD_WIDTH)
+            target.simulation.apply(((ActionType.GARBAGE, {"lines": lines, "hole": hole}),))
+            player.garbage_sent += lines
+            self.garbage_lines += lines
+
+    def _check_finished(self):
+        """生き残りが1人以下になったらラウンドを終了"""
+        if self.state != ROOM_PLAYING:
+            return
+        playing = self._playing()
+        if len(playing) <= 1:
+            self.state = ROOM_FINISHED
+            self.winner = playing[0].slot if playing else None
+            self.pacer.mark_dirty()
+
+    def apply(self, slot: int, message: Dict[str, Any], now: int):
+        """メンバーのアクションを到着時刻に適用（startは終了後の再戦、一時停止はできない）"""
+        action = message.get("action")
+        if action == "start":
+            if self.state == ROOM_PLAYING:
+                raise ValueError("ラウンドの途中です")
+            self.start(now)
+            return
+        if action == "resync":
+            # ルームフレームは毎回全員分の状態を送るので再同期は不要
+            return
+        if action == "pause":
+            raise ValueError("対戦中は一時停止できません")
+        player = self.players.get(slot)
+        if self.state != ROOM_PLAYING or player is None or player.simulation is None:
+            raise ValueError("参加中のラウンドがありません")
+        self.advance_to(now)
+        player.simulation.apply((message,))
+        self._exchange_garbage()
+        self._check_finished()
+        self.pacer.mark_dirty()
+
+    @staticmethod
+    def _encode_game(game: TetrisGame) -> str:
+        """ルームフレームの1人分のゲーム状態（席番号と表示名を除く）"""
+        piece = game.current_piece
+        return json.dumps({
+            "board": ["".join(CELL_CHARS[COLOR_INDEX[cell]] for cell in row) for row in game.board],
+            "piece": [piece.shape_idx, piece.rotation, piece.x, piece.y] if piece else None,
+            "next": game.next_piece.shape_idx if game.next_piece else None,
+            "score": game.score,
+            "level": game.level,
+            "lines": game.lines_cleared,
+            "game_over": game.game_over,
+            "garbage": sum(lines for lines, _ in game.pending_garbage),
+            "bombs": [[bomb.x, bomb.y] for bomb in game.bombs],
+        }, separators=(",", ":"))
+
+    def _encode_player(self, player: RoomPlayer) -> str:
+        head = json.dumps({"slot": player.slot, "name": player.name}, separators=(",", ":"))
+        if player.simulation is None:
+            return head
+        # ゲームの部分は版ごとに1回だけエンコードし、変わっていないメンバーの分は使い回す
+        game = player.simulation.game
+        return head[:-1] + "," + game.cached("room", lambda: self._encode_game(game))[1:]
+
+    def encode(self, now: int) -> Optional[str]:
+        """全メンバーの状態をまとめたルームフレーム（前回から変化がなければNone）"""
+        self.pacer.mark_sent(now)
+        slots = sorted(self.players)
+        versions = (self.state, self.round, self.winner, tuple(
+            (slot, self.players[slot].name,
+             self.players[slot].simulation.game.state_version if self.players[slot].simulation else None)
+            for slot in slots))
+        if versions == self._last_versions:
+            return None
+        self._last_versions = versions
+        head = json.dumps({
+            "room": self.room_id,
+            "state": self.state,
+            "size": self.size,
+            "round": self.round,
+            "winner": self.winner,
+        }, separators=(",", ":"))
+        body = head[:-1] + ',"players":[' + ",".join(
+            self._encode_player(self.players[slot]) for slot in slots) + "]}"
+        if body == self._last_body:
+            return None
+        self._last_body = body
+        self.seq += 1
+        # 通番は変化の有無の比較から外すため、エンコード後に先頭へ付ける
+        return f'{{"type":"room","seq":{self.seq},{body[1:]}'
+
+    def stats(self) -> Dict[str, Any]:
+        """ルームの状態と統計"""
+        return {
+            "room": self.room_id,
+            "state": self.state,
+            "size": self.size,
+            "players": len(self.players),
+            "round": self.round,
+            "frames": self.seq,
+            "updates": self.updates,
+            "garbage_lines": self.garbage_lines,
+        }
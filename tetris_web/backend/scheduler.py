@@ -0,0 +1,161 @@
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+
+def monotonic_ms() -> int:
+    """単調増加クロックの現在時刻（ミリ秒）"""
+    return int(time.monotonic() * 1000)
+
+
+class SessionScheduler:
+    """各セッションの次回更新期限をヒープで管理するスケジューラ
+
+    期限が来たセッションだけを取り出すため、1回の処理コストは
+    接続数ではなく期限到来したイベント数に比例する。
+    """
+
+    def __init__(self, clock: Callable[[], int] = monotonic_ms):
+        self._clock = clock
+        self._heap: List[Tuple[int, int, Hashable]] = []
+        # セッションごとの有効なエントリ（期限, 通番）。ヒープ内の古いエントリは遅延削除
+        self._entries: Dict[Hashable, Tuple[int, int]] = {}
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+
+        # 遅延（期限から実際に処理されるまでの時間）の計測値
+        self.last_lag_ms = 0
+        self.max_lag_ms = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def schedule(self, key: Hashable, deadline: Optional[int]):
+        """セッションの次回期限を設定（Noneの場合は登録解除）"""
+        if deadline is None:
+            self.cancel(key)
+            return
+
+        current = self._entries.get(key)
+        if current is not None and current[0] == deadline:
+            return
+
+        seq = next(self._counter)
+        self._entries[key] = (deadline, seq)
+        earliest = self.next_deadline()
+        heapq.heappush(self._heap, (deadline, seq, key))
+
+        # 最も早い期限が前倒しされた場合は待機中のループを起こす
+        if earliest is None or deadline < earliest:
+            self._wakeup.set()
+
+    def cancel(self, key: Hashable):
+        """セッションの登録を解除"""
+        self._entries.pop(key, None)
+
+    def _discard_stale(self):
+        """ヒープ先頭の無効なエントリを取り除く"""
+        while self._heap:
+            deadline, seq, key = self._heap[0]
+            if self._entries.get(key) == (deadline, seq):
+                return
+            heapq.heappop(self._heap)
+
+    def next_deadline(self) -> Optional[int]:
+        """最も早い期限を返す（登録がなければNone）"""
+        self._discard_stale()
+        if self._heap:
+            return self._heap[0][0]
+        return None
+
+    def pop_due(self, now: Optional[int] = None) -> List[Hashable]:
+        """期限が到来したセッションを取り出す"""
+        if now is None:
+            now = self._clock()
+
+        due: List[Hashable] = []
+        lag = 0
+        while True:
+            self._discard_stale()
+            if not self._heap or self._heap[0][0] > now:
+                break
+            deadline, _, key = heapq.heappop(self._heap)
+            del self._entries[key]
+            due.append(key)
+            lag = max(lag, now - deadline)
+
+        if due:
+            self.last_lag_ms = lag
+            self.max_lag_ms = max(self.max_lag_ms, lag)
+        return due
+
+    async def wait_until_due(self):
+        """最も早い期限が到来するまで待機（登録がなければ新たな登録まで待機）"""
+        while True:
+            earliest = self.next_deadline()
+            now = self._clock()
+            if earliest is not None and earliest <= now:
+                return
+
+            self._wakeup.clear()
+            timeout = None if earliest is None else (earliest - now) / 1000
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+# クライアントが接続時に選べる状態の送信レート（Hz）と既定値
+BROADCAST_RATES = (20, 30, 60)
+DEFAULT_BROADCAST_RATE = 30
+
+
+def parse_broadcast_rate(value: Optional[str]) -> int:
+    """接続時に指定された送信レート（未指定・対応していない値は既定値）"""
+    try:
+        rate = int(value) if value is not None else DEFAULT_BROADCAST_RATE
+    except ValueError:
+        return DEFAULT_BROADCAST_RATE
+    return rate if rate in BROADCAST_RATES else DEFAULT_BROADCAST_RATE
+
+
+def earliest(*deadlines: Optional[int]) -> Optional[int]:
+    """Noneを除いた最も早い期限（すべてNoneならNone）"""
+    return min((deadline for deadline in deadlines if deadline is not None), default=None)
+
+
+class BroadcastPacer:
+    """クライアントごとの状態送信の間隔を管理（シミュレーションの更新とは独立）
+
+    更新で状態が変わったら mark_dirty() し、送信枠（1000/rate ミリ秒ごと）が来たら
+    そこまでの変化をまとめて1回だけ送る。クライアント自身の操作への応答は枠を待たずに送り、
+    そこから次の枠を数える。
+    """
+
+    def __init__(self, rate: int = DEFAULT_BROADCAST_RATE):
+        self.rate = rate
+        self.interval_ms = 1000 // rate
+        self.dirty = False
+        self._next_at = 0
+
+    def mark_dirty(self):
+        """送っていない状態の変化がある"""
+        self.dirty = True
+
+    def deadline(self) -> Optional[int]:
+        """次に送る時刻（送る変化がなければNone）"""
+        return self._next_at if self.dirty else None
+
+    def ready(self, now: int) -> bool:
+        """今送るべきか"""
+        return self.dirty and now >= self._next_at
+
+    def mark_sent(self, now: int):
+        """状態を送った（次の枠はinterval_ms後）"""
+        self.dirty = False
+        self._next_at = now + self.interval_ms
@@ -0,0 +1,591 @@
+import asyncio
+import itertools
+import multiprocessing
+import threading
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from game import TetrisGame, UniformRandomizer
+from inputs import InputQueue
+from profiling import Profiler
+from protocol import create_encoder
+from rooms import Room
+from scheduler import (DEFAULT_BROADCAST_RATE, BroadcastPacer, SessionScheduler, earliest,
+                       monotonic_ms)
+from simulation import GameRecording, Simulation
+from snapshot import decode_snapshot, encode_snapshot
+from spectator import SpectatorEncoders, SpectatorFrame
+
+# ワーカーが負荷情報を報告する間隔（ミリ秒）
+STATS_INTERVAL_MS = 1000
+# ワーカー終了から再起動までの待ち時間（秒、起動直後の異常終了で再起動が連発しないように）
+RESTART_DELAY_SEC = 1.0
+
+
+def run_shard_worker(shard_id: int, conn: Any):
+    """シミュレーションワーカーのメインループ（子プロセスで実行）
+
+    受信するコマンド:
+        ("open", session_id, frames, encoding, game_id, resumed, rate, predict) / ("start", session_id, message, game_id)
+        ("action", session_id, message) / ("close", session_id, resume_token) / ("stop",)
+        ("watch", session_id, formats) / ("profile", request_id, kind, params)
+        ("room_join", room_id, slot, name, size) / ("room_leave", room_id, slot)
+        ("room_action", room_id, slot, message)
+        resumedは再開するゲームの(スナップショット, 記録)またはNone、rateは状態の送信レート（Hz）、
+        resume_tokenはNoneなら保存しない。formatsは観戦者がいるフレーム形式（空なら観戦フレームを作らない）。kindは phases（paramsのenabledで切り替え）・sample・allocations
+    送信するメッセージ:
+        ("frames", [(session_id, payload), ...]) / ("error", session_id, text)
+        ("spectate", [(session_id, [(形式, payload, キーフレームか), ...]), ...])
+        ("room_frames", [(room_id, payload), ...]) / ("room_error", room_id, slot, text)
+        ("recording", game_id, recording) / ("snapshot", resume_token, game_id, snapshot, recording)
+        ("stats", shard_id, {...}) / ("profile", request_id, shard_id, report)
+    """
+    # セッションごとのゲーム（期限どおりの時刻で進め、操作を記録する）
+    simulations: Dict[int, Simulation] = {}
+    game_ids: Dict[int, str] = {}
+    encoders: Dict[int, Any] = {}
+    pacers: Dict[int, BroadcastPacer] = {}
+    # セッションごとの入力キュー（次のステップの時刻にまとめて適用する）
+    inputs: Dict[int, InputQueue] = {}
+    # 観戦されているセッションの観戦フレームのエンコーダ
+    spectators: Dict[int, SpectatorEncoders] = {}
+    # 対戦ルーム（スケジューラにはルームIDで登録し、全メンバーのゲームをまとめて進める）
+    rooms: Dict[str, Room] = {}
+    scheduler = SessionScheduler()
+
+    def label_of(game: TetrisGame) -> Optional[str]:
+        """ゲームに対応するセッション名（メモリ割り当ての集計用）"""
+        for session_id, simulation in simulations.items():
+            if simulation.game is game:
+                return game_ids.get(session_id, f"session-{session_id}")
+        return None
+
+    # 区間計測・サンプリング・メモリ割り当て追跡（実行中のジョブの依頼ID）
+    profiler = Profiler(label_of)
+    profile_request: Optional[int] = None
+
+    updates = 0
+    busy_time = 0.0
+    next_stats = monotonic_ms() + STATS_INTERVAL_MS
+
+    def encode_frame(session_id: int, frames: List[Tuple[int, Any]]):
+        simulation = simulations[session_id]
+        # ゲームオーバーになったら記録をフロントエンドへ渡す（フレームより先に届くように送る）
+        if simulation.game.game_over and session_id in game_ids:
+            conn.send(("recording", game_ids.pop(session_id), simulation.recording))
+        # 処理済みの入力の通番をフレームに付ける
+        encoder = encoders[session_id]
+        encoder.ack = inputs[session_id].last_seq
+        payload = encoder.encode(simulation.game)
+        if payload is not None:
+            frames.append((session_id, payload))
+        # 次の送信枠はここから数える
+        pacers[session_id].mark_sent(monotonic_ms())
+
+    def reschedule(session_id: int):
+        """次の更新期限・入力の適用時刻と送信枠（観戦用の送信枠を含む）のうち最も早い時刻でスケジューラに登録"""
+        spectator = spectators.get(session_id)
+        scheduler.schedule(session_id, earliest(
+            simulations[session_id].next_due, pacers[session_id].deadline(),
+            spectator.pacer.deadline() if spectator is not None else None,
+            inputs[session_id].due))
+
+    def reschedule_room(room_id: str):
+        """ルームのいずれかのゲームの次の更新期限と送信枠のうち最も早い時刻でスケジューラに登録"""
+        room = rooms[room_id]
+        scheduler.schedule(room_id, earliest(room.next_due, room.pacer.deadline()))
+
+    def update_room(room_id: str, current_time: int, room_frames: List[Tuple[str, str]]):
+        """ルームの全ゲームを進め、送信枠が来ていればルームフレームを1回だけエンコードする"""
+        nonlocal updates
+        room = rooms[room_id]
+        before = room.updates
+        room.advance_to(current_time)
+        updates += room.updates - before
+        if room.pacer.ready(current_time):
+            payload = room.encode(current_time)
+            if payload is not None:
+                room_frames.append((room_id, payload))
+        reschedule_room(room_id)
+
+    def handle_room(command: Tuple[Any, ...]):
+        kind, room_id, slot = command[:3]
+        now = monotonic_ms()
+        room = rooms.get(room_id)
+        if kind == "room_join":
+            if room is None:
+                room = rooms[room_id] = Room(room_id, command[4])
+            room.add_player(slot, command[3], now)
+        elif room is None:
+            return
+        elif kind == "room_leave":
+            room.remove_player(slot, now)
+            if not len(room):
+                del rooms[room_id]
+                scheduler.cancel(room_id)
+                return
+        else:
+            room.apply(slot, command[3], now)
+        # 参加・操作への応答は送信枠を待たずに全メンバーへ送る
+        payload = room.encode(now)
+        if payload is not None:
+            conn.send(("room_frames", [(room_id, payload)]))
+        reschedule_room(room_id)
+
+    def start_game(session_id: int, game_id: str, randomizer: str = UniformRandomizer.name,
+                   speed_multiplier: float = 1.0):
+        simulations[session_id] = Simulation.recorded(monotonic_ms(), randomizer, speed_multiplier)
+        game_ids[session_id] = game_id
+
+    def handle(command: Tuple[Any, ...], frames: List[Tuple[int, Any]]) -> bool:
+        nonlocal profile_request
+        kind = command[0]
+        if kind == "stop":
+            return False
+        session_id = command[1]
+        if kind.startswith("room_"):
+            try:
+                handle_room(command)
+            except Exception as e:
+                conn.send(("room_error", command[1], command[2], str(e)))
+        elif kind == "profile":
+            request_id, job, params = command[1:]
+            if job == "phases":
+                conn.send(("profile", request_id, shard_id, profiler.set_phases(params.get("enabled"))))
+                return True
+            try:
+                profiler.start_job(job, **params)
+                profile_request = request_id
+            except ValueError as e:
+                conn.send(("profile", request_id, shard_id, {"error": str(e)}))
+        elif kind == "open":
+            if command[5] is not None:
+                snapshot, recording = command[5]
+                simulations[session_id] = decode_snapshot(snapshot, monotonic_ms(), recording)
+                game_ids[session_id] = command[4]
+            else:
+                start_game(session_id, command[4])
+            encoders[session_id] = create_encoder(command[2], command[3], command[7])
+            pacers[session_id] = BroadcastPacer(command[6])
+            inputs[session_id] = InputQueue()
+            encode_frame(session_id, frames)
+            reschedule(session_id)
+        elif kind == "close":
+            simulation = simulations.pop(session_id, None)
+            game_id = game_ids.pop(session_id, None)
+            # 続行中のゲームは再開用にスナップショットと記録を返す
+            if simulation is not None and game_id is not None and command[2] is not None:
+                simulation.advance_to(monotonic_ms())
+                if not simulation.game.game_over:
+                    try:
+                        conn.send(("snapshot", command[2], game_id, encode_snapshot(simulation),
+                                   simulation.recording))
+                    except Exception as e:
+                        # 再開はできなくなるが、スコア検証用の記録は渡してセッションの後片付けを続ける
+                        print(f"シャード {shard_id} のスナップショットの保存エラー: {e}")
+                        conn.send(("recording", game_id, simulation.recording))
+            encoders.pop(session_id, None)
+            pacers.pop(session_id, None)
+            inputs.pop(session_id, None)
+            spectators.pop(session_id, None)
+            scheduler.cancel(session_id)
+        elif kind == "watch":
+            if command[2] and session_id in simulations:
+                spectators.setdefault(session_id, SpectatorEncoders()).set_formats(command[2])
+                reschedule(session_id)
+            else:
+                spectators.pop(session_id, None)
+        elif kind in ("start", "action") and session_id in simulations:
+            message = command[2]
+            try:
+                if kind == "start":
+                    start_game(session_id, command[3],
+                               message.get("randomizer", UniformRandomizer.name),
+                               message.get("initial_speed_multiplier", 1.0))
+                    # 前のゲームへの未処理の入力は捨てる
+                    inputs[session_id].take()
+                    inputs[session_id].acknowledge(message)
+                elif message.get("action") == "resync":
+                    encoders[session_id].request_keyframe()
+                else:
+                    # 到着後の最初のステップの時刻でまとめて適用する（応答はその時刻の1フレーム）
+                    simulation = simulations[session_id]
+                    inputs[session_id].push(message, simulation.next_step(monotonic_ms()))
+                    reschedule(session_id)
+                    return True
+                # 新しいゲーム・再同期への応答は送信枠を待たずに送る
+                encode_frame(session_id, frames)
+                reschedule(session_id)
+            except Exception as e:
+                conn.send(("error", session_id, str(e)))
+        return True
+
+    running = True
+    while running:
+        frames: List[Tuple[int, Any]] = []
+        spectator_frames: List[Tuple[int, List[SpectatorFrame]]] = []
+        room_frames: List[Tuple[str, str]] = []
+
+        # 期限が来たセッションを更新
+        started = time.perf_counter()
+        current_time = monotonic_ms()
+        for session_id in scheduler.pop_due(current_time):
+            if session_id in rooms:
+                try:
+                    update_room(session_id, current_time, room_frames)
+                except Exception as e:
+                    print(f"シャード {shard_id} のルーム {session_id} の更新エラー: {e}")
+                continue
+            simulation = simulations.get(session_id)
+            if simulation is None:
+                continue
+            try:
+                before = simulation.updates
+                version = simulation.game.state_version
+                # ためていた入力はステップの時刻でまとめて適用する
+                queue = inputs[session_id]
+                replied = queue.due is not None and queue.due <= current_time
+                if replied:
+                    simulation.advance_to(queue.due)
+                    simulation.apply(queue.take())
+                simulation.advance_to(current_time)
+                updates += simulation.updates - before
+                # 送信枠が来ていれば、それまでの更新をまとめた最新の状態を送る（状態が変わったときだけ）
+                pacer = pacers[session_id]
+                spectator = spectators.get(session_id)
+                if simulation.game.state_version != version:
+                    pacer.mark_dirty()
+                    if spectator is not None:
+                        spectator.pacer.mark_dirty()
+                # 入力への応答は送信枠を待たずに1フレームで返す
+                if replied or pacer.ready(current_time):
+                    encode_frame(session_id, frames)
+                # 観戦者へは観戦用の送信枠ごとに1回だけエンコードする（配るのはフロントエンド）
+                if spectator is not None and spectator.pacer.ready(current_time):
+                    spectator_frames.append((session_id, spectator.encode(simulation.game, current_time)))
+                reschedule(session_id)
+            except Exception as e:
+                print(f"シャード {shard_id} のセッション {session_id} の更新エラー: {e}")
+                conn.send(("error", session_id, str(e)))
+        busy_time += time.perf_counter() - started
+
+        if frames:
+            conn.send(("frames", frames))
+            frames = []
+        if spectator_frames:
+            conn.send(("spectate", spectator_frames))
+        if room_frames:
+            conn.send(("room_frames", room_frames))
+
+        # 負荷情報の報告
+        now = monotonic_ms()
+        if now >= next_stats:
+            elapsed = STATS_INTERVAL_MS + (now - next_stats)
+            conn.send(("stats", shard_id, {
+                "sessions": len(simulations),
+                "rooms": len(rooms),
+                "states": dict(Counter(simulation.game.status for simulation in simulations.values())),
+                "scheduled": len(scheduler),
+                "updates_per_sec": updates * 1000 / elapsed,
+                "busy_ratio": busy_time * 1000 / elapsed,
+                "max_lag_ms": scheduler.max_lag_ms,
+            }))
+            updates = 0
+            busy_time = 0.0
+            scheduler.max_lag_ms = 0
+            next_stats = now + STATS_INTERVAL_MS
+
+        # 期間が過ぎた計測の結果を返す
+        if profile_request is not None and now >= profiler.job_deadline:
+            conn.send(("profile", profile_request, shard_id, profiler.finish_job()))
+            profile_request = None
+
+        # 次の期限（または次の報告時刻・計測の終了時刻）までコマンドを待つ
+        wake_at = next_stats
+        deadline = scheduler.next_deadline()
+        if deadline is not None:
+            wake_at = min(wake_at, deadline)
+        if profile_request is not None:
+            wake_at = min(wake_at, profiler.job_deadline)
+        timeout = max(0, wake_at - monotonic_ms()) / 1000
+
+        try:
+            if conn.poll(timeout):
+                started = time.perf_counter()
+                while running and conn.poll():
+                    running = handle(conn.recv(), frames)
+                busy_time += time.perf_counter() - started
+        except (EOFError, OSError):
+            break
+
+        if frames:
+            conn.send(("frames", frames))
+
+
+class ShardPool:
+    """シミュレーションワーカープロセス群とセッションの割り当てを管理（フロントエンド側）
+
+    各ワーカーがセッションの一部（シャード）を所有して更新・エンコードし、
+    フロントエンドはアクションとフレームをパイプで中継する。
+    ワーカーが終了した場合は再起動し、そのシャードのセッションを新しいゲームで開き直す。
+    """
+
+    def __init__(self, workers: int,
+                 on_frame: Callable[[int, Any], None],
+                 on_error: Callable[[int, str], None],
+                 on_recording: Optional[Callable[[str, GameRecording], None]] = None,
+                 on_snapshot: Optional[Callable[[str, str, bytes, GameRecording], None]] = None,
+                 on_spectate: Optional[Callable[[int, List[SpectatorFrame]], None]] = None,
+                 on_room_frame: Optional[Callable[[str, str], None]] = None,
+                 on_room_error: Optional[Callable[[str, int, str], None]] = None):
+        self.workers = workers
+        self._on_frame = on_frame
+        self._on_error = on_error
+        self._on_recording = on_recording
+        self._on_snapshot = on_snapshot
+        self._on_spectate = on_spectate
+        self._on_room_frame = on_room_frame
+        self._on_room_error = on_room_error
+        self._context = multiprocessing.get_context("spawn")
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._processes: List[Any] = [None] * workers
+        self._conns: List[Any] = [None] * workers
+        self._stopping = False
+
+        # セッションID → (シャード番号, frames, encoding, 送信レート, 予測モード, ゲームID)
+        self._sessions: Dict[int, Tuple[int, Optional[str], Optional[str], int, bool, str]] = {}
+        # 観戦されているセッションID → 観戦者がいるフレーム形式（ワーカーの再起動時に送り直す）
+        self._watched: Dict[int, Tuple[str, ...]] = {}
+        # ルームID → (シャード番号, 人数)と、ルームごとの参加者（席番号 → 表示名、再起動時に参加し直す）
+        self._rooms: Dict[str, Tuple[int, int]] = {}
+        self._room_players: Dict[str, Dict[int, str]] = {}
+        self._shard_sessions: List[int] = [0] * workers
+        self._restarts: List[int] = [0] * workers
+        self._shard_stats: List[Dict[str, Any]] = [{} for _ in range(workers)]
+        # 計測の依頼ID → (完了時に結果を渡すFuture, シャード番号 → 結果)
+        self._profile_requests: Dict[int, Tuple[asyncio.Future, Dict[int, Dict[str, Any]]]] = {}
+        self._profile_ids = itertools.count(1)
+
+    def start(self):
+        """全ワーカーを起動（イベントループ内で呼ぶ）"""
+        self._loop = asyncio.get_running_loop()
+        for shard_id in range(self.workers):
+            self._start_worker(shard_id)
+
+    def _start_worker(self, shard_id: int):
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=run_shard_worker, args=(shard_id, child_conn),
+            name=f"tetris-shard-{shard_id}", daemon=True,
+        )
+        process.start()
+        child_conn.close()
+        self._processes[shard_id] = process
+        self._conns[shard_id] = parent_conn
+        threading.Thread(
+            target=self._reader, args=(shard_id, parent_conn),
+            name=f"tetris-shard-reader-{shard_id}", daemon=True,
+        ).start()
+        print(f"シャードワーカー {shard_id} を起動しました (pid={process.pid})")
+
+    def _reader(self, shard_id: int, conn: Any):
+        """ワーカーからのメッセージを受信してイベントループへ渡す（スレッドで実行）"""
+        try:
+            while True:
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    break
+                self._loop.call_soon_threadsafe(self._dispatch, shard_id, message)
+            self._loop.call_soon_threadsafe(self._handle_worker_exit, shard_id, conn)
+        except RuntimeError:
+            # イベントループが既に閉じている（シャットダウン中）
+            pass
+
+    def _dispatch(self, shard_id: int, message: Tuple[Any, ...]):
+        kind = message[0]
+        if kind == "frames":
+            for session_id, payload in message[1]:
+                if session_id in self._sessions:
+                    self._on_frame(session_id, payload)
+        elif kind == "spectate":
+            if self._on_spectate is not None:
+                for session_id, frames in message[1]:
+                    if session_id in self._sessions:
+                        self._on_spectate(session_id, frames)
+        elif kind == "room_frames":
+            if self._on_room_frame is not None:
+                for room_id, payload in message[1]:
+                    if room_id in self._rooms:
+                        self._on_room_frame(room_id, payload)
+        elif kind == "error":
+            self._on_error(message[1], message[2])
+        elif kind == "room_error":
+            if self._on_room_error is not None:
+                self._on_room_error(*message[1:])
+        elif kind == "recording":
+            if self._on_recording is not None:
+                self._on_recording(message[1], message[2])
+        elif kind == "snapshot":
+            if self._on_snapshot is not None:
+                self._on_snapshot(*message[1:])
+        elif kind == "stats":
+            self._shard_stats[shard_id] = message[2]
+        elif kind == "profile":
+            request = self._profile_requests.get(message[1])
+            if request is not None:
+                future, results = request
+                results[message[2]] = message[3]
+                if len(results) == self.workers and not future.done():
+                    future.set_result(results)
+
+    def _handle_worker_exit(self, shard_id: int, conn: Any):
+        """ワーカーの終了を検知したら再起動してセッションを開き直す"""
+        if self._stopping or self._conns[shard_id] is not conn:
+            return
+        process = self._processes[shard_id]
+        process.join(timeout=1)
+        print(f"シャードワーカー {shard_id} が終了しました (exitcode={process.exitcode})。再起動します")
+        self._restarts[shard_id] += 1
+        self._shard_stats[shard_id] = {}
+        self._loop.call_later(RESTART_DELAY_SEC, self._restart_worker, shard_id)
+
+    def _restart_worker(self, shard_id: int):
+        """ワーカーを起動し直し、担当セッションを新しいゲームで開き直す（ゲームIDは引き継ぐ）"""
+        if self._stopping:
+            return
+        self._start_worker(shard_id)
+        for session_id, (assigned, frames, encoding, rate, predict, game_id) in self._sessions.items():
+            if assigned == shard_id:
+                self._send(shard_id, ("open", session_id, frames, encoding, game_id, None, rate, predict))
+                if session_id in self._watched:
+                    self._send(shard_id, ("watch", session_id, self._watched[session_id]))
+        # ルームは参加者を入れ直し、満員なら新しいラウンドから始める
+        for room_id, (assigned, size) in self._rooms.items():
+            if assigned == shard_id:
+                for slot, name in sorted(self._room_players[room_id].items()):
+                    self._send(shard_id, ("room_join", room_id, slot, name, size))
+
+    def _send(self, shard_id: int, command: Tuple[Any, ...]):
+        try:
+            self._conns[shard_id].send(command)
+        except (BrokenPipeError, OSError) as e:
+            # 再起動は読み取りスレッドの終了検知で行う
+            print(f"シャードワーカー {shard_id} への送信エラー: {e}")
+
+    def open_session(self, session_id: int, frames: Optional[str] = None,
+                     encoding: Optional[str] = None, game_id: str = "",
+                     resumed: Optional[Tuple[bytes, Optional[GameRecording]]] = None,
+                     rate: int = DEFAULT_BROADCAST_RATE, predict: bool = False) -> int:
+        """最もセッション数の少ないシャードにセッションを割り当てる（resumedを渡すとそのゲームを再開）"""
+        shard_id = min(range(self.workers), key=lambda i: self._shard_sessions[i])
+        self._sessions[session_id] = (shard_id, frames, encoding, rate, predict, game_id)
+        self._shard_sessions[shard_id] += 1
+        self._send(shard_id, ("open", session_id, frames, encoding, game_id, resumed, rate, predict))
+        return shard_id
+
+    def start_game(self, session_id: int, message: Dict[str, Any], game_id: str):
+        """セッションで新しいゲームを開始（startメッセージを担当シャードへ中継）"""
+        session = self._sessions.get(session_id)
+        if session is not None:
+            self._sessions[session_id] = session[:-1] + (game_id,)
+            self._send(session[0], ("start", session_id, message, game_id))
+
+    def send_action(self, session_id: int, message: Dict[str, Any]):
+        """セッションのアクションを担当シャードへ中継"""
+        session = self._sessions.get(session_id)
+        if session is not None:
+            self._send(session[0], ("action", session_id, message))
+
+    def watch(self, session_id: int, formats: Tuple[str, ...]):
+        """セッションの観戦フレームを作る形式を担当シャードへ伝える（空なら作らない）"""
+        session = self._sessions.get(session_id)
+        if session is None:
+            return
+        if formats:
+            self._watched[session_id] = formats
+        else:
+            self._watched.pop(session_id, None)
+        self._send(session[0], ("watch", session_id, formats))
+
+    def join_room(self, room_id: str, slot: int, name: str, size: int) -> int:
+        """ルームに参加（新しいルームは最もセッション数の少ないシャードに割り当て、メンバーも1セッションと数える）"""
+        room = self._rooms.get(room_id)
+        if room is None:
+            shard_id = min(range(self.workers), key=lambda i: self._shard_sessions[i])
+            room = self._rooms[room_id] = (shard_id, size)
+            self._room_players[room_id] = {}
+        shard_id = room[0]
+        self._room_players[room_id][slot] = name
+        self._shard_sessions[shard_id] += 1
+        self._send(shard_id, ("room_join", room_id, slot, name, size))
+        return shard_id
+
+    def leave_room(self, room_id: str, slot: int):
+        """ルームから抜ける（最後のメンバーが抜けたらルームを削除）"""
+        room = self._rooms.get(room_id)
+        if room is None or self._room_players[room_id].pop(slot, None) is None:
+            return
+        self._shard_sessions[room[0]] -= 1
+        if not self._room_players[room_id]:
+            del self._rooms[room_id]
+            del self._room_players[room_id]
+        self._send(room[0], ("room_leave", room_id, slot))
+
+    def room_action(self, room_id: str, slot: int, message: Dict[str, Any]):
+        """ルームのメンバーのアクションを担当シャードへ中継"""
+        room = self._rooms.get(room_id)
+        if room is not None:
+            self._send(room[0], ("room_action", room_id, slot, message))
+
+    def close_session(self, session_id: int, resume_token: Optional[str] = None):
+        """セッションを担当シャードから削除（resume_tokenを渡すと続行中のゲームを再開用に保存）"""
+        self._watched.pop(session_id, None)
+        session = self._sessions.pop(session_id, None)
+        if session is not None:
+            self._shard_sessions[session[0]] -= 1
+            self._send(session[0], ("close", session_id, resume_token))
+
+    async def profile(self, kind: str, timeout: float, **params) -> Dict[int, Dict[str, Any]]:
+        """全ワーカーで計測を行い、シャードごとの結果を返す（timeout秒までに届いた分だけ）"""
+        request_id = next(self._profile_ids)
+        future = self._loop.create_future()
+        results: Dict[int, Dict[str, Any]] = {}
+        self._profile_requests[request_id] = (future, results)
+        for shard_id in range(self.workers):
+            self._send(shard_id, ("profile", request_id, kind, params))
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            print(f"シャードワーカーの計測結果が揃いませんでした（{len(results)}/{self.workers}）")
+        finally:
+            del self._profile_requests[request_id]
+        return dict(results)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """シャードごとの負荷情報"""
+        result = []
+        for shard_id in range(self.workers):
+            process = self._processes[shard_id]
+            result.append({
+                "shard": shard_id,
+                "pid": process.pid if process else None,
+                "alive": bool(process and process.is_alive()),
+                "assigned_sessions": self._shard_sessions[shard_id],
+                "assigned_rooms": sum(1 for assigned, _ in self._rooms.values() if assigned == shard_id),
+                "restarts": self._restarts[shard_id],
+                **self._shard_stats[shard_id],
+            })
+        return result
+
+    def stop(self):
+        """全ワーカーを停止"""
+        self._stopping = True
+        for shard_id in range(self.workers):
+            self._send(shard_id, ("stop",))
+        for process in self._processes:
+            if process is not None:
+                process.join(timeout=2)
+                if process.is_alive():
+                    process.terminate()
@@ -0,0 +1,165 @@
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from game import LINE_CLEAR_STEP, ActionType, TetrisGame, UniformRandomizer, parse_speed_multiplier
+from protocol import perform_message_action
+
+# シミュレーションの固定ステップ（ミリ秒）。更新はゲーム開始からこの間隔の時刻にだけ行う
+SIMULATION_STEP_MS = LINE_CLEAR_STEP
+# ポリシーを呼び出す既定の間隔（ミリ秒、人間の操作間隔に相当）
+DEFAULT_POLICY_INTERVAL_MS = 100
+# 1ゲームの仮想時間の上限（ミリ秒、終わらないゲームの打ち切り用）
+DEFAULT_MAX_GAME_MS = 24 * 60 * 60 * 1000
+
+# 記録する操作メッセージのキー
+RECORDED_MESSAGE_KEYS = ("action", "x", "y")
+
+# アクションの指定方法: ActionType / (ActionType, 引数) / クライアントと同じメッセージ
+Action = Union[ActionType, Tuple[ActionType, Dict[str, Any]], Dict[str, Any]]
+Policy = Callable[[TetrisGame], Optional[Iterable[Action]]]
+
+
+def apply_action(game: TetrisGame, action: Action):
+    """1つのアクションをゲームに適用"""
+    if isinstance(action, ActionType):
+        game.perform_action(action)
+    elif isinstance(action, tuple):
+        action_type, kwargs = action
+        game.perform_action(action_type, **kwargs)
+    else:
+        perform_message_action(game, action)
+
+
+def recorded_action(action: Action) -> Action:
+    """記録用のアクション（メッセージは再現に必要なキーだけを残す）"""
+    if isinstance(action, dict):
+        return {key: action[key] for key in RECORDED_MESSAGE_KEYS if key in action}
+    return action
+
+
+@dataclass
+class GameRecording:
+    """ゲームを再現するための入力（シード・開始条件・時刻付きの操作ログ）"""
+    seed: int
+    randomizer: str
+    start_time: int
+    speed_multiplier: float = 1.0
+    actions: List[Tuple[int, Action]] = field(default_factory=list)  # (開始からの経過ms, メッセージ)
+    step_ms: int = SIMULATION_STEP_MS
+
+
+class Simulation:
+    """仮想時計でTetrisGameを進めるヘッドレス実行環境（実時間を待たない）
+
+    更新は開始時刻からstep_ms刻みの固定ステップの時刻にだけ行い、その中で
+    next_update_time() が返す時刻以降の最初のステップで update() を呼ぶ。
+    アクションはその時刻に適用し、次のステップで更新する。遅れて進めた場合も
+    途中のステップを順に処理するので、ループの揺らぎによらず同じアクション列と時刻からは
+    常に同じ結果になり、待ち時間がない分だけ実時間よりはるかに速く進む。
+    """
+
+    def __init__(self, game: Optional[TetrisGame] = None, start_time: int = 0,
+                 recording: Optional[GameRecording] = None, step_ms: int = SIMULATION_STEP_MS):
+        self.game = game if game is not None else TetrisGame()
+        self.start_time = start_time
+        self.now = start_time
+        self.step_ms = step_ms
+        self.updates = 0
+        self.recording = recording  # 指定するとapply()した操作を記録する
+        self._due: Optional[int] = start_time  # 次にupdate()が必要な時刻（Noneは待機中）
+
+    @classmethod
+    def recorded(cls, start_time: int, randomizer: str = UniformRandomizer.name,
+                 speed_multiplier: float = 1.0, seed: Optional[int] = None) -> "Simulation":
+        """操作を記録しながら進める新しいゲーム（実時刻で駆動するサーバー用、速度倍率は範囲内に丸める）"""
+        speed_multiplier = parse_speed_multiplier(speed_multiplier)
+        game = TetrisGame(seed=seed, randomizer=randomizer)
+        game.speed_multiplier = speed_multiplier
+        recording = GameRecording(game.seed, randomizer, start_time, speed_multiplier)
+        return cls(game, start_time, recording)
+
+    def _step_at(self, time: int) -> int:
+        """時刻time以降の最初のステップの時刻"""
+        return time + (self.start_time - time) % self.step_ms
+
+    def next_step(self, time: int) -> int:
+        """時刻time以降の最初のステップの時刻（その時刻に届いた入力をまとめて適用する時刻）"""
+        return self._step_at(max(time, self.now))
+
+    @property
+    def next_due(self) -> Optional[int]:
+        """次にupdate()が必要な時刻（一時停止・ゲームオーバー中はNone）"""
+        return None if self.game.game_over else self._due
+
+    def restore_clock(self, now: int, due: Optional[int]):
+        """仮想時計を時刻nowに合わせ、次の更新期限を設定（スナップショットからの復元用）"""
+        self.now = now
+        self._due = due
+
+    def apply(self, actions: Iterable[Action]):
+        """現在時刻でアクションをまとめて適用"""
+        # サーバー・replay() と同じく、現在時刻が期限の更新を済ませてから適用する
+        self.advance_to(self.now)
+        for action in actions:
+            apply_action(self.game, action)
+            if self.recording is not None:
+                self.recording.actions.append((self.now - self.start_time, recorded_action(action)))
+        # アクションの結果（落下速度・爆弾・一時停止の解除など）は次のステップの更新で反映する
+        self._due = self._step_at(self.now + 1)
+
+    def advance(self, ms: int):
+        """仮想時計をms進め、その間に期限の来た更新をすべて行う"""
+        self.advance_to(self.now + ms)
+
+    def advance_to(self, end: int):
+        """仮想時計を時刻endまで進め、その間に期限の来た更新をすべて行う"""
+        if end < self.now:
+            return
+        game = self.game
+        due = self._due
+        while due is not None and due <= end and not game.game_over:
+            game.update(due)
+            self.updates += 1
+            next_time = game.next_update_time(due)
+            due = self._step_at(max(next_time, due + 1)) if next_time is not None else None
+        self._due = due
+        self.now = end
+
+    def step(self, ms: int, actions: Iterable[Action] = ()):
+        """アクションを適用してから仮想時計をms進める"""
+        self.apply(actions)
+        self.advance(ms)
+
+    def run_until_game_over(self, policy: Optional[Policy] = None,
+                            interval_ms: int = DEFAULT_POLICY_INTERVAL_MS,
+                            max_ms: int = DEFAULT_MAX_GAME_MS) -> TetrisGame:
+        """ゲームオーバー（または時間上限）まで進める
+
+        policyを指定するとinterval_msごとにゲームを渡して呼び出し、返されたアクションを適用する。
+        policyなしでは操作せずに落下だけで進める（一時停止中なら進めずに戻る）。
+        """
+        game = self.game
+        end = self.now + max_ms
+        if policy is None:
+            while not game.game_over and self._due is not None and self.now < end:
+                self.advance(min(interval_ms * 100, end - self.now))
+            return game
+
+        while not game.game_over and self.now < end:
+            actions = policy(game)
+            if actions:
+                self.apply(actions)
+            self.advance(min(interval_ms, end - self.now))
+        return game
+
+
+def replay(recording: GameRecording, max_ms: int = DEFAULT_MAX_GAME_MS) -> TetrisGame:
+    """記録した操作を同じ時刻に適用し、ゲームオーバーまで進めた結果を返す"""
+    game = TetrisGame(seed=recording.seed, randomizer=recording.randomizer)
+    game.speed_multiplier = recording.speed_multiplier
+    simulation = Simulation(game, recording.start_time, step_ms=recording.step_ms)
+    for offset, action in recording.actions:
+        simulation.advance_to(recording.start_time + offset)
+        simulation.apply((action,))
+    simulation.run_until_game_over(max_ms=max_ms)
+    return game
@@ -0,0 +1,228 @@
+import secrets
+import struct
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from game import (BOARD_HEIGHT, BOARD_WIDTH, Bomb, SevenBagRandomizer, TetrisGame,
+                  Tetromino, UniformRandomizer)
+from protocol import COLOR_INDEX
+from simulation import SIMULATION_STEP_MS, GameRecording, Simulation
+
+# 切断されたゲームを再開できる期間（秒）と最大保持数
+DEFAULT_SNAPSHOT_TTL_SEC = 120
+DEFAULT_MAX_SNAPSHOTS = 10000
+
+# スナップショット形式のバージョン（レイアウトを変えたら上げる）
+SNAPSHOT_VERSION = 2
+
+# ピース列の種類と1バイトの番号の対応
+SNAPSHOT_RANDOMIZERS = (UniformRandomizer.name, SevenBagRandomizer.name)
+
+# スナップショットのヘッダ（リトルエンディアン）
+# バージョン, シード, ピース列の種類, 取り出したピース数, フラグ,
+# スコア, ライン数, レベル, 爆弾所持数, 落下間隔, 基本落下間隔, 速度倍率,
+# ロック遅延, ライン消去遅延, ライン消去経過時間, 消去待ちライン数, 今回消去ライン数,
+# 落下時刻, ロック開始時刻, ライン消去起点時刻, ゲーム開始からの経過時間, 次の更新期限（いずれも現在時刻からの差）,
+# 現在ピースx, y, 形状番号, 回転, 次ピースx, y, 形状番号, 回転, 爆弾数
+SNAPSHOT_HEADER = struct.Struct("<BIBIBIIHHIIdIIiBBqqqqqbbbBbbbBH")
+SNAPSHOT_BOMB = struct.Struct("<bbBB")
+# ボードは1セル4ビット（色番号）で2セルずつ1バイトに詰める
+SNAPSHOT_BOARD_SIZE = BOARD_WIDTH * BOARD_HEIGHT // 2
+
+# フラグのビット
+SNAPSHOT_GAME_OVER = 0x01
+SNAPSHOT_PAUSED = 0x02
+SNAPSHOT_LOCKED = 0x04
+SNAPSHOT_PENDING_LINE_CLEAR = 0x08
+SNAPSHOT_HAS_CURRENT = 0x10
+SNAPSHOT_HAS_NEXT = 0x20
+SNAPSHOT_LINE_CLEAR_STARTED = 0x40
+SNAPSHOT_HAS_DUE = 0x80
+
+INDEX_COLOR = {index: color for color, index in COLOR_INDEX.items()}
+
+# ボードの1バイト（2セル）→ 2セル分の色
+_BYTE_COLORS = tuple(
+    (INDEX_COLOR.get(byte >> 4, 0), INDEX_COLOR.get(byte & 0x0F, 0)) for byte in range(256))
+
+
+def encode_snapshot(simulation: Simulation) -> bytes:
+    """ゲームの全状態と仮想時計をバイナリに変換（時刻は現在時刻からの差で保存する）"""
+    game = simulation.game
+    now = simulation.now
+    current = game.current_piece
+    next_piece = game.next_piece
+    due = simulation.next_due
+
+    flags = 0
+    if game.game_over:
+        flags |= SNAPSHOT_GAME_OVER
+    if game.paused:
+        flags |= SNAPSHOT_PAUSED
+    if game.is_locked:
+        flags |= SNAPSHOT_LOCKED
+    if game.pending_line_clear:
+        flags |= SNAPSHOT_PENDING_LINE_CLEAR
+    if current:
+        flags |= SNAPSHOT_HAS_CURRENT
+    if next_piece:
+        flags |= SNAPSHOT_HAS_NEXT
+    if game.line_clear_started is not None:
+        flags |= SNAPSHOT_LINE_CLEAR_STARTED
+    if due is not None:
+        flags |= SNAPSHOT_HAS_DUE
+
+    header = SNAPSHOT_HEADER.pack(
+        SNAPSHOT_VERSION, game.seed, SNAPSHOT_RANDOMIZERS.index(game.randomizer_name),
+        game.randomizer.drawn, flags,
+        game.score, game.lines_cleared, game.level, game.bombs_available,
+        game.fall_speed, game.base_fall_speed, game.speed_multiplier,
+        game.lock_delay, game.line_clear_delay, game.line_clear_time,
+        game.pending_lines, game.lines_cleared_this_frame,
+        now - game.fall_time, now - game.lock_time,
+        now - game.line_clear_started if game.line_clear_started is not None else 0,
+        now - simulation.start_time, due - now if due is not None else 0,
+        current.x if current else 0, current.y if current else 0,
+        current.shape_idx if current else 0, current.rotation if current else 0,
+        next_piece.x if next_piece else 0, next_piece.y if next_piece else 0,
+        next_piece.shape_idx if next_piece else 0, next_piece.rotation if next_piece else 0,
+        len(game.bombs),
+    )
+    bombs = b"".join(SNAPSHOT_BOMB.pack(bomb.x, bomb.y, bomb.radius, 1 if bomb.active else 0)
+                     for bomb in game.bombs)
+    cells = [COLOR_INDEX[cell] for row in game.board for cell in row]
+    board = bytes(high << 4 | low for high, low in zip(cells[0::2], cells[1::2]))
+    return header + bombs + board
+
+
+def decode_snapshot(data: bytes, now: int,
+                    recording: Optional[GameRecording] = None) -> Simulation:
+    """スナップショットから時刻nowで再開するシミュレーションを復元
+
+    保存時との時刻の差だけ全時刻をずらすので、切断中にゲームは進まない。
+    recordingを渡すと操作の記録を続ける（記録上の経過時間は切断前から連続する）。
+    """
+    if not data or data[0] != SNAPSHOT_VERSION:
+        raise ValueError("スナップショットの形式が不正です")
+    (_, seed, randomizer_index, drawn, flags,
+     score, lines_cleared, level, bombs_available,
+     fall_speed, base_fall_speed, speed_multiplier,
+     lock_delay, line_clear_delay, line_clear_time, pending_lines, lines_cleared_this_frame,
+     fall_age, lock_age, line_clear_age, elapsed, due_in,
+     current_x, current_y, current_shape, current_rotation,
+     next_x, next_y, next_shape, next_rotation, bomb_count) = SNAPSHOT_HEADER.unpack_from(data)
+    bombs_offset = SNAPSHOT_HEADER.size
+    board_offset = bombs_offset + SNAPSHOT_BOMB.size * bomb_count
+    if len(data) != board_offset + SNAPSHOT_BOARD_SIZE:
+        raise ValueError("スナップショットの長さが不正です")
+
+    randomizer = SNAPSHOT_RANDOMIZERS[randomizer_index]
+    # 同じシードのピース列を保存時と同じ位置まで進める（作成時に引いた分を除く）
+    game = TetrisGame(seed=seed, randomizer=randomizer)
+    game.randomizer.skip(drawn - game.randomizer.drawn)
+
+    game.game_over = bool(flags & SNAPSHOT_GAME_OVER)
+    game.paused = bool(flags & SNAPSHOT_PAUSED)
+    game.is_locked = bool(flags & SNAPSHOT_LOCKED)
+    game.pending_line_clear = bool(flags & SNAPSHOT_PENDING_LINE_CLEAR)
+    game.current_piece = (Tetromino(current_x, current_y, current_shape, current_rotation)
+                          if flags & SNAPSHOT_HAS_CURRENT else None)
+    game.next_piece = (Tetromino(next_x, next_y, next_shape, next_rotation)
+                       if flags & SNAPSHOT_HAS_NEXT else None)
+
+    game.score = score
+    game.lines_cleared = lines_cleared
+    game.level = level
+    game.bombs_available = bombs_available
+    game.fall_speed = fall_speed
+    game.base_fall_speed = base_fall_speed
+    game.speed_multiplier = speed_multiplier
+    game.lock_delay = lock_delay
+    game.line_clear_delay = line_clear_delay
+    game.line_clear_time = line_clear_time
+    game.pending_lines = pending_lines
+    game.lines_cleared_this_frame = lines_cleared_this_frame
+    game.fall_time = now - fall_age
+    game.lock_time = now - lock_age
+    game.line_clear_started = now - line_clear_age if flags & SNAPSHOT_LINE_CLEAR_STARTED else None
+
+    game.bombs = []
+    for offset in range(bombs_offset, board_offset, SNAPSHOT_BOMB.size):
+        x, y, radius, active = SNAPSHOT_BOMB.unpack_from(data, offset)
+        game.bombs.append(Bomb(x, y, radius, bool(active)))
+
+    # ボード（色プレーンと占有ビット）
+    cells = [color for byte in data[board_offset:] for color in _BYTE_COLORS[byte]]
+    for y in range(BOARD_HEIGHT):
+        row = cells[y * BOARD_WIDTH:(y + 1) * BOARD_WIDTH]
+        game.board[y] = row
+        game.row_masks[y] = sum(1 << x for x, cell in enumerate(row) if cell)
+    game.rebuild_stack()
+    game.touch()
+
+    simulation = Simulation(game, now - elapsed, recording,
+                            recording.step_ms if recording is not None else SIMULATION_STEP_MS)
+    simulation.restore_clock(now, now + due_in if flags & SNAPSHOT_HAS_DUE else None)
+    return simulation
+
+
+def new_resume_token() -> str:
+    """推測されにくい再開トークン"""
+    return secrets.token_urlsafe(16)
+
+
+class SnapshotStore:
+    """切断されたゲームのスナップショットを再開トークンで保持するストア
+
+    期限切れ・上限超過の古いものから削除する。再開時に1回だけ取り出せる。
+    """
+
+    def __init__(self, ttl_sec: float = DEFAULT_SNAPSHOT_TTL_SEC,
+                 max_snapshots: int = DEFAULT_MAX_SNAPSHOTS):
+        self.ttl_sec = ttl_sec
+        self.max_snapshots = max_snapshots
+        # 再開トークン → (保存時刻, ゲームID, スナップショット)。古いものから順に並ぶ
+        self._entries: "OrderedDict[str, Tuple[float, str, bytes]]" = OrderedDict()
+
+        # 統計
+        self.saved = 0
+        self.resumed = 0
+        self.expired = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def put(self, token: str, game_id: str, snapshot: bytes):
+        """スナップショットを保存（期限切れ・上限超過の古いものは削除）"""
+        now = time.monotonic()
+        self._entries[token] = (now, game_id, snapshot)
+        self._entries.move_to_end(token)
+        self.saved += 1
+        while self._entries:
+            oldest, (saved_at, _, _) = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_snapshots and now - saved_at < self.ttl_sec:
+                break
+            del self._entries[oldest]
+            self.expired += 1
+
+    def take(self, token: str) -> Optional[Tuple[str, bytes]]:
+        """(ゲームID, スナップショット)を取り出す（同じトークンで二度再開できないように削除する）"""
+        entry = self._entries.pop(token, None)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] >= self.ttl_sec:
+            self.expired += 1
+            return None
+        self.resumed += 1
+        return entry[1], entry[2]
+
+    def stats(self) -> Dict[str, Any]:
+        """ストアの統計"""
+        return {
+            "snapshots": len(self._entries),
+            "bytes": sum(len(entry[2]) for entry in self._entries.values()),
+            "saved": self.saved,
+            "resumed": self.resumed,
+            "expired": self.expired,
+        }
@@ -0,0 +1,175 @@
+import json
+import secrets
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from game import TetrisGame
+from outbox import ClientOutbox
+from protocol import (FRAME_KEY, BinaryStateEncoder, DeltaFrameEncoder, FramePayload,
+                      JsonStateEncoder)
+from scheduler import DEFAULT_BROADCAST_RATE, BroadcastPacer
+
+# 観戦者へ状態を送るレート（Hz、プレイヤーごとの送信レートとは独立）
+SPECTATOR_BROADCAST_RATE = DEFAULT_BROADCAST_RATE
+# 差分フレームでキーフレームを挟む間隔（途中参加・再同期ではキーフレームとそれ以降の差分を送るので、
+# 送信箱のメッセージの最大保持数より小さくする）
+SPECTATOR_KEYFRAME_INTERVAL = 15
+# 1ゲームあたりの観戦者数の上限
+MAX_SPECTATORS_PER_GAME = 1000
+# 観戦するゲームが見つからない・終了したときのクローズコード
+SPECTATE_NOT_FOUND_CLOSE_CODE = 4404
+SPECTATE_END_CLOSE_CODE = 1000
+
+# 観戦フレームの形式（従来のJSON・差分フレーム・バイナリ）
+SPECTATOR_FORMATS = ("json", "delta", "binary")
+
+# エンコードした観戦フレーム（形式, フレーム, キーフレームか）
+SpectatorFrame = Tuple[str, FramePayload, bool]
+
+
+def new_watch_id() -> str:
+    """観戦用のID（スコア検証に使うゲームIDとは別に公開してよいもの）"""
+    return secrets.token_urlsafe(9)
+
+
+def spectator_format(frames: Optional[str] = None, encoding: Optional[str] = None) -> str:
+    """接続時に指定されたフレーム形式（create_encoderと同じ優先順位）"""
+    if encoding == "binary":
+        return "binary"
+    if frames == "delta":
+        return "delta"
+    return "json"
+
+
+def create_spectator_encoder(kind: str) -> Any:
+    """観戦フレーム形式ごとのエンコーダ（ゲームごと・形式ごとに1つを全観戦者で共有する）"""
+    if kind == "binary":
+        return BinaryStateEncoder()
+    if kind == "delta":
+        return DeltaFrameEncoder(keyframe_interval=SPECTATOR_KEYFRAME_INTERVAL)
+    return JsonStateEncoder()
+
+
+class SpectatorEncoders:
+    """観戦されているゲームのフレームを送信枠ごとに形式ごとに1回だけエンコードする
+
+    ゲームを進めるプロセス（シャード利用時はワーカー）で観戦されているゲームにだけ持たせる。
+    エンコードの回数は観戦者数によらず、送信枠ごと・形式ごとに1回になる。
+    """
+
+    def __init__(self, rate: int = SPECTATOR_BROADCAST_RATE):
+        self.encoders: Dict[str, Any] = {}
+        self.pacer = BroadcastPacer(rate)
+
+    def set_formats(self, formats: Iterable[str]):
+        """観戦者がいる形式のエンコーダだけを持つ（新しい形式は最初のフレームがキーフレームになる）"""
+        formats = set(formats)
+        for kind in list(self.encoders):
+            if kind not in formats:
+                del self.encoders[kind]
+        for kind in formats:
+            if kind not in self.encoders:
+                self.encoders[kind] = create_spectator_encoder(kind)
+                self.pacer.mark_dirty()
+
+    def encode(self, game: TetrisGame, now: int) -> List[SpectatorFrame]:
+        """形式ごとに最新の状態をエンコード（前回から変化のない形式は含めない）"""
+        frames = []
+        for kind, encoder in self.encoders.items():
+            if isinstance(encoder, DeltaFrameEncoder):
+                frame = encoder.encode_frame(game.get_game_state())
+                if frame is not None:
+                    frames.append((kind, json.dumps(frame), frame["type"] == FRAME_KEY))
+            else:
+                payload = encoder.encode(game)
+                if payload is not None:
+                    frames.append((kind, payload, True))
+        self.pacer.mark_sent(now)
+        return frames
+
+
+class SpectatorChannel:
+    """1つのゲームの観戦者への配信（受け取ったフレームを全観戦者の送信箱へそのまま入れる）
+
+    各観戦者の送信箱は最新のフレームだけを保持するので、送信が遅れている観戦者は途中のフレームを飛ばす。
+    差分フレームで欠落したクライアントは再同期を要求し、最新のキーフレームとそれ以降の差分を受け取る。
+    途中参加の観戦者も同じ方法で最新のキーフレームから受信を始める。
+    """
+
+    def __init__(self, watch_id: str):
+        self.watch_id = watch_id
+        self.viewers: Dict[str, Set[ClientOutbox]] = {}
+        # 形式ごとの最新のキーフレームとそれ以降の差分フレーム
+        self._keyframes: Dict[str, FramePayload] = {}
+        self._since_key: Dict[str, List[FramePayload]] = {}
+
+        # 統計
+        self.frames_published = 0
+        self.frames_delivered = 0
+
+    def __len__(self) -> int:
+        return sum(len(viewers) for viewers in self.viewers.values())
+
+    @property
+    def formats(self) -> Tuple[str, ...]:
+        """観戦者がいる形式"""
+        return tuple(sorted(kind for kind, viewers in self.viewers.items() if viewers))
+
+    def add(self, outbox: ClientOutbox, kind: str) -> bool:
+        """観戦者を追加して最新のキーフレームから送る（新しい形式が増えた場合はTrue）"""
+        viewers = self.viewers.setdefault(kind, set())
+        added_format = not viewers
+        viewers.add(outbox)
+        self.catch_up(outbox, kind)
+        return added_format
+
+    def remove(self, outbox: ClientOutbox, kind: str) -> bool:
+        """観戦者を削除（その形式の観戦者がいなくなった場合はTrue）"""
+        viewers = self.viewers.get(kind)
+        if viewers is None or outbox not in viewers:
+            return False
+        viewers.discard(outbox)
+        if viewers:
+            return False
+        del self.viewers[kind]
+        self._keyframes.pop(kind, None)
+        self._since_key.pop(kind, None)
+        return True
+
+    def catch_up(self, outbox: ClientOutbox, kind: str):
+        """最新のキーフレームとそれ以降の差分を順に送る（まだなければ次のキーフレームを待つ）"""
+        keyframe = self._keyframes.get(kind)
+        if keyframe is None:
+            return
+        frames = [keyframe] + self._since_key.get(kind, [])
+        for frame in frames[:-1]:
+            outbox.push_message(frame)
+        # 最新のフレームは未送信のフレームと置き換える（送信待ちのフレームより新しい）
+        outbox.push_payload(frames[-1])
+
+    def publish(self, frames: Iterable[SpectatorFrame]) -> List[ClientOutbox]:
+        """エンコード済みのフレームを全観戦者へ入れ、送信が滞っている観戦者の送信箱を返す"""
+        stalled = []
+        for kind, payload, is_key in frames:
+            viewers = self.viewers.get(kind)
+            if not viewers:
+                continue
+            if is_key:
+                self._keyframes[kind] = payload
+                self._since_key[kind] = []
+            elif kind in self._since_key:
+                self._since_key[kind].append(payload)
+            self.frames_published += 1
+            for outbox in viewers:
+                if outbox.closed or outbox.is_stalled():
+                    stalled.append(outbox)
+                    continue
+                outbox.push_payload(payload)
+                self.frames_delivered += 1
+        return stalled
+
+    def close(self):
+        """配信を終了して全観戦者を切断"""
+        for viewers in self.viewers.values():
+            for outbox in viewers:
+                outbox.close(code=SPECTATE_END_CLOSE_CODE)
+        self.viewers.clear()
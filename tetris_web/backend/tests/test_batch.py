@@ -0,0 +1,100 @@
+import random
+from typing import List
+
+import numpy as np
+import pytest
+
+from batch import BATCH_ACTIONS, BatchEngine
+from game import BOARD_HEIGHT, BOARD_WIDTH, TETROMINO_COLORS, ActionType, SevenBagRandomizer, TetrisGame
+
+# セルの色 → BatchEngine の盤面の値（形状番号+1）
+CELL_CODES = {0: 0}
+CELL_CODES.update({color: i + 1 for i, color in enumerate(TETROMINO_COLORS)})
+
+# ランダムに選ぶアクションの重み（BATCH_ACTIONS の順、0は操作なし）
+ACTION_WEIGHTS = [30, 10, 10, 10, 10, 6, 2, 1, 0.5, 1, 1]
+
+
+def prefill(game: TetrisGame, engine: BatchEngine, index: int, rng: random.Random):
+    """下の数行を1マスずつ穴の空いた行で埋める（ライン消去が起きやすいように）"""
+    for r in range(BOARD_HEIGHT - rng.randrange(0, 13), BOARD_HEIGHT):
+        hole = rng.randrange(BOARD_WIDTH)
+        for c in range(BOARD_WIDTH):
+            if c != hole:
+                color = rng.choice(TETROMINO_COLORS)
+                game.board[r][c] = color
+                game.row_masks[r] |= 1 << c
+                engine.board[index, r, c] = CELL_CODES[color]
+        engine.row_occupied[index, r] = True
+    game.rebuild_stack()
+    game.check_stack_height()
+    engine._check_stack_height(np.array([index]))
+
+
+def game_state(game: TetrisGame):
+    piece = game.current_piece
+    return (game.score, game.level, game.lines_cleared, game.bombs_available, game.game_over, game.paused,
+            game.pending_line_clear, game.fall_speed, game.lines_cleared_this_frame,
+            piece.shape_idx, piece.rotation % 4, piece.x, piece.y, game.next_piece.shape_idx)
+
+
+def engine_state(engine: BatchEngine, i: int):
+    return (int(engine.score[i]), int(engine.level[i]), int(engine.lines_cleared[i]),
+            int(engine.bombs_available[i]), bool(engine.game_over[i]), bool(engine.paused[i]),
+            bool(engine.pending_line_clear[i]), int(engine.fall_speed[i]), int(engine.lines_cleared_this_frame[i]),
+            int(engine.piece_shape[i]), int(engine.piece_rotation[i]) % 4, int(engine.piece_x[i]),
+            int(engine.piece_y[i]), int(engine.next_shape[i]))
+
+
+@pytest.mark.parametrize("randomizer", ["uniform", SevenBagRandomizer.name])
+def test_batch_engine_matches_tetris_game(randomizer):
+    count, steps = 64, 1500
+    rng = random.Random(14)
+    seeds = list(range(count))
+    engine = BatchEngine(count, seeds=seeds, randomizer=randomizer, speed_multiplier=1.5)
+    games: List[TetrisGame] = [None] * count
+
+    def new_game(i: int, seed: int):
+        engine.reset([i], [seed], speed_multiplier=1.5)
+        games[i] = game = TetrisGame(seed=seed, randomizer=randomizer)
+        game.speed_multiplier = 1.5
+        game.bombs_available = engine.bombs_available[i] = 2
+        # 爆弾の獲得（BOMB_LINES_REQUIRED ラインごと）の直前から始めることもある
+        game.lines_cleared = engine.lines_cleared[i] = rng.randrange(10)
+        prefill(game, engine, i, rng)
+
+    for i, seed in enumerate(seeds):
+        new_game(i, seed)
+
+    divergences = 0
+    lines = bombs_earned = 0
+    for step in range(steps):
+        actions = np.array(rng.choices(range(len(BATCH_ACTIONS)), weights=ACTION_WEIGHTS, k=count))
+        bomb_x = np.array([rng.randrange(BOARD_WIDTH) for _ in range(count)])
+        bomb_y = np.array([rng.randrange(BOARD_HEIGHT) for _ in range(count)])
+        engine.step(actions, bomb_x, bomb_y)
+        for i, game in enumerate(games):
+            action = BATCH_ACTIONS[actions[i]]
+            lines_before, bombs_before = game.lines_cleared, game.bombs_available
+            if action == ActionType.PLACE_BOMB:
+                game.perform_action(action, x=int(bomb_x[i]), y=int(bomb_y[i]))
+            elif action is not None:
+                game.perform_action(action)
+            game.update(engine.time)
+            lines += game.lines_cleared - lines_before
+            bombs_earned += game.bombs_available > bombs_before
+
+            if game_state(game) != engine_state(engine, i):
+                divergences += 1
+            elif step % 25 == 0 or game.game_over:
+                board = np.array([[CELL_CODES[cell] for cell in row] for row in game.board], dtype=np.uint8)
+                divergences += not np.array_equal(board, engine.board[i])
+
+            # 終わったゲームは両方とも新しいシードでやり直す
+            if game.game_over:
+                seeds.append(len(seeds))
+                new_game(i, seeds[-1])
+
+    assert divergences == 0
+    # ライン消去・爆弾獲得も比べられていること
+    assert lines > count and bombs_earned > 0
@@ -0,0 +1,25 @@
+from game import ActionType, TetrisGame
+
+
+def test_bomb_on_empty_cells_bumps_state_version():
+    game = TetrisGame(seed=1)
+    game.bombs_available = 1
+    game.perform_action(ActionType.PLACE_BOMB, x=0, y=19)
+    assert game.get_game_state()["bombs"][0]["active"] is True
+    version = game.state_version
+
+    game.update(1)
+
+    assert game.bombs[0].active is False
+    assert game.state_version != version
+    assert game.get_game_state()["bombs"][0]["active"] is False
+
+
+def test_speed_multiplier_is_clamped():
+    from game import MAX_SPEED_MULTIPLIER, MIN_SPEED_MULTIPLIER, parse_speed_multiplier
+
+    assert parse_speed_multiplier(0.001) == MIN_SPEED_MULTIPLIER
+    assert parse_speed_multiplier(100) == MAX_SPEED_MULTIPLIER
+    assert parse_speed_multiplier("1.5") == 1.5
+    assert parse_speed_multiplier("fast") == 1.0
+    assert parse_speed_multiplier(float("nan")) == 1.0
@@ -0,0 +1,141 @@
+import random
+import struct
+
+import pytest
+
+from game import BOARD_HEIGHT, BOARD_WIDTH, ActionType, TetrisGame
+from protocol import (ACTION_OPCODES, BINARY_FRAME_STATE, BINARY_FRAME_STATE_ACK, BINARY_FRAME_STATE_HASH,
+                      BOMB_RECORD, COLOR_INDEX, FLAG_GAME_OVER, FLAG_HAS_CURRENT, FLAG_HAS_NEXT, FLAG_PAUSED,
+                      INPUT_SEQ, OPCODE_SEQ_FLAG, STATE_HEADER, BinaryStateEncoder, decode_binary_action,
+                      state_hash)
+
+INDEX_COLOR = {index: color for color, index in COLOR_INDEX.items()}
+
+
+def decode_state_frame(frame: bytes):
+    """クライアントと同じ手順でバイナリ状態フレームを読む"""
+    (kind, seq, flags, score, level, lines, bombs_available, speed, lines_this_frame,
+     x, y, shape_idx, rotation, next_shape, bomb_count) = STATE_HEADER.unpack_from(frame, 0)
+    offset = STATE_HEADER.size
+    cells = frame[offset:offset + BOARD_WIDTH * BOARD_HEIGHT]
+    board = [[INDEX_COLOR[cells[r * BOARD_WIDTH + c]] for c in range(BOARD_WIDTH)] for r in range(BOARD_HEIGHT)]
+    offset += BOARD_WIDTH * BOARD_HEIGHT
+    bombs = []
+    for _ in range(bomb_count):
+        bomb_x, bomb_y, active = BOMB_RECORD.unpack_from(frame, offset)
+        bombs.append({"x": bomb_x, "y": bomb_y, "active": bool(active)})
+        offset += BOMB_RECORD.size
+    state = {
+        "board": board,
+        "current_piece": {"x": x, "y": y, "shape_idx": shape_idx, "rotation": rotation}
+        if flags & FLAG_HAS_CURRENT else None,
+        "next_shape_idx": next_shape if flags & FLAG_HAS_NEXT else None,
+        "bombs": bombs,
+        "game_over": bool(flags & FLAG_GAME_OVER),
+        "paused": bool(flags & FLAG_PAUSED),
+        "score": score,
+        "level": level,
+        "lines_cleared": lines,
+        "bombs_available": bombs_available,
+        "speed_multiplier": speed,
+        "lines_cleared_this_frame": lines_this_frame,
+    }
+    return kind, seq, state, frame[offset:]
+
+
+def expected_state(game: TetrisGame):
+    piece = game.current_piece
+    return {
+        "board": [list(row) for row in game.board],
+        "current_piece": {"x": piece.x, "y": piece.y, "shape_idx": piece.shape_idx,
+                          "rotation": piece.rotation % 4} if piece else None,
+        "next_shape_idx": game.next_piece.shape_idx if game.next_piece else None,
+        "bombs": [{"x": bomb.x, "y": bomb.y, "active": bomb.active} for bomb in game.bombs],
+        "game_over": game.game_over,
+        "paused": game.paused,
+        "score": game.score,
+        "level": game.level,
+        "lines_cleared": game.lines_cleared,
+        "bombs_available": game.bombs_available,
+        "speed_multiplier": game.speed_multiplier,
+        "lines_cleared_this_frame": game.lines_cleared_this_frame,
+    }
+
+
+def played_games(count: int, steps: int):
+    """ランダムな操作で進めながら、途中の状態を1ステップずつ返す"""
+    rng = random.Random(3)
+    actions = [ActionType.LEFT, ActionType.RIGHT, ActionType.DOWN, ActionType.ROTATE,
+               ActionType.HARD_DROP, ActionType.SPEED_UP, ActionType.SPEED_DOWN]
+    for seed in range(count):
+        game = TetrisGame(seed=seed)
+        game.bombs_available = 3
+        for step in range(steps):
+            roll = rng.random()
+            if roll < 0.03:
+                game.perform_action(ActionType.PLACE_BOMB, x=rng.randrange(BOARD_WIDTH), y=rng.randrange(BOARD_HEIGHT))
+            elif roll < 0.05:
+                game.perform_action(ActionType.SPAWN_BOMB)
+            elif roll < 0.06:
+                game.perform_action(ActionType.PAUSE)
+            else:
+                game.perform_action(rng.choice(actions))
+            game.update(step * 16)
+            yield game
+
+
+@pytest.mark.parametrize("ack, hashes", [(None, False), (7, False), (None, True), (2 ** 32 + 5, True)])
+def test_binary_state_frame_round_trip(ack, hashes):
+    encoder = BinaryStateEncoder(hashes=hashes)
+    encoder.ack = ack
+    last_seq = 0
+    for game in played_games(4, 300):
+        encoder.request_keyframe()
+        frame = encoder.encode(game)
+
+        kind, seq, state, trailer = decode_state_frame(frame)
+        assert seq == last_seq + 1
+        last_seq = seq
+        assert state == expected_state(game)
+        if hashes:
+            assert kind == BINARY_FRAME_STATE_HASH
+            assert struct.unpack("<II", trailer) == ((ack or 0) & 0xFFFFFFFF, state_hash(game))
+        elif ack is not None:
+            assert kind == BINARY_FRAME_STATE_ACK
+            assert INPUT_SEQ.unpack(trailer) == (ack & 0xFFFFFFFF,)
+        else:
+            assert kind == BINARY_FRAME_STATE
+            assert trailer == b""
+
+
+def test_binary_state_frame_skips_unchanged_state():
+    encoder = BinaryStateEncoder()
+    game = TetrisGame(seed=1)
+    assert encoder.encode(game) is not None
+    assert encoder.encode(game) is None
+    game.perform_action(ActionType.LEFT)
+    assert encoder.encode(game) is not None
+
+
+@pytest.mark.parametrize("seq", [None, 0, 12345, 2 ** 32 - 1])
+def test_binary_action_round_trip(seq):
+    for action, opcode in ACTION_OPCODES.items():
+        data = bytes([opcode])
+        expected = {"action": action}
+        if seq is not None:
+            data = bytes([opcode | OPCODE_SEQ_FLAG]) + INPUT_SEQ.pack(seq)
+            expected["seq"] = seq
+        if action == "place_bomb":
+            data += struct.pack("<bb", 3, 17)
+            expected.update(x=3, y=17)
+        elif action == "start":
+            data += struct.pack("<f", 1.5)
+            expected["initial_speed_multiplier"] = 1.5
+        assert decode_binary_action(data) == expected
+
+
+def test_binary_action_rejects_unknown_opcodes():
+    with pytest.raises(ValueError):
+        decode_binary_action(b"")
+    with pytest.raises(ValueError):
+        decode_binary_action(bytes([0x7F]))
@@ -0,0 +1,90 @@
+import random
+
+from game import BOARD_HEIGHT, BOARD_WIDTH, CYAN, ROTATIONS, TETROMINOS, TetrisGame, Tetromino
+
+
+# 壁キック表を使う前の rotate_piece が試していた位置（その場→左右1・2マス→上1マス）
+REFERENCE_KICKS = ((0, 0), (-1, 0), (1, 0), (-2, 0), (2, 0), (0, -1))
+
+
+def fill_board(game: TetrisGame, rng: random.Random, density: float):
+    """ボードの色プレーンと占有ビットを同じ乱数の内容で埋める"""
+    for r in range(BOARD_HEIGHT):
+        mask = 0
+        for c in range(BOARD_WIDTH):
+            filled = rng.random() < density
+            game.board[r][c] = CYAN if filled else 0
+            if filled:
+                mask |= 1 << c
+        game.row_masks[r] = mask
+    game.rebuild_stack()
+
+
+def reference_is_valid_move(game: TetrisGame, x: int, y: int, shape) -> bool:
+    """ビットマスク化する前の is_valid_move（セルごとに色プレーンを調べる）"""
+    for r, row in enumerate(shape):
+        for c, cell in enumerate(row):
+            if cell:
+                new_x = x + c
+                new_y = y + r
+                if (new_x < 0 or new_x >= BOARD_WIDTH or
+                        new_y >= BOARD_HEIGHT or
+                        (new_y >= 0 and game.board[new_y][new_x])):
+                    return False
+    return True
+
+
+def reference_rotation(shape_idx: int, rotation: int):
+    """回転表を使う前の形状（Tetromino.rotate をrotation回適用）"""
+    shape = Tetromino(0, 0, shape_idx).shape
+    for _ in range(rotation):
+        shape = Tetromino.rotate(shape)
+    return shape
+
+
+def test_rotation_table_matches_rotate():
+    for shape_idx in range(-1, len(TETROMINOS)):
+        for rotation in range(4):
+            expected = reference_rotation(shape_idx, rotation)
+            table = ROTATIONS[shape_idx][rotation]
+            assert [list(row) for row in table.shape] == expected
+            assert table.width == len(expected[0]) and table.height == len(expected)
+
+
+def test_fits_matches_cell_check():
+    rng = random.Random(6)
+    game = TetrisGame(seed=6)
+    for density in (0.0, 0.2, 0.5, 0.8):
+        for _ in range(5):
+            fill_board(game, rng, density)
+            for shape_idx in range(-1, len(TETROMINOS)):
+                for rotation in range(4):
+                    piece = Tetromino(0, 0, shape_idx, rotation)
+                    shape = reference_rotation(shape_idx, rotation)
+                    for x in range(-4, BOARD_WIDTH + 2):
+                        for y in range(-4, BOARD_HEIGHT + 2):
+                            expected = reference_is_valid_move(game, x, y, shape)
+                            assert game.piece_fits(piece, x, y) == expected, (shape_idx, rotation, x, y)
+                            assert game.is_valid_move(x, y, shape) == expected, (shape_idx, rotation, x, y)
+
+
+def test_rotate_piece_matches_reference_kicks():
+    rng = random.Random(7)
+    game = TetrisGame(seed=7)
+    for _ in range(300):
+        fill_board(game, rng, rng.choice((0.1, 0.3, 0.5)))
+        shape_idx = rng.randrange(len(TETROMINOS))
+        piece = Tetromino(rng.randrange(-1, BOARD_WIDTH), rng.randrange(-2, BOARD_HEIGHT),
+                          shape_idx, rng.randrange(4))
+        game.current_piece = piece
+
+        shape = reference_rotation(shape_idx, (piece.rotation + 1) % 4)
+        expected = (piece.x, piece.y, piece.rotation)
+        for dx, dy in REFERENCE_KICKS:
+            if reference_is_valid_move(game, piece.x + dx, piece.y + dy, shape):
+                expected = (piece.x + dx, piece.y + dy, (piece.rotation + 1) % 4)
+                break
+        expected_rotated = expected[2] != piece.rotation
+
+        assert game.rotate_piece() == expected_rotated
+        assert (piece.x, piece.y, piece.rotation % 4) == expected
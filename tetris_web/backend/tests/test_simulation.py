@@ -0,0 +1,51 @@
+import random
+
+import pytest
+
+from bot import BotPlayer
+from game import ActionType, SevenBagRandomizer, UniformRandomizer
+from protocol import state_hash
+from simulation import Simulation, replay
+
+# ボットの操作に混ぜるランダムなアクション（爆弾はクライアントと同じメッセージ形式で送る）
+NOISE_ACTIONS = [ActionType.LEFT, ActionType.RIGHT, ActionType.DOWN, ActionType.ROTATE,
+                 ActionType.SPEED_UP, ActionType.SPEED_DOWN]
+
+
+# 1ゲームの仮想時間の上限（ミリ秒）
+GAME_MS = 60 * 1000
+
+
+def noisy_bot_policy(rng: random.Random):
+    """ラインを消しながら進むように、ボットの操作にランダムな操作・爆弾を混ぜたポリシー"""
+    bot = BotPlayer(actions_per_call=2)
+
+    def policy(game):
+        roll = rng.random()
+        if roll < 0.05:
+            return [{"action": "place_bomb", "x": rng.randrange(10), "y": rng.randrange(20)}]
+        if roll < 0.08:
+            return [{"action": "spawn_bomb"}]
+        if roll < 0.2:
+            return [rng.choice(NOISE_ACTIONS)]
+        return bot(game)
+    return policy
+
+
+@pytest.mark.parametrize("randomizer", [UniformRandomizer.name, SevenBagRandomizer.name])
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_replay_reproduces_recorded_game(randomizer, seed):
+    simulation = Simulation.recorded(1000 + seed, randomizer=randomizer, speed_multiplier=1.5, seed=seed)
+    game = simulation.run_until_game_over(noisy_bot_policy(random.Random(seed)), interval_ms=37,
+                                          max_ms=GAME_MS)
+    assert game.lines_cleared > 0
+
+    # 記録の最後の操作から元のゲームを止めた時刻まで進める
+    recording = simulation.recording
+    replayed = replay(recording, max_ms=simulation.now - recording.start_time - recording.actions[-1][0])
+
+    assert replayed.game_over == game.game_over
+    assert (replayed.score, replayed.level, replayed.lines_cleared) == \
+        (game.score, game.level, game.lines_cleared)
+    assert replayed.board == game.board
+    assert state_hash(replayed) == state_hash(game)
@@ -0,0 +1,78 @@
+import random
+
+import pytest
+
+from bot import BotPlayer
+from game import SevenBagRandomizer
+from protocol import state_hash
+from simulation import Simulation
+from snapshot import decode_snapshot, encode_snapshot
+
+
+def test_slow_game_snapshot_encodes():
+    simulation = Simulation.recorded(0, speed_multiplier=0.001)
+    simulation.game.check_stack_height()
+    simulation.advance_to(1000)
+
+    data = encode_snapshot(simulation)
+
+    restored = decode_snapshot(data, simulation.now, simulation.recording)
+    assert restored.game.fall_speed == simulation.game.fall_speed
+    assert encode_snapshot(restored) == data
+
+
+def play(simulation: Simulation, rng: random.Random, bot: BotPlayer, steps: int):
+    """ボットの操作に爆弾・一時停止を混ぜて進め、適用した操作を (時刻, 操作) で返す"""
+    applied = []
+    for _ in range(steps):
+        if simulation.game.game_over:
+            break
+        roll = rng.random()
+        if roll < 0.03:
+            actions = [{"action": "place_bomb", "x": rng.randrange(10), "y": rng.randrange(20)}]
+        elif roll < 0.05:
+            actions = [{"action": "spawn_bomb"}]
+        elif roll < 0.06:
+            actions = [{"action": "pause"}]
+        else:
+            actions = bot(simulation.game) or []
+        simulation.apply(actions)
+        applied.append((simulation.now, actions))
+        simulation.advance(rng.choice((7, 16, 40, 100)))
+    return applied
+
+
+def snapshot_state(simulation: Simulation):
+    game = simulation.game
+    return (game.board, game.score, game.lines_cleared, game.level, game.bombs_available, game.game_over,
+            game.paused, game.pending_line_clear, game.fall_speed, state_hash(game),
+            [(bomb.x, bomb.y, bomb.active) for bomb in game.bombs],
+            game.next_piece.shape_idx if game.next_piece else None)
+
+
+@pytest.mark.parametrize("seed", range(6))
+def test_snapshot_round_trip(seed):
+    rng = random.Random(seed)
+    simulation = Simulation.recorded(500, randomizer=SevenBagRandomizer.name if seed % 2 else "uniform",
+                                     speed_multiplier=1.25, seed=seed)
+    simulation.game.bombs_available = 2
+    bot = BotPlayer(actions_per_call=2)
+
+    # 途中のどの状態でも、同じ時刻に復元すれば同じバイト列にエンコードされる
+    for _ in range(100):
+        play(simulation, rng, bot, 5)
+        data = encode_snapshot(simulation)
+        assert encode_snapshot(decode_snapshot(data, simulation.now, simulation.recording)) == data
+
+    # 切断から時間が経ってから復元しても、同じ操作を続ければ同じゲームになる
+    delay = rng.randrange(1, 100000)
+    restored = decode_snapshot(encode_snapshot(simulation), simulation.now + delay)
+    assert snapshot_state(restored) == snapshot_state(simulation)
+    for _ in range(300):
+        for now, actions in play(simulation, rng, bot, 1):
+            restored.advance_to(now + delay)
+            restored.apply(actions)
+            restored.advance_to(simulation.now + delay)
+            assert snapshot_state(restored) == snapshot_state(simulation)
+    restored.advance_to(simulation.now + delay)
+    assert snapshot_state(restored) == snapshot_state(simulation)
@@ -0,0 +1,205 @@
+import asyncio
+import dataclasses
+import multiprocessing
+import secrets
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from simulation import GameRecording, replay
+
+# 再生を行うワーカープロセス数（0の場合はスレッドで実行）
+DEFAULT_VERIFY_WORKERS = 2
+# 提出をまとめて1回の再生依頼にする待ち時間（秒）
+DEFAULT_BATCH_WINDOW_SEC = 0.01
+# 1回の再生依頼にまとめる最大件数
+DEFAULT_MAX_BATCH = 64
+# 記録の保持期間（秒）と最大保持数
+DEFAULT_RECORDING_TTL_SEC = 3600
+DEFAULT_MAX_RECORDINGS = 10000
+
+
+def new_game_id() -> str:
+    """推測されにくいゲームID"""
+    return secrets.token_urlsafe(12)
+
+
+def replay_batch(recordings: List[GameRecording]) -> List[Tuple[int, int, int, float]]:
+    """記録をまとめて再生し、(スコア, レベル, ライン数, CPU時間ms)を返す（ワーカープロセスで実行）"""
+    results = []
+    for recording in recordings:
+        started = time.process_time()
+        game = replay(recording)
+        cpu_ms = (time.process_time() - started) * 1000
+        results.append((game.score, game.level, game.lines_cleared, cpu_ms))
+    return results
+
+
+@dataclass
+class VerificationResult:
+    """スコア検証の結果（再生で得られた値を含む）"""
+    verified: bool
+    score: int = 0
+    level: int = 0
+    lines_cleared: int = 0
+    reason: Optional[str] = None
+
+
+class ScoreVerifier:
+    """ゲームの記録を保持し、提出されたスコアを記録の再生で検証するサービス
+
+    進行中のゲームの記録は期限・上限なしで保持し、ゲームが終わってから期限を数える
+    （シャード利用時はゲームオーバー時・切断時に登録する）。提出時に1回だけ取り出す。
+    短い待ち時間の間に届いた提出はまとめてワーカープロセスで再生し、イベントループを塞がない。
+    """
+
+    def __init__(self, workers: int = DEFAULT_VERIFY_WORKERS,
+                 batch_window_sec: float = DEFAULT_BATCH_WINDOW_SEC,
+                 max_batch: int = DEFAULT_MAX_BATCH,
+                 recording_ttl_sec: float = DEFAULT_RECORDING_TTL_SEC,
+                 max_recordings: int = DEFAULT_MAX_RECORDINGS):
+        self.workers = workers
+        self.batch_window_sec = batch_window_sec
+        self.max_batch = max_batch
+        self.recording_ttl_sec = recording_ttl_sec
+        self.max_recordings = max_recordings
+
+        self._executor: Optional[ProcessPoolExecutor] = None
+        # ゲームID → (登録時刻, 記録)。終わったゲームの記録で、古いものから順に並ぶ
+        self._recordings: "OrderedDict[str, Tuple[float, GameRecording]]" = OrderedDict()
+        # ゲームID → 記録。進行中のゲームの記録（期限切れ・上限超過では削除しない）
+        self._live: Dict[str, GameRecording] = {}
+        self._pending: List[Tuple[GameRecording, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+
+        # 統計
+        self.verified = 0
+        self.rejected = 0
+        self.batches = 0
+        self.replays = 0
+        self.replay_cpu_ms = 0.0
+
+    def start(self):
+        """再生用のワーカープロセス群を用意（プロセスは最初の依頼時に起動される）"""
+        if self.workers > 0 and self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def stop(self):
+        """ワーカープロセス群を停止"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def register(self, game_id: str, recording: GameRecording):
+        """ゲームの記録を登録（期限切れ・上限超過の古い記録は削除）"""
+        now = time.monotonic()
+        self._recordings[game_id] = (now, recording)
+        self._recordings.move_to_end(game_id)
+        while self._recordings:
+            oldest_id, (registered_at, _) = next(iter(self._recordings.items()))
+            if len(self._recordings) <= self.max_recordings and now - registered_at < self.recording_ttl_sec:
+                break
+            del self._recordings[oldest_id]
+
+    def track(self, game_id: str, recording: GameRecording):
+        """進行中のゲームの記録を登録（finish() まで期限・上限の対象にしない）"""
+        self._recordings.pop(game_id, None)
+        self._live[game_id] = recording
+
+    def finish(self, game_id: str):
+        """進行中のゲームが終わった（ここから期限を数える。提出済みなら何もしない）"""
+        recording = self._live.pop(game_id, None)
+        if recording is not None:
+            self.register(game_id, recording)
+
+    def recording(self, game_id: str) -> Optional[GameRecording]:
+        """登録済みの記録を取り出さずに返す（再開したゲームで記録を続けるため）"""
+        if game_id in self._live:
+            return self._live[game_id]
+        entry = self._recordings.get(game_id)
+        if entry is None or time.monotonic() - entry[0] >= self.recording_ttl_sec:
+            return None
+        return entry[1]
+
+    def _take(self, game_id: str) -> Optional[GameRecording]:
+        """記録を取り出す（同じゲームで二度提出できないように削除する）"""
+        recording = self._live.pop(game_id, None)
+        if recording is None:
+            entry = self._recordings.pop(game_id, None)
+            if entry is None or time.monotonic() - entry[0] >= self.recording_ttl_sec:
+                return None
+            recording = entry[1]
+        # 進行中のゲームの記録は追記され続けるので、この時点の写しを再生する
+        return dataclasses.replace(recording, actions=list(recording.actions))
+
+    async def verify(self, game_id: Optional[str], score: int, level: int,
+                     lines_cleared: int) -> VerificationResult:
+        """記録を再生し、提出された値と一致するか検証"""
+        recording = self._take(game_id) if game_id else None
+        if recording is None:
+            self.rejected += 1
+            return VerificationResult(False, reason="ゲームの記録が見つかりません")
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((recording, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(
+                self.batch_window_sec, self._flush)
+
+        replayed_score, replayed_level, replayed_lines = await future
+        result = VerificationResult(True, replayed_score, replayed_level, replayed_lines)
+        if (replayed_score, replayed_level, replayed_lines) != (score, level, lines_cleared):
+            result.verified = False
+            result.reason = "提出されたスコアが記録の再生結果と一致しません"
+            self.rejected += 1
+        else:
+            self.verified += 1
+        return result
+
+    def _flush(self):
+        """保留中の提出を1回の再生依頼として送る"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.ensure_future(self._run_batch(batch))
+
+    async def _run_batch(self, batch: List[Tuple[GameRecording, asyncio.Future]]):
+        recordings = [recording for recording, _ in batch]
+        try:
+            if self._executor is not None:
+                results = await asyncio.get_running_loop().run_in_executor(
+                    self._executor, replay_batch, recordings)
+            else:
+                results = await asyncio.to_thread(replay_batch, recordings)
+        except Exception as e:
+            print(f"スコア検証エラー: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.replays += len(results)
+        for (_, future), (score, level, lines_cleared, cpu_ms) in zip(batch, results):
+            self.replay_cpu_ms += cpu_ms
+            if not future.done():
+                future.set_result((score, level, lines_cleared))
+
+    def stats(self) -> Dict[str, Any]:
+        """検証の統計"""
+        return {
+            "workers": self.workers,
+            "recordings": len(self._recordings) + len(self._live),
+            "live_recordings": len(self._live),
+            "verified": self.verified,
+            "rejected": self.rejected,
+            "batches": self.batches,
+            "avg_replay_cpu_ms": self.replay_cpu_ms / self.replays if self.replays else None,
+        }
@@ -1,3 +1,92 @@
+// バイナリ通信形式の定義（backend/protocol.py・backend/game.pyと対応）
+const ACTION_OPCODES = {
+    start: 0x01, left: 0x02, right: 0x03, down: 0x04, rotate: 0x05,
+    hard_drop: 0x06, place_bomb: 0x07, spawn_bomb: 0x08, pause: 0x09,
+    speed_up: 0x0A, speed_down: 0x0B, resync: 0x0C
+};
+// 通番付きのアクションのオペコードに立てるビット（オペコードの直後に4バイトの通番が続く）
+const OPCODE_SEQ_FLAG = 0x80;
+// 処理済みの入力の通番が末尾に付いた状態フレームの種別（状態ハッシュ付きはさらにハッシュが続く）
+const BINARY_FRAME_STATE_ACK = 2;
+const BINARY_FRAME_STATE_HASH = 3;
+// 手元で結果を予測して先に描画する操作（サーバーの応答で答え合わせする）
+const PREDICTED_ACTIONS = ['left', 'right', 'down', 'rotate'];
+
+// 状態ハッシュ（backend/protocol.pyのstate_hashと同じCRC32）
+const CRC32_TABLE = (() => {
+    const table = new Uint32Array(256);
+    for (let n = 0; n < 256; n++) {
+        let c = n;
+        for (let k = 0; k < 8; k++) {
+            c = (c & 1) ? (0xEDB88320 ^ (c >>> 1)) : (c >>> 1);
+        }
+        table[n] = c >>> 0;
+    }
+    return table;
+})();
+
+function stateHash(state) {
+    // 行ごとの占有ビットマスク（2バイトずつ）と現在のピースの形状番号・回転・x・y（1バイトずつ）
+    const bytes = [];
+    state.board.forEach(row => {
+        let mask = 0;
+        row.forEach((cell, x) => {
+            if (cell) mask |= 1 << x;
+        });
+        bytes.push(mask & 0xFF, mask >>> 8);
+    });
+    const piece = state.current_piece;
+    if (piece) {
+        bytes.push(piece.shape_idx & 0xFF, piece.rotation, piece.x & 0xFF, piece.y & 0xFF);
+    }
+    let crc = 0xFFFFFFFF;
+    for (const byte of bytes) {
+        crc = CRC32_TABLE[(crc ^ byte) & 0xFF] ^ (crc >>> 8);
+    }
+    return (crc ^ 0xFFFFFFFF) >>> 0;
+}
+const TETROMINO_SHAPES = [
+    [[1, 1, 1, 1]],
+    [[1, 1], [1, 1]],
+    [[0, 1, 0], [1, 1, 1]],
+    [[1, 0, 0], [1, 1, 1]],
+    [[0, 0, 1], [1, 1, 1]],
+    [[0, 1, 1], [1, 1, 0]],
+    [[1, 1, 0], [0, 1, 1]]
+];
+const TETROMINO_RGB = [
+    [0, 255, 255], [255, 255, 0], [128, 0, 128], [255, 165, 0],
+    [0, 0, 255], [0, 255, 0], [255, 0, 0]
+];
+const BOMB_RGB = [255, 50, 50];
+const GARBAGE_RGB = [128, 128, 128];
+// 色番号 → RGB（0は空セル）
+const BINARY_COLORS = [0, ...TETROMINO_RGB, BOMB_RGB, GARBAGE_RGB];
+
+function pieceColor(shapeIdx) {
+    return shapeIdx === -1 ? BOMB_RGB : TETROMINO_RGB[shapeIdx];
+}
+
+function rotatedShape(shapeIdx, rotation) {
+    // サーバーのTetromino.rotate()と同じ時計回り90度回転
+    let shape = shapeIdx === -1 ? [[1]] : TETROMINO_SHAPES[shapeIdx];
+    for (let i = 0; i < rotation; i++) {
+        const rows = shape.length;
+        const cols = shape[0].length;
+        const rotated = [];
+        for (let c = 0; c < cols; c++) {
+            rotated.push(new Array(rows).fill(0));
+        }
+        for (let r = 0; r < rows; r++) {
+            for (let c = 0; c < cols; c++) {
+                rotated[c][rows - 1 - r] = shape[r][c];
+            }
+        }
+        shape = rotated;
+    }
+    return shape;
+}
+
 class TetrisWebGame {
     constructor() {
         this.gameBoard = document.getElementById('gameBoard');
@@ -33,6 +122,31 @@ class TetrisWebGame {
         this.lastNextPiece = null;
         this.renderScheduled = false;
         
+        // 通信形式（'binary': バイナリ、'delta': JSON差分フレーム、'json': 従来形式）
+        this.wireProtocol = 'binary';
+        
+        // 差分フレーム用の変数（最後に受信したフレーム番号と復元済みの状態）
+        this.frameSeq = 0;
+        this.frameState = null;
+        
+        // 現在のゲームのID（サーバーがゲーム開始時に通知し、スコア送信時に検証に使う）
+        this.gameId = null;
+        
+        // 再開トークン（切断後の自動再接続で同じゲームを続けるために使う）
+        this.resumeToken = null;
+        
+        // 入力の通番（サーバーは処理済みの通番を状態フレームの ack で返す）
+        this.inputSeq = 0;
+        this.inputSentAt = new Map(); // 通番 → 送信時刻（応答待ち）
+        this.inputLatency = null; // 最後に処理された入力の送信から応答までの時間（ミリ秒）
+        
+        // 操作の予測（サーバーから届いたピースの規則で手元の結果を先に描画し、応答が届いたら答え合わせする）
+        this.predict = true;
+        this.pieceRules = null;
+        this.lastAck = 0;
+        this.pendingInputs = []; // 予測して描画済みでサーバーの処理待ちの入力 {seq, action}
+        this.authoritativeState = null; // 最後にサーバーから届いた状態
+        
         // 難易度設定
         this.selectedDifficulty = 1.0; // デフォルトは普通（1.0倍速）
         
@@ -110,6 +224,7 @@ class TetrisWebGame {
             this.isConnected = false;
             this.gameStarted = false; // 一旦falseにしてから接続後にtrueに
             this.returnToOP = false; // 新規ゲーム開始なので自動再接続を許可
+            this.resumeToken = null; // 新規ゲームなので前のゲームは再開しない
             
             // ゲームオーバー画面を確実に隠す
             const gameOverElement = document.getElementById('gameOver');
@@ -378,11 +493,33 @@ class TetrisWebGame {
         }
     }
     
-    connectWebSocket() {
+    connectWebSocket(resume = false) {
         const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-        const wsUrl = `${protocol}//${window.location.host}/ws`;
+        const params = new URLSearchParams({
+            binary: 'encoding=binary',
+            delta: 'frames=delta',
+            json: ''
+        }[this.wireProtocol] || '');
+        // 自動再接続では切断前のゲームの再開を要求する
+        if (resume && this.resumeToken) {
+            params.set('resume', this.resumeToken);
+        }
+        // 予測モード（ピースの規則が最初に届き、フレームに状態ハッシュが付く）
+        if (this.predict) {
+            params.set('predict', '1');
+        }
+        const query = params.toString() ? `?${params}` : '';
+        const wsUrl = `${protocol}//${window.location.host}/ws${query}`;
+        
+        // 新しい接続ではキーフレームから受信し直す
+        this.frameSeq = 0;
+        this.frameState = null;
+        this.inputSentAt.clear();
+        this.pendingInputs = [];
+        this.lastAck = 0;
         
         this.ws = new WebSocket(wsUrl);
+        this.ws.binaryType = 'arraybuffer';
         
         this.ws.onopen = () => {
             this.isConnected = true;
@@ -391,8 +528,13 @@ class TetrisWebGame {
         
         this.ws.onmessage = (event) => {
             try {
-                const gameState = JSON.parse(event.data);
-                this.updateGameState(gameState);
+                const gameState = event.data instanceof ArrayBuffer
+                    ? this.decodeBinaryFrame(event.data)
+                    : this.applyFrame(JSON.parse(event.data));
+                if (gameState) {
+                    this.authoritativeState = gameState;
+                    this.updateGameState(this.reconcile(gameState));
+                }
             } catch (error) {
                 console.error('WebSocketメッセージの解析エラー:', error);
             }
@@ -403,7 +545,7 @@ class TetrisWebGame {
             console.log('WebSocket接続が切れました');
             // OP画面からの開始時は自動再接続しない
             if (this.gameStarted && !this.returnToOP) {
-                setTimeout(() => this.connectWebSocket(), 3000);
+                setTimeout(() => this.connectWebSocket(true), 3000);
             }
         };
         
@@ -413,6 +555,224 @@ class TetrisWebGame {
         };
     }
     
+    applyFrame(frame) {
+        // 予測モードのピースの規則（出現位置・回転表・壁キックの順）
+        if (frame.type === 'rules') {
+            this.pieceRules = frame;
+            return null;
+        }
+        
+        // ゲーム開始・再開の通知：スコア送信時の検証に使うゲームIDと再開トークンを保持する
+        if (frame.type === 'game') {
+            this.gameId = frame.game_id;
+            this.resumeToken = frame.resume_token;
+            if (frame.resumed) {
+                console.log('切断前のゲームを再開しました');
+            }
+            return null;
+        }
+        
+        if (frame.ack !== undefined) {
+            this.acknowledgeInput(frame.ack);
+        }
+        
+        // キーフレーム：状態を丸ごと置き換える
+        if (frame.type === 'key') {
+            this.frameSeq = frame.seq;
+            this.frameState = frame.state;
+            return this.frameState;
+        }
+        
+        // 差分フレーム：欠落があればキーフレームを要求して破棄
+        if (frame.type === 'delta') {
+            if (!this.frameState || frame.seq !== this.frameSeq + 1) {
+                // 再同期の要求は欠落を検知したときの1回だけ送る
+                if (this.frameState && this.ws && this.ws.readyState === WebSocket.OPEN) {
+                    this.ws.send(JSON.stringify({ action: 'resync' }));
+                }
+                this.frameState = null;
+                return null;
+            }
+            this.frameSeq = frame.seq;
+            if (frame.cells) {
+                frame.cells.forEach(([x, y, cell]) => {
+                    this.frameState.board[y][x] = cell;
+                });
+            }
+            if (frame.fields) {
+                Object.assign(this.frameState, frame.fields);
+            }
+            // 復元した状態がサーバーと食い違っていればキーフレームを要求して破棄
+            if (frame.hash !== undefined && stateHash(this.frameState) !== frame.hash) {
+                this.ws.send(JSON.stringify({ action: 'resync' }));
+                this.frameState = null;
+                return null;
+            }
+            return this.frameState;
+        }
+        
+        // 従来形式（完全な状態やエラー）はそのまま扱う
+        return frame;
+    }
+    
+    decodeBinaryFrame(buffer) {
+        // レイアウトはbackend/protocol.pyのSTATE_HEADERと同じ（リトルエンディアン）
+        const view = new DataView(buffer);
+        const flags = view.getUint8(5);
+        const boardOffset = 29;
+        const bombsOffset = boardOffset + this.boardWidth * this.boardHeight;
+        
+        const board = [];
+        for (let y = 0; y < this.boardHeight; y++) {
+            const row = [];
+            for (let x = 0; x < this.boardWidth; x++) {
+                const index = view.getUint8(boardOffset + y * this.boardWidth + x);
+                row.push(index === 0 ? 0 : BINARY_COLORS[index]);
+            }
+            board.push(row);
+        }
+        
+        const bombs = [];
+        const bombCount = view.getUint8(28);
+        for (let i = 0; i < bombCount; i++) {
+            const offset = bombsOffset + i * 3;
+            bombs.push({
+                x: view.getInt8(offset),
+                y: view.getInt8(offset + 1),
+                active: view.getUint8(offset + 2) === 1
+            });
+        }
+        
+        // 処理済みの入力の通番は爆弾の後ろに付く（状態ハッシュ付きでは通番が0なら未処理）
+        const frameType = view.getUint8(0);
+        if (frameType === BINARY_FRAME_STATE_ACK) {
+            this.acknowledgeInput(view.getUint32(bombsOffset + bombCount * 3, true));
+        } else if (frameType === BINARY_FRAME_STATE_HASH) {
+            const ack = view.getUint32(bombsOffset + bombCount * 3, true);
+            if (ack > 0) {
+                this.acknowledgeInput(ack);
+            }
+        }
+        
+        const currentShape = view.getInt8(25);
+        const nextShape = view.getInt8(27);
+        return {
+            board,
+            current_piece: (flags & 0x04) ? {
+                x: view.getInt8(23),
+                y: view.getInt8(24),
+                shape: rotatedShape(currentShape, view.getUint8(26)),
+                color: pieceColor(currentShape),
+                is_bomb: currentShape === -1,
+                shape_idx: currentShape,
+                rotation: view.getUint8(26)
+            } : null,
+            next_piece: (flags & 0x08) ? {
+                shape: rotatedShape(nextShape, 0),
+                color: pieceColor(nextShape),
+                is_bomb: nextShape === -1
+            } : null,
+            bombs,
+            game_over: (flags & 0x01) !== 0,
+            paused: (flags & 0x02) !== 0,
+            score: view.getUint32(6, true),
+            level: view.getUint16(10, true),
+            lines_cleared: view.getUint32(12, true),
+            bombs_available: view.getUint16(16, true),
+            speed_multiplier: view.getFloat32(18, true),
+            lines_cleared_this_frame: view.getUint8(22)
+        };
+    }
+    
+    encodeBinaryAction(action, x, y, seq) {
+        // 1バイトのオペコードと4バイトの通番（爆弾配置のみ座標2バイトを付加）
+        const opcode = ACTION_OPCODES[action] | OPCODE_SEQ_FLAG;
+        const buffer = new ArrayBuffer(action === 'place_bomb' ? 7 : 5);
+        const view = new DataView(buffer);
+        view.setUint8(0, opcode);
+        view.setUint32(1, seq, true);
+        if (action === 'place_bomb') {
+            view.setInt8(5, x);
+            view.setInt8(6, y);
+        }
+        return buffer;
+    }
+    
+    acknowledgeInput(ack) {
+        // 処理済みになった入力の応答時間を記録し、応答待ちから外す
+        const sentAt = this.inputSentAt.get(ack);
+        if (sentAt !== undefined) {
+            this.inputLatency = performance.now() - sentAt;
+        }
+        for (const seq of this.inputSentAt.keys()) {
+            if (seq <= ack) {
+                this.inputSentAt.delete(seq);
+            }
+        }
+        this.lastAck = ack;
+        this.pendingInputs = this.pendingInputs.filter(input => input.seq > ack);
+    }
+    
+    pieceFits(board, shapeIdx, rotation, x, y) {
+        // サーバーのTetrisGame.piece_fits()と同じ判定（盤面より上ははみ出してよい）
+        const cells = this.pieceRules.rotations[shapeIdx][rotation];
+        const [width, height] = this.pieceRules.board;
+        return cells.every(([dx, dy]) => {
+            const bx = x + dx;
+            const by = y + dy;
+            if (bx < 0 || bx >= width || by >= height) return false;
+            return by < 0 || !board[by][bx];
+        });
+    }
+    
+    predictMove(board, piece, action) {
+        // サーバーのperform_action()と同じ規則で1つの操作の結果を求める
+        if (action === 'down') {
+            // ↓は置ける限り最大soft_dropマス落とす
+            let y = piece.y;
+            for (let i = 0; i < this.pieceRules.soft_drop; i++) {
+                if (!this.pieceFits(board, piece.shape_idx, piece.rotation, piece.x, y + 1)) break;
+                y++;
+            }
+            return y === piece.y ? piece : { ...piece, y };
+        }
+        const moves = { left: [-1, 0], right: [1, 0] };
+        if (action in moves) {
+            const [dx, dy] = moves[action];
+            if (this.pieceFits(board, piece.shape_idx, piece.rotation, piece.x + dx, piece.y + dy)) {
+                return { ...piece, x: piece.x + dx, y: piece.y + dy };
+            }
+            return piece;
+        }
+        const rotation = (piece.rotation + 1) % 4;
+        if (this.pieceFits(board, piece.shape_idx, rotation, piece.x, piece.y)) {
+            return { ...piece, rotation };
+        }
+        for (const [dx, dy] of this.pieceRules.kicks) {
+            if (this.pieceFits(board, piece.shape_idx, rotation, piece.x + dx, piece.y + dy)) {
+                return { ...piece, rotation, x: piece.x + dx, y: piece.y + dy };
+            }
+        }
+        return piece;
+    }
+    
+    reconcile(state) {
+        // サーバーの状態に、まだ処理されていない予測済みの入力を順に適用し直した状態
+        if (!this.pieceRules || !state.current_piece || state.paused || state.game_over ||
+            this.pendingInputs.length === 0) {
+            return state;
+        }
+        let piece = state.current_piece;
+        for (const input of this.pendingInputs) {
+            piece = this.predictMove(state.board, piece, input.action);
+        }
+        if (piece === state.current_piece) {
+            return state;
+        }
+        piece = { ...piece, shape: rotatedShape(piece.shape_idx, piece.rotation) };
+        return { ...state, current_piece: piece, lines_cleared_this_frame: 0 };
+    }
+    
     updateConnectionStatus(message, color) {
         const statusElement = document.getElementById('connectionStatus');
         if (statusElement) {
@@ -449,7 +809,18 @@ class TetrisWebGame {
                 break;
         }
         
-        const message = { action };
+        // 入力ごとに通番を付け、処理済みの通番が返るまでの時間を測る
+        this.inputSeq = (this.inputSeq + 1) >>> 0;
+        const message = { action, seq: this.inputSeq };
+        
+        // 予測できる操作は応答を待たずに手元で結果を描画する
+        if (this.predict && this.authoritativeState && PREDICTED_ACTIONS.includes(action)) {
+            this.pendingInputs.push({ seq: message.seq, action });
+            const predicted = this.reconcile(this.authoritativeState);
+            if (predicted !== this.authoritativeState) {
+                this.updateGameState(predicted);
+            }
+        }
         if (x !== null && y !== null) {
             message.x = x;
             message.y = y;
@@ -458,7 +829,12 @@ class TetrisWebGame {
         // 高速送信（エラーハンドリング付き）
         try {
             if (this.ws && this.ws.readyState === WebSocket.OPEN) {
-                this.ws.send(JSON.stringify(message));
+                this.inputSentAt.set(message.seq, performance.now());
+                if (this.wireProtocol === 'binary' && action in ACTION_OPCODES) {
+                    this.ws.send(this.encodeBinaryAction(action, message.x || 0, message.y || 0, message.seq));
+                } else {
+                    this.ws.send(JSON.stringify(message));
+                }
             }
         } catch (error) {
             console.warn('WebSocket送信エラー:', error);
@@ -903,7 +1279,8 @@ class TetrisWebGame {
                 body: JSON.stringify({
                     score: currentScore,
                     level: this.gameState.level,
-                    lines_cleared: this.gameState.lines_cleared
+                    lines_cleared: this.gameState.lines_cleared,
+                    game_id: this.gameId
                 })
             });
             
@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""
+/ws エンドポイントの負荷試験ツール
+
+ローカルでサーバーを起動し（--url指定時は既存サーバーを使用）、同時接続数ごとに
+模擬クライアントを接続して以下を計測する。
+- アクション送信からその通番を処理済みとして返す状態フレーム受信までの遅延（パーセンタイル）
+- フレーム到着間隔のばらつき（ジッター）
+- 受信バイト数/秒、フレーム数/秒
+- サーバープロセス（子プロセスを含む）のCPU使用率とRSS
+
+結果はJSONファイルに保存され、コミット間で比較できる。
+
+使い方:
+    python loadtest.py --clients 10,50,100 --duration 10
+    python loadtest.py --clients 200 --encoding binary --output results.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import statistics
+import struct
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import websockets
+
+# 模擬クライアントのアクションの比率（実際のプレイに近い配分）
+ACTION_MIX = [
+    ("left", 25),
+    ("right", 25),
+    ("rotate", 20),
+    ("down", 15),
+    ("hard_drop", 15),
+]
+
+# バイナリ状態フレームのヘッダー（backend/protocol.py の STATE_HEADER と同じ配置）
+BINARY_FRAME_STATE = 1
+BINARY_FRAME_STATE_ACK = 2  # 末尾に処理済みの入力の通番（4バイト）
+BINARY_FRAME_STATE_HASH = 3  # 末尾に通番（なければ0）と状態ハッシュ（4バイトずつ）
+BINARY_FLAGS_OFFSET = 5
+BINARY_FLAG_GAME_OVER = 1
+INPUT_SEQ = struct.Struct("<I")
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend")
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """パーセンタイル（最近傍法）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(p / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    """ミリ秒の値の要約統計"""
+    return {
+        "count": len(values),
+        "mean": statistics.fmean(values) if values else None,
+        "stdev": statistics.pstdev(values) if len(values) > 1 else None,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+
+def is_game_over(message: Any) -> bool:
+    """フレームがゲームオーバーを示しているか（JSON・差分・バイナリ形式）"""
+    if isinstance(message, bytes):
+        return (len(message) > BINARY_FLAGS_OFFSET and
+                message[0] in (BINARY_FRAME_STATE, BINARY_FRAME_STATE_ACK, BINARY_FRAME_STATE_HASH) and
+                bool(message[BINARY_FLAGS_OFFSET] & BINARY_FLAG_GAME_OVER))
+    return '"game_over": true' in message
+
+
+def frame_ack(message: Any) -> Optional[int]:
+    """フレームに付いた処理済みの入力の通番（付いていなければNone）"""
+    if isinstance(message, bytes):
+        if message[:1] == bytes([BINARY_FRAME_STATE_ACK]):
+            return INPUT_SEQ.unpack_from(message, len(message) - INPUT_SEQ.size)[0]
+        if message[:1] == bytes([BINARY_FRAME_STATE_HASH]):
+            return INPUT_SEQ.unpack_from(message, len(message) - 2 * INPUT_SEQ.size)[0] or None
+        return None
+    if '"ack"' not in message:
+        return None
+    frame = json.loads(message)
+    return frame.get("ack") if isinstance(frame, dict) else None
+
+
+class ProcessUsage:
+    """/proc から読み取るプロセスツリー（子プロセスを含む）のCPU時間とRSS（Linuxのみ）"""
+
+    def __init__(self, pid: Optional[int]):
+        self.pid = pid
+        self.clock_ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+        self.page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+    def _tree(self) -> List[int]:
+        children: Dict[int, List[int]] = {}
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                children.setdefault(int(fields[1]), []).append(int(entry))
+            except (OSError, IndexError, ValueError):
+                continue
+        tree, stack = [], [self.pid]
+        while stack:
+            pid = stack.pop()
+            tree.append(pid)
+            stack.extend(children.get(pid, []))
+        return tree
+
+    def sample(self) -> Optional[Dict[str, float]]:
+        """CPU時間（秒）とRSS（MB）の合計"""
+        if self.pid is None or not os.path.exists("/proc"):
+            return None
+        cpu_ticks = 0
+        rss_pages = 0
+        for pid in self._tree():
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                # utime, stime は ")" 以降の12・13番目、rss は22番目
+                cpu_ticks += int(fields[11]) + int(fields[12])
+                rss_pages += int(fields[21])
+            except (OSError, IndexError, ValueError):
+                continue
+        return {
+            "cpu_sec": cpu_ticks / self.clock_ticks,
+            "rss_mb": rss_pages * self.page_size / (1024 * 1024),
+        }
+
+
+class ClientStats:
+    """全模擬クライアントの計測値"""
+
+    def __init__(self):
+        self.latencies_ms: List[float] = []
+        self.frame_gaps_ms: List[float] = []
+        self.frames = 0
+        self.bytes = 0
+        self.actions = 0
+        self.errors = 0
+        self.connected = 0
+        # 遅延・フレーム間隔は全クライアント接続後の定常状態でだけ記録する（フレーム数/秒と同じ区間）
+        self.measuring = False
+
+
+async def run_client(url: str, stats: ClientStats, stop_at: float, actions_per_sec: float,
+                     speed: float, rng: random.Random):
+    """1つの模擬クライアント（アクションに通番を付け、その通番のackが付いたフレームの受信までを1往復として計測）"""
+    actions = [name for name, _ in ACTION_MIX]
+    weights = [weight for _, weight in ACTION_MIX]
+    try:
+        async with websockets.connect(url, max_size=None) as ws:
+            stats.connected += 1
+            await ws.send(json.dumps({"action": "start", "initial_speed_multiplier": speed}))
+
+            seq = 0
+            pending_since: Optional[float] = None
+            last_frame: Optional[float] = None
+            next_action = time.perf_counter() + rng.expovariate(actions_per_sec)
+
+            while time.perf_counter() < stop_at:
+                now = time.perf_counter()
+                if pending_since is None and now >= next_action:
+                    action = rng.choices(actions, weights)[0]
+                    # 状態が変わらない操作（壁際の移動など）にも応答フレームが返るように通番を付ける
+                    seq += 1
+                    await ws.send(json.dumps({"action": action, "seq": seq}))
+                    stats.actions += 1
+                    pending_since = time.perf_counter()
+                    next_action = pending_since + rng.expovariate(actions_per_sec)
+
+                timeout = max(0.001, min(next_action, stop_at) - time.perf_counter())
+                try:
+                    message = await asyncio.wait_for(ws.recv(), timeout)
+                except asyncio.TimeoutError:
+                    continue
+
+                received = time.perf_counter()
+                stats.frames += 1
+                stats.bytes += len(message)
+                if last_frame is not None and stats.measuring:
+                    stats.frame_gaps_ms.append((received - last_frame) * 1000)
+                last_frame = received
+                if pending_since is not None:
+                    ack = frame_ack(message)
+                    if ack is not None and ack >= seq:
+                        if stats.measuring:
+                            stats.latencies_ms.append((received - pending_since) * 1000)
+                        pending_since = None
+
+                # ゲームオーバーになったら再スタート
+                if is_game_over(message):
+                    await ws.send(json.dumps({"action": "start", "initial_speed_multiplier": speed}))
+    except Exception as e:
+        stats.errors += 1
+        print(f"クライアントエラー: {e}", file=sys.stderr)
+
+
+async def run_level(url: str, clients: int, duration: float, ramp: float,
+                    actions_per_sec: float, speed: float, usage: ProcessUsage,
+                    seed: int) -> Dict[str, Any]:
+    """同時接続数1段階分の計測"""
+    stats = ClientStats()
+    rng = random.Random(seed)
+    started = time.perf_counter()
+    stop_at = started + ramp + duration
+
+    tasks = []
+    for i in range(clients):
+        tasks.append(asyncio.create_task(run_client(
+            url, stats, stop_at, actions_per_sec, speed, random.Random(rng.random()))))
+        # 接続を均等にずらして一斉接続のスパイクを避ける
+        await asyncio.sleep(ramp / clients if clients else 0)
+
+    # 全クライアント接続後の定常状態でサーバー資源を計測
+    usage_start = usage.sample()
+    stats.measuring = True
+    measure_started = time.perf_counter()
+    frames_start, bytes_start = stats.frames, stats.bytes
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - measure_started
+    usage_end = usage.sample()
+
+    result: Dict[str, Any] = {
+        "clients": clients,
+        "connected": stats.connected,
+        "errors": stats.errors,
+        "duration_sec": elapsed,
+        "actions": stats.actions,
+        "frames_per_sec": (stats.frames - frames_start) / elapsed if elapsed else None,
+        "bytes_per_sec": (stats.bytes - bytes_start) / elapsed if elapsed else None,
+        "latency_ms": summarize(stats.latencies_ms),
+        "frame_gap_ms": summarize(stats.frame_gaps_ms),
+    }
+    if usage_start and usage_end:
+        result["server_cpu_percent"] = (usage_end["cpu_sec"] - usage_start["cpu_sec"]) / elapsed * 100
+        result["server_rss_mb"] = usage_end["rss_mb"]
+    return result
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port: int) -> subprocess.Popen:
+    """backendディレクトリでuvicornを起動し、接続可能になるまで待つ"""
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1",
+         "--port", str(port), "--log-level", "warning"],
+        cwd=BACKEND_DIR,
+        stdout=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("サーバーの起動に失敗しました")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("サーバーが起動しませんでした")
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True, cwd=BACKEND_DIR).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_ms(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value:.1f}"
+
+
+def print_result(result: Dict[str, Any]):
+    latency = result["latency_ms"]
+    gaps = result["frame_gap_ms"]
+    cpu = result.get("server_cpu_percent")
+    rss = result.get("server_rss_mb")
+    print(
+        f"{result['clients']:>6} | "
+        f"{format_ms(latency['p50']):>7} {format_ms(latency['p95']):>7} {format_ms(latency['p99']):>7} | "
+        f"{format_ms(gaps['p50']):>7} {format_ms(gaps['stdev']):>7} | "
+        f"{result['frames_per_sec']:>8.0f} {result['bytes_per_sec'] / 1024:>9.1f} | "
+        f"{'-' if cpu is None else f'{cpu:.0f}':>5} {'-' if rss is None else f'{rss:.0f}':>6} | "
+        f"{result['errors']:>4}"
+    )
+
+
+async def main_async(args: argparse.Namespace):
+    levels = [int(n) for n in args.clients.split(",") if n]
+    process = None
+    url = args.url
+    server_pid = args.server_pid
+    if url is None:
+        port = free_port()
+        print(f"🚀 サーバーを起動中... (port={port})")
+        process = start_server(port)
+        server_pid = process.pid
+        url = f"ws://127.0.0.1:{port}/ws"
+
+    query = []
+    if args.encoding:
+        query.append(f"encoding={args.encoding}")
+    if args.frames:
+        query.append(f"frames={args.frames}")
+    if args.rate:
+        query.append(f"rate={args.rate}")
+    if query:
+        url += ("&" if "?" in url else "?") + "&".join(query)
+
+    usage = ProcessUsage(server_pid)
+    results = []
+    print("接続数 | 遅延p50    p95     p99 | 間隔p50  stdev | frames/s   KiB/s | CPU%  RSSMB | 失敗")
+    try:
+        for i, clients in enumerate(levels):
+            result = await run_level(url, clients, args.duration, args.ramp,
+                                     args.actions_per_sec, args.speed, usage, args.seed + i)
+            print_result(result)
+            results.append(result)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "url": url,
+        "settings": {
+            "duration_sec": args.duration,
+            "ramp_sec": args.ramp,
+            "actions_per_sec": args.actions_per_sec,
+            "speed": args.speed,
+            "encoding": args.encoding,
+            "frames": args.frames,
+            "rate": args.rate,
+            "shard_workers": os.environ.get("SHARD_WORKERS", "0"),
+        },
+        "levels": results,
+    }
+    output = args.output or f"loadtest_{report['commit'] or 'local'}_{time.strftime('%Y%m%d_%H%M%S')}.json"
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"📄 結果を保存しました: {output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="/ws エンドポイントの負荷試験")
+    parser.add_argument("--clients", default="10,50,100", help="同時接続数（カンマ区切りで段階指定）")
+    parser.add_argument("--duration", type=float, default=10.0, help="各段階の計測時間（秒）")
+    parser.add_argument("--ramp", type=float, default=2.0, help="全クライアントの接続にかける時間（秒）")
+    parser.add_argument("--actions-per-sec", type=float, default=5.0, help="1クライアントあたりの平均アクション数/秒")
+    parser.add_argument("--speed", type=float, default=1.0, help="ゲーム開始時の速度倍率")
+    parser.add_argument("--encoding", choices=["binary"], help="通信形式（省略時はJSON）")
+    parser.add_argument("--frames", choices=["delta"], help="JSONのフレーム形式（省略時は完全な状態）")
+    parser.add_argument("--rate", type=int, choices=[20, 30, 60], help="状態の送信レート（Hz、省略時はサーバーの既定値）")
+    parser.add_argument("--url", help="既存サーバーのWebSocket URL（省略時はローカルで起動）")
+    parser.add_argument("--server-pid", type=int, help="--url指定時にCPU・RSSを計測するサーバーのPID")
+    parser.add_argument("--seed", type=int, default=1, help="アクション選択の乱数シード")
+    parser.add_argument("--output", help="結果のJSONファイル名")
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()